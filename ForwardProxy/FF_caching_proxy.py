@@ -1,20 +1,45 @@
-import hashlib
+from __future__ import annotations
+
+import heapq
+import itertools
 import asyncio
 from pathlib import Path
 import time
 import aiohttp
+from aiohttp.abc import AbstractAccessLogger
 import aiofiles
 import dataclasses
 
 import logging
 from aiohttp import web
 import os
-import tempfile
+import shutil
+import uuid
+import multiprocessing
+import signal
 from urllib.parse import urlparse
 
 import aiohttp_jinja2
 import jinja2
 from datetime import datetime
+from multidict import CIMultiDict
+from yarl import URL
+
+from blob_store import BLOB_DIR, BlobStore
+from cache_index import CacheIndex
+from eviction import make_policy
+from upstream_pool import UpstreamPool
+from hot_tier import HotTier
+from metrics import MetricsRegistry
+from process_lock import KeyLocks
+from compression import accepts_encoding, is_compressible, make_compressor, make_decompressor, resolve_encoding
+from sparse_cache import PartialObject, parse_content_range, requested_range, upstream_range
+from warmer import WarmJob
+from purge import PurgeJob, UrlMatcher
+from access_log import REPLAY_HEADERS, AccessLog
+from cache_key import KeyBuilder
+from resilience import UPSTREAM_BODY_ERRORS, CircuitOpenError, UpstreamGuard
+from freshness import CLIENT_CONDITIONAL_HEADERS, NEGOTIATED_HEADERS, REVALIDATION_HEADERS, Freshness, compute_freshness, conditional_headers, vary_snapshot
 
 
 #set up logging
@@ -30,31 +55,133 @@ class GetCallResult:
     headers: dict
     uri : str
     cachePath : str  
+    cacheKey : str
+    size: int = 0
     number_of_requests: int = dataclasses.field(default_factory=lambda: 1)
-    created_time: float = dataclasses.field(default_factory=lambda: asyncio.get_event_loop().time())   
-    last_accessed_time: float = dataclasses.field(default_factory=lambda: asyncio.get_event_loop().time())
+    # wall clock times so they survive a restart through the cache index
+    created_time: float = dataclasses.field(default_factory=time.time)   
+    last_accessed_time: float = dataclasses.field(default_factory=time.time)
+    expires_at: float = 0.0
+    stale_while_revalidate: float = 0.0
+    # how long past expiry the copy may be served while upstream fails
+    stale_if_error: float = 0.0
+    # request header values this response was selected by, from its Vary header
+    vary: dict = dataclasses.field(default_factory=dict)
+    # Content-Encoding the proxy stored the body with, None for a plain body
+    encoding: str | None = None
+    # digest of the body when its file is a link into the blob store
+    blob: str | None = None
 
     def CacheHit(self):
         self.number_of_requests += 1
-        self.last_accessed_time = asyncio.get_event_loop().time()
-        logger.info(f"Cache hit n: {self.number_of_requests} for {self.uri}")
+        self.last_accessed_time = time.time()
+        cacheIndex.Hit(self.cacheKey, self.number_of_requests, self.last_accessed_time)
+        cacheBudget.policy.Touch(self.cacheKey)
+        logger.debug(f"Cache hit n: {self.number_of_requests} for {self.uri}")
+
+    def ToRecord(self) -> dict:
+        return {
+            "key": self.cacheKey,
+            "uri": str(self.uri),
+            "file": os.path.basename(self.cachePath),
+            "headers": list(self.headers.items()),
+            "size": self.size,
+            "number_of_requests": self.number_of_requests,
+            "created_time": self.created_time,
+            "last_accessed_time": self.last_accessed_time,
+            "expires_at": self.expires_at,
+            "stale_while_revalidate": self.stale_while_revalidate,
+            "stale_if_error": self.stale_if_error,
+            "vary": self.vary,
+            "encoding": self.encoding,
+            "blob": self.blob,
+        }
+
+    @classmethod
+    def FromRecord(cls, record: dict) -> "GetCallResult":
+        headers = CIMultiDict(record["headers"])
+        encoding = record.get("encoding")
+        if encoding is None:
+            # bodies are stored decoded unless the proxy compressed them, older records kept upstream's header
+            headers.popall("Content-Encoding", None)
+        return cls(
+            headers=headers,
+            uri=record["uri"],
+            cachePath=os.path.join(CACHE_DIR, record["file"]),
+            cacheKey=record["key"],
+            size=record["size"],
+            number_of_requests=record["number_of_requests"],
+            created_time=record["created_time"],
+            last_accessed_time=record["last_accessed_time"],
+            # records written before freshness tracking are treated as expired
+            expires_at=record.get("expires_at", 0.0),
+            stale_while_revalidate=record.get("stale_while_revalidate", 0.0),
+            stale_if_error=record.get("stale_if_error", STALE_IF_ERROR),
+            vary=record.get("vary", {}),
+            encoding=encoding,
+            blob=record.get("blob"),
+        )
+
+    def ApplyFreshness(self, freshness: Freshness):
+        self.expires_at = freshness.expires_at
+        self.stale_while_revalidate = freshness.stale_while_revalidate
+        self.stale_if_error = freshness.stale_if_error
+
+    def IsFresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    def CanServeStale(self) -> bool:
+        return time.time() < self.expires_at + self.stale_while_revalidate
+
+    def CanServeIfError(self) -> bool:
+        return time.time() < self.expires_at + self.stale_if_error
+
+    def MatchesVary(self, request_headers) -> bool:
+        return all(request_headers.get(name, "") == value for name, value in self.vary.items())
+
+    def Revalidated(self, response_headers):
+        """
+        Folds the headers of a 304 Not Modified into the stored response and restarts its freshness.
+        """
+        headers = CIMultiDict(self.headers)
+        for name in REVALIDATION_HEADERS:
+            if name in response_headers:
+                headers[name] = response_headers[name]
+        self.headers = headers
+        hotTier.Remove(self.cacheKey)
+        self.ApplyFreshness(compute_freshness(headers, DEFAULT_TTL, STALE_WHILE_REVALIDATE, default_stale_if_error=STALE_IF_ERROR))
+        cacheIndex.Put(self.ToRecord(), new=False)
     
     def Stats(self):
-        size_str = self.GetFileSize()
-        minutes, seconds = divmod(int(asyncio.get_event_loop().time() - self.last_accessed_time), 60)    
+        minutes, seconds = divmod(int(time.time() - self.last_accessed_time), 60)    
         createdAt = datetime.fromtimestamp(self.created_time).strftime('%H:%M:%S')
         return {
+            "cacheKey": self.cacheKey,
             "uri": self.uri,
-            "size": size_str,
+            "size": self.GetFileSize(),
             "number_of_requests": self.number_of_requests,
             "created_time": createdAt,
-            "size" : self.GetFileSize(),
             "time_since_use": f"{minutes:02}:{seconds:02}"
             
         }
 
+    def ToListing(self) -> dict:
+        return {
+            "key": self.cacheKey,
+            "uri": str(self.uri),
+            "size": self.size,
+            "number_of_requests": self.number_of_requests,
+            "created_time": self.created_time,
+            "last_accessed_time": self.last_accessed_time,
+            "expires_at": self.expires_at,
+            "fresh": self.IsFresh(),
+            "encoding": self.encoding,
+            "blob": self.blob,
+        }
+
     def GetFileSize(self) -> str:
-        file_size = os.path.getsize(self.cachePath)
+        # the size counted while the file was written, rendering the cache page doesn't stat every file
+        file_size = self.size
         if file_size >= 1024 * 1024:
             size_str = f"{file_size / (1024 * 1024):.2f} MB"
         else:
@@ -63,50 +190,495 @@ class GetCallResult:
         return size_str
 
 
+def _new_future() -> asyncio.Future:
+    future = asyncio.get_running_loop().create_future()
+    # a fill may fail with nobody waiting on it, don't warn about the unretrieved exception
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    return future
+
 @dataclasses.dataclass
 class ConcurrentCall:
+    """
+    A single upstream fill shared by every request for the same cache key.
+    Notes:
+        - The fill runs in its own task, so a disconnecting client never cancels it for the others.
+        - `started` resolves with the outcome once upstream has answered, `finished` with (entry, outcome)
+          when the body is on disk. A failure is set on both so every waiter sees it.
+        - Followers stream the body from the partial file as it is written, `progress` is swapped for a
+          fresh future on every write to wake them up.
+    """
     uri: str
-    number_of_requests: int
-    wait_handle : asyncio.Condition
-
-    def NewCall(self) -> asyncio.Condition:
+    cacheKey: str
+    number_of_requests: int = 1
+    headers: CIMultiDict | None = None
+    partPath: str | None = None
+    expected_size: int | None = None
+    bytes_written: int = 0
+    vary: dict = dataclasses.field(default_factory=dict)
+    # set while another worker process holds the fill lock for the key
+    locked_elsewhere: bool = False
+    task: asyncio.Task | None = None
+    started: asyncio.Future = dataclasses.field(default_factory=_new_future)
+    finished: asyncio.Future = dataclasses.field(default_factory=_new_future)
+    progress: asyncio.Future = dataclasses.field(default_factory=_new_future)
+
+    def NewCall(self):
         self.number_of_requests += 1
-        return self.wait_handle
+
+    def Started(self, outcome: str, headers=None, partPath: str | None = None, expected_size: int | None = None, vary: dict | None = None):
+        self.headers = headers
+        self.partPath = partPath
+        self.expected_size = expected_size
+        self.vary = vary or {}
+        self.started.set_result(outcome)
+
+    def Wrote(self, size: int):
+        self.bytes_written += size
+        self._Notify()
+
+    def Finished(self, entry: GetCallResult, outcome: str):
+        if not self.started.done():
+            self.started.set_result(outcome)
+        self.finished.set_result((entry, outcome))
+        self._Notify()
+
+    def Failed(self, error: BaseException):
+        for future in (self.started, self.finished):
+            if not future.done():
+                future.set_exception(error)
+        self._Notify()
+
+    def _Notify(self):
+        progress, self.progress = self.progress, _new_future()
+        progress.set_result(None)
+
+    async def WaitForProgress(self, seen: int, timeout: float):
+        """
+        Waits until more than `seen` bytes are on disk or the fill is over.
+        Raises:
+            asyncio.TimeoutError: If the fill makes no progress within `timeout` seconds.
+        """
+        while self.bytes_written <= seen and not self.finished.done():
+            await asyncio.wait_for(asyncio.shield(self.progress), timeout)
 
     def Stats(self):
-        return {"uri": self.uri, "number_of_requests": self.number_of_requests}
+        return {"uri": self.uri, "number_of_requests": self.number_of_requests, "bytes_written": self.bytes_written}
 
 concurrentCalls: dict[str, ConcurrentCall] = {}
 storedData: dict[str, GetCallResult] = {}
 
 
 CACHE_DIR = os.getenv('FFPROXY_CACHE_PATH', 'cache')
-PORT = os.getenv('FFPROXY_PORT', 8080)
-TIMEOUT = os.getenv('FFPROXY_TIMEOUT', 60)
-LIFETIME = os.getenv('FFPROXY_LIFETIME', "CartaBlanca")
+PORT = int(os.getenv('FFPROXY_PORT', 8080))
+# idle read timeout towards upstream, large downloads are bounded by stalls rather than total time
+TIMEOUT = float(os.getenv('FFPROXY_TIMEOUT', 60))
+CONNECT_TIMEOUT = float(os.getenv('FFPROXY_CONNECT_TIMEOUT', 10))
+UPSTREAM_LIMIT = int(os.getenv('FFPROXY_UPSTREAM_LIMIT', 100))
+UPSTREAM_LIMIT_PER_HOST = int(os.getenv('FFPROXY_UPSTREAM_LIMIT_PER_HOST', 20))
+KEEPALIVE_TIMEOUT = float(os.getenv('FFPROXY_KEEPALIVE_TIMEOUT', 30))
+DNS_CACHE_TTL = int(os.getenv('FFPROXY_DNS_CACHE_TTL', 300))
+# freshness for responses without Cache-Control/Expires, and the default stale-while-revalidate window
+DEFAULT_TTL = float(os.getenv('FFPROXY_DEFAULT_TTL', 3600))
+STALE_WHILE_REVALIDATE = float(os.getenv('FFPROXY_STALE_WHILE_REVALIDATE', 60))
+# how long past expiry a cached copy stands in for a failing upstream unless the response says otherwise, 0 disables
+STALE_IF_ERROR = float(os.getenv('FFPROXY_STALE_IF_ERROR', 0))
+# how long a request waits on a shared upstream fill that makes no progress before giving up
+FILL_STALL_TIMEOUT = float(os.getenv('FFPROXY_FILL_STALL_TIMEOUT', 30))
+CHUNK_SIZE = 64 * 1024
+# off, gzip or zstd, compressible responses are stored encoded once and decoded for clients that don't accept it
+COMPRESSION = resolve_encoding(os.getenv('FFPROXY_COMPRESSION', 'off'))
+COMPRESSION_LEVEL = int(os.getenv('FFPROXY_COMPRESSION_LEVEL')) if os.getenv('FFPROXY_COMPRESSION_LEVEL') else None
+# block size of partially cached objects filled by Range requests, 0 sends ranges on cold keys through a full fill
+RANGE_BLOCK_SIZE = int(os.getenv('FFPROXY_RANGE_BLOCK_SIZE', 1024 * 1024))
+# "warm" restores the cache from the on-disk index, "clean" wipes CACHE_DIR on startup
+STARTUP_MODE = os.getenv('FFPROXY_STARTUP_MODE', "warm")
+INDEX_FLUSH_INTERVAL = float(os.getenv('FFPROXY_INDEX_FLUSH_INTERVAL', 1.0))
+# cache budget, 0 disables the limit
+MAX_CACHE_BYTES = int(os.getenv('FFPROXY_MAX_BYTES', 10 * 1024 * 1024 * 1024))
+MAX_CACHE_ENTRIES = int(os.getenv('FFPROXY_MAX_ENTRIES', 100_000))
+EVICTION_POLICY = os.getenv('FFPROXY_EVICTION_POLICY', "lru")
+# RAM tier for small hot entries, 0 bytes disables it
+HOT_TIER_BYTES = int(os.getenv('FFPROXY_HOT_TIER_BYTES', 64 * 1024 * 1024))
+HOT_TIER_MAX_OBJECT = int(os.getenv('FFPROXY_HOT_TIER_MAX_OBJECT', 64 * 1024))
+HOT_TIER_PROMOTE_HITS = int(os.getenv('FFPROXY_HOT_TIER_PROMOTE_HITS', 3))
+# worker processes sharing the port through SO_REUSEPORT, the cache index and the fill locks
+WORKERS = int(os.getenv('FFPROXY_WORKERS', 1))
+# set by the parent for each worker, None when running as a single process
+WORKER_ID = os.getenv('FFPROXY_WORKER_ID')
+# the first worker does the housekeeping that must run once, eviction and startup compaction
+PRIMARY = WORKER_ID in (None, "0")
+# store identical bodies once, cache entries become hard links into a content addressed blob store
+DEDUPLICATE = os.getenv('FFPROXY_DEDUPLICATE', "off").lower() in ("1", "on", "true")
+# defaults for warm jobs, urls fetched at once and started per second (0 unlimited)
+WARM_CONCURRENCY = int(os.getenv('FFPROXY_WARM_CONCURRENCY', 8))
+WARM_RATE = float(os.getenv('FFPROXY_WARM_RATE', 0))
+# background refresh of the most requested entries shortly before they expire, 0 entries disables it
+REFRESH_TOP_N = int(os.getenv('FFPROXY_REFRESH_TOP_N', 0))
+REFRESH_INTERVAL = float(os.getenv('FFPROXY_REFRESH_INTERVAL', 60))
+REFRESH_AHEAD = float(os.getenv('FFPROXY_REFRESH_AHEAD', 300))
+# JSON lines log of the proxied requests for replay.py, off unless a path is given
+ACCESS_LOG_PATH = os.getenv('FFPROXY_ACCESS_LOG')
+ACCESS_LOG_FLUSH_INTERVAL = float(os.getenv('FFPROXY_ACCESS_LOG_FLUSH_INTERVAL', 1.0))
+
+# Host values, with or without port, the cache api answers on, other hosts are proxied, empty answers any host
+API_HOSTS = {name.strip().lower() for name in os.getenv('FFPROXY_API_HOSTS', "").split(',') if name.strip()}
+# cache key normalization: query parameters left out of the key (utm_* matches a prefix), whether the rest are sorted,
+# request headers upstream varies on that get an entry per value, and how many recent url to key computations are kept
+KEY_IGNORE_PARAMS = [name.strip() for name in os.getenv('FFPROXY_KEY_IGNORE_PARAMS', "").split(',') if name.strip()]
+KEY_SORT_QUERY = os.getenv('FFPROXY_KEY_SORT_QUERY', "on").lower() in ("1", "on", "true")
+KEY_HEADERS = [name.strip() for name in os.getenv('FFPROXY_KEY_HEADERS', "").split(',') if name.strip() and name.strip().lower() not in NEGOTIATED_HEADERS]
+KEY_MEMO_SIZE = int(os.getenv('FFPROXY_KEY_MEMO_SIZE', 4096))
+
+# consecutive failures that open an upstream host's circuit, 0 never opens it, and how long it stays open
+BREAKER_FAILURES = int(os.getenv('FFPROXY_BREAKER_FAILURES', 5))
+BREAKER_OPEN_SECONDS = float(os.getenv('FFPROXY_BREAKER_OPEN_SECONDS', 30))
+# time upstream gets to answer a cache fill with its headers
+HEADERS_TIMEOUT = float(os.getenv('FFPROXY_HEADERS_TIMEOUT', 30))
+# fills slower than this latency percentile of their host are sent twice, 0 disables hedging
+HEDGE_PERCENTILE = float(os.getenv('FFPROXY_HEDGE_PERCENTILE', 0))
+HEDGE_MIN_DELAY = float(os.getenv('FFPROXY_HEDGE_MIN_DELAY', 0.05))
+HEDGE_MAX_RATIO = float(os.getenv('FFPROXY_HEDGE_MAX_RATIO', 0.1))
 
 # Ensure the  path is valid and directories are created
 if not os.path.exists(CACHE_DIR):
     os.makedirs(CACHE_DIR)
 
-if(LIFETIME == "CartaBlanca"):
-    logger.info("Cache lifetime set to Carta Blanca")
+cacheIndex = CacheIndex(CACHE_DIR, writer=WORKER_ID)
+
+# also with DEDUPLICATE off, entries stored while it was on keep their blobs
+blobStore = BlobStore(CACHE_DIR)
+
+fillLocks = KeyLocks(os.path.join(CACHE_DIR, "fill.locks")) if WORKER_ID is not None else None
+
+accessLog = AccessLog(ACCESS_LOG_PATH) if ACCESS_LOG_PATH else None
+
+upstreamGuard = UpstreamGuard(
+    failure_threshold=BREAKER_FAILURES,
+    open_seconds=BREAKER_OPEN_SECONDS,
+    headers_timeout=HEADERS_TIMEOUT,
+    hedge_percentile=HEDGE_PERCENTILE,
+    hedge_min_delay=HEDGE_MIN_DELAY,
+    hedge_max_ratio=HEDGE_MAX_RATIO,
+)
+
+keyBuilder = KeyBuilder(ignored_params=KEY_IGNORE_PARAMS, sort_query=KEY_SORT_QUERY, key_headers=KEY_HEADERS, memo_size=KEY_MEMO_SIZE)
+
+upstreamPool = UpstreamPool(
+    limit=UPSTREAM_LIMIT,
+    limit_per_host=UPSTREAM_LIMIT_PER_HOST,
+    keepalive_timeout=KEEPALIVE_TIMEOUT,
+    dns_cache_ttl=DNS_CACHE_TTL,
+    connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=TIMEOUT,
+)
+
+async def upstream_pool_ctx(app):
+    await upstreamPool.Open()
+    yield
+    await upstreamPool.Close()
+
+@dataclasses.dataclass
+class CacheBudget:
+    max_bytes: int
+    max_entries: int
+    policy: object
+    used_bytes: int = 0
+    evictions: int = 0
+    evicted_bytes: int = 0
+    # set by the evictor's startup hook on the serving loop, on 3.9 an event binds the loop current when it is made
+    over_budget: asyncio.Event | None = None
+
+    def Add(self, entry: GetCallResult):
+        # a deduplicated body takes disk space once, whatever number of entries link to it
+        if entry.blob is None or blobStore.Ref(entry.blob):
+            self.used_bytes += entry.size
+        self.policy.Add(entry.cacheKey, entry.number_of_requests)
+        if self.over_budget is not None and self.IsOverBudget():
+            self.over_budget.set()
+
+    def Remove(self, entry: GetCallResult):
+        if entry.blob is None or blobStore.Unref(entry.blob):
+            self.used_bytes -= entry.size
+        self.policy.Remove(entry.cacheKey)
+
+    def IsOverBudget(self) -> bool:
+        return (self.max_bytes > 0 and self.used_bytes > self.max_bytes) or (self.max_entries > 0 and len(self.policy) > self.max_entries)
+
+    def Stats(self):
+        return {
+            "policy": EVICTION_POLICY,
+            "entries": len(self.policy),
+            "max_entries": self.max_entries,
+            "used_bytes": self.used_bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+cacheBudget = CacheBudget(max_bytes=MAX_CACHE_BYTES, max_entries=MAX_CACHE_ENTRIES, policy=make_policy(EVICTION_POLICY))
+
+hotTier = HotTier(max_bytes=HOT_TIER_BYTES, max_object_size=HOT_TIER_MAX_OBJECT, promote_after=HOT_TIER_PROMOTE_HITS)
+
+# outcomes answered from disk or memory without waiting on upstream
+CACHE_OUTCOMES = ("HIT", "STALE", "REVALIDATED", "STALE_IF_ERROR")
+
+metrics = MetricsRegistry()
+requestsTotal = metrics.Counter("ffproxy_requests_total", "Requests served, by cache outcome and status class.", ("outcome", "code"))
+requestLatency = metrics.Histogram("ffproxy_request_duration_seconds", "Time until the response was fully sent, by cache outcome.", ("outcome",))
+responseBytes = metrics.Counter("ffproxy_response_bytes_total", "Body bytes sent to clients, from the cache or streamed from upstream.", ("source",))
+upstreamBytes = metrics.Counter("ffproxy_upstream_fill_bytes_total", "Decoded body bytes read from upstream into the cache.")
+errorsTotal = metrics.Counter("ffproxy_errors_total", "Failed requests and broken off streams, by exception class.", ("class", "code"))
+evictionsTotal = metrics.Counter("ffproxy_cache_evictions_total", "Entries evicted to stay within the cache budget.")
+metrics.Gauge("ffproxy_cache_entries", "Entries in the disk cache.", lambda: len(storedData))
+metrics.Gauge("ffproxy_cache_bytes", "Bytes of the disk cache, as counted when entries were written.", lambda: cacheBudget.used_bytes)
+metrics.Gauge("ffproxy_dedup_saved_bytes", "Bytes not written because an identical body was stored already.", lambda: blobStore.saved_bytes)
+metrics.Gauge("ffproxy_hot_tier_bytes", "Bytes held by the in-memory tier.", lambda: hotTier.used_bytes)
+metrics.Gauge("ffproxy_fills_in_flight", "Upstream fills currently running.", lambda: len(concurrentCalls))
+metrics.Gauge("ffproxy_partial_objects", "Objects cached block by block from range requests.", lambda: len(partialData))
+metrics.Gauge("ffproxy_upstream_connections_in_use", "Pooled upstream connections in use.", lambda: upstreamPool.Stats()["in_use"])
+metrics.Gauge("ffproxy_upstream_connections_idle", "Pooled upstream connections idle.", lambda: upstreamPool.Stats()["idle"])
+metrics.Gauge("ffproxy_key_memo_hits", "Cache keys found in the memo of recent url to key computations.", lambda: keyBuilder.Stats()["memo_hits"])
+metrics.Gauge("ffproxy_key_memo_misses", "Cache keys computed because the memo didn't hold them.", lambda: keyBuilder.Stats()["memo_misses"])
+metrics.Gauge("ffproxy_upstream_circuits_open", "Upstream hosts whose circuit is open or half open.", upstreamGuard.OpenCircuits)
+metrics.Gauge("ffproxy_upstream_hedges", "Cache fills sent upstream a second time because the first was slow.", lambda: sum(health.hedges for health in upstreamGuard.hosts.values()))
+metrics.Gauge("ffproxy_upstream_hedges_won", "Hedged fills the second request answered first.", lambda: sum(health.hedges_won for health in upstreamGuard.hosts.values()))
+metrics.Gauge("ffproxy_access_log_dropped", "Access log records dropped because the writer fell behind.", lambda: accessLog.dropped if accessLog is not None else 0)
+
+def store_entry(stored: GetCallResult):
+    """
+    Registers a freshly written cache file with storedData, the cache index and the eviction budget.
+    """
+    previous = storedData.get(stored.cacheKey)
+    if previous is not None:
+        cacheBudget.Remove(previous)
+        if previous.blob is not None:
+            # the new file replaced the previous link, its blob may have lost its last entry
+            collect = asyncio.create_task(asyncio.to_thread(blobStore.Collect, previous.blob))
+            backgroundTasks.add(collect)
+            collect.add_done_callback(backgroundTasks.discard)
+
+    storedData[stored.cacheKey] = stored
+    hotTier.Remove(stored.cacheKey)
+    cacheIndex.Put(stored.ToRecord(), new=previous is None)
+    cacheBudget.Add(stored)
+
+def drop_entry(cache_key: str) -> GetCallResult | None:
+    """
+    Forgets a cache entry, the caller is responsible for removing its file.
+    """
+    entry = storedData.pop(cache_key, None)
+    if entry is not None:
+        hotTier.Remove(cache_key)
+        cacheIndex.Delete(cache_key)
+        cacheBudget.Remove(entry)
+    return entry
+
+async def evict_over_budget():
+    """
+    Background eviction, woken whenever an insert pushes the cache over its byte or entry budget.
+    """
+    while True:
+        await cacheBudget.over_budget.wait()
+        cacheBudget.over_budget.clear()
+
+        while cacheBudget.IsOverBudget():
+            victim = cacheBudget.policy.Victim()
+            if victim is None:
+                break
+
+            entry = drop_entry(victim)
+            if entry is None:
+                cacheBudget.policy.Remove(victim)
+                continue
+
+            cacheBudget.evictions += 1
+            cacheBudget.evicted_bytes += entry.size
+            evictionsTotal.Inc()
+            logger.info(f"Evicting {entry.uri} ({entry.size} bytes) from cache")
+
+            try:
+                await remove_entry_file(entry)
+            except OSError as e:
+                logger.error(f"Failed to remove evicted file {entry.cachePath}: {e}")
+
+async def eviction_ctx(app):
+    if not PRIMARY:
+        # the other workers learn about evictions from the shared journal
+        yield
+        return
+
+    cacheBudget.over_budget = asyncio.Event()
+    if cacheBudget.IsOverBudget():
+        # the restored index may not fit a budget lowered since the last run
+        cacheBudget.over_budget.set()
+    evictor = asyncio.create_task(evict_over_budget())
+    yield
+
+    evictor.cancel()
+    try:
+        await evictor
+    except asyncio.CancelledError:
+        pass
+
+def prepare_cache_dir() -> bool:
+    """
+    Wipes CACHE_DIR when started clean, otherwise removes what interrupted downloads left behind.
+    With several workers the parent runs this once before starting them, a worker would remove the partial files of the others.
+    Returns:
+        bool: Whether the directory was wiped.
+    """
+    if STARTUP_MODE == "clean":
+        logger.info("Startup mode clean, wiping cache directory")
+        for filename in os.listdir(CACHE_DIR):
+            file_path = os.path.join(CACHE_DIR, filename)
+            try:
+                if os.path.isfile(file_path) or os.path.islink(file_path):
+                    logger.info(f"Deleting: {file_path}")
+                    os.unlink(file_path)         
+            except Exception as e:
+                logger.error(f'Failed to delete {file_path}. Reason: {e}')
+        shutil.rmtree(os.path.join(CACHE_DIR, BLOB_DIR), ignore_errors=True)
+        return True
+
+    blobStore.CollectAll()
+
     for filename in os.listdir(CACHE_DIR):
-        file_path = os.path.join(CACHE_DIR, filename)
+        # partial objects aren't journaled, their sparse files are dropped with interrupted downloads
+        if filename.endswith((".part", ".sparse")):
+            logger.info(f"Removing interrupted download {filename}")
+            os.unlink(os.path.join(CACHE_DIR, filename))
+    return False
+
+def restore_cache_index():
+    """
+    Rebuilds storedData from the journal in CACHE_DIR, or wipes the directory when started clean.
+    """
+    if WORKER_ID is None and prepare_cache_dir():
+        return
+
+    # one directory listing instead of a stat per entry, drops records whose file was lost in a crash
+    present = set(os.listdir(CACHE_DIR))
+
+    for cache_key, record in cacheIndex.Load().items():
+        if record.get("file") not in present:
+            logger.warning(f"Dropping index record for {cache_key}: cached file is missing")
+            continue
         try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                logger.info(f"Deleting: {file_path}")
-                os.unlink(file_path)         
-        except Exception as e:
-            logger.error(f'Failed to delete {file_path}. Reason: {e}')
+            storedData[cache_key] = GetCallResult.FromRecord(record)
+        except KeyError as e:
+            logger.warning(f"Dropping incomplete index record for {cache_key}: missing {e}")
+
+    # replay in access order so recency based policies start out with the right ordering
+    for entry in sorted(storedData.values(), key=lambda entry: entry.last_accessed_time):
+        cacheBudget.Add(entry)
 
-# else loadfromdisk
+    logger.info(f"Restored {len(storedData)} entries from {cacheIndex.path}")
 
-def generate_key(url, method) -> str:
-    #need to ensure that the key here is a valid filename   
-    # Create a hash of the URL, method, and body to ensure the key is a valid filename
-    key_string = f"{url}_{method}"
-    return hashlib.md5(key_string.encode()).hexdigest()
+def apply_index_op(op: str, cache_key: str, record: dict):
+    """
+    Applies a journal record written by another worker to this worker's view of the cache.
+    """
+    entry = storedData.get(cache_key)
+    if op == "put":
+        try:
+            stored = GetCallResult.FromRecord(record)
+        except KeyError:
+            return
+        # a put this worker made after the other's already is the newer one
+        if entry is not None and entry.created_time > stored.created_time:
+            return
+        if entry is not None:
+            cacheBudget.Remove(entry)
+        storedData[cache_key] = stored
+        hotTier.Remove(cache_key)
+        cacheBudget.Add(stored)
+    elif op == "hit" and entry is not None:
+        entry.number_of_requests = max(entry.number_of_requests, record.get("number_of_requests", 0))
+        entry.last_accessed_time = max(entry.last_accessed_time, record.get("last_accessed_time", 0))
+        cacheBudget.policy.Touch(cache_key)
+    elif op == "del" and entry is not None:
+        storedData.pop(cache_key)
+        hotTier.Remove(cache_key)
+        cacheBudget.Remove(entry)
+
+async def sync_cache_index():
+    """
+    Catches up with the records the other workers appended to the shared journal.
+    """
+    replaced, ops = await asyncio.to_thread(cacheIndex.Tail)
+    if replaced:
+        # a compacted journal is a full snapshot, entries missing from it were deleted meanwhile
+        live = {cache_key for op, cache_key, _ in ops if op == "put"}
+        unflushed = {record["key"] for record in cacheIndex.pending}
+        for cache_key in [key for key in storedData if key not in live and key not in unflushed]:
+            apply_index_op("del", cache_key, {})
+    for op, cache_key, record in ops:
+        apply_index_op(op, cache_key, record)
+
+async def compact_cache_index():
+    if WORKER_ID is None:
+        await cacheIndex.Compact([entry.ToRecord() for entry in storedData.values()])
+        return
+
+    # every other worker's records have to be in storedData before they are rewritten into the snapshot
+    async with cacheIndex.Exclusive():
+        await sync_cache_index()
+        await cacheIndex.Compact([entry.ToRecord() for entry in storedData.values()])
+
+async def flush_cache_index():
+    """
+    Periodically writes buffered index records to the journal and compacts it when it has grown too large.
+    Workers sharing the journal also pick up each other's records here.
+    """
+    while True:
+        await asyncio.sleep(INDEX_FLUSH_INTERVAL)
+        try:
+            await cacheIndex.Flush()
+            if WORKER_ID is not None:
+                await sync_cache_index()
+            if cacheIndex.NeedsCompaction():
+                await compact_cache_index()
+        except OSError as e:
+            logger.error(f"Failed to write cache index: {e}")
+
+async def cache_index_ctx(app):
+    restore_cache_index()
+    if fillLocks is not None:
+        fillLocks.Open()
+    if PRIMARY:
+        # start from a compact snapshot so the journal only grows with this run's changes
+        await compact_cache_index()
+
+    flusher = asyncio.create_task(flush_cache_index())
+    yield
+
+    flusher.cancel()
+    try:
+        await flusher
+    except asyncio.CancelledError:
+        pass
+    await cacheIndex.Flush()
+    if fillLocks is not None:
+        fillLocks.Close()
+
+# connection scoped headers a proxy must not forward, RFC 9110 section 7.6.1
+HOP_BY_HOP_HEADERS = ("Connection", "Keep-Alive", "Proxy-Authenticate", "Proxy-Authorization", "Proxy-Connection", "TE", "Trailer", "Transfer-Encoding", "Upgrade")
+
+def strip_hop_by_hop(headers) -> CIMultiDict:
+    forwarded = CIMultiDict(headers)
+    # headers named in Connection are hop-by-hop as well
+    for name in headers.get("Connection", "").split(','):
+        if name.strip():
+            forwarded.popall(name.strip(), None)
+    for name in HOP_BY_HOP_HEADERS:
+        forwarded.popall(name, None)
+    return forwarded
+
+def generate_key(url, method, headers=None) -> str:
+    #need to ensure that the key here is a valid filename, keys are hex digests of the normalized url (see KeyBuilder)
+    # Accept-Encoding is left out on purpose, one copy is stored per url and negotiated per client when served,
+    # so Vary: Accept-Encoding neither splits the key nor counts as a Vary mismatch (see NEGOTIATED_HEADERS)
+    return keyBuilder.Key(url, method, headers)
 
 async def save_payload_to_cache(request : web.Request) -> web.Response:
     """
@@ -118,14 +690,13 @@ async def save_payload_to_cache(request : web.Request) -> web.Response:
     Raises:
         ValueError: If the URL returned in the response body is invalid.
     Notes:
-        - The request body is temporarily stored in a file before being forwarded.
+        - The request body is streamed once, every chunk is written to a temporary file in CACHE_DIR as it is sent upstream.
         - The response body is expected to contain a URL, which is used to generate a cache key.
-        - The cache key is used to store the payload in a cache directory.
+        - The temporary file is renamed into place under that key, or removed when the upload fails or there is no URL.
         - Additional headers are added to the response to indicate whether the payload was cached.
     Dependencies:
         - aiofiles
         - aiohttp
-        - tempfile
         - os
         - urllib.parse.urlparse
         - logging
@@ -133,47 +704,134 @@ async def save_payload_to_cache(request : web.Request) -> web.Response:
     
     url = request.url
 
-    # Create a temporary file and write the request body to it
-    with tempfile.NamedTemporaryFile(delete=False, delete_on_close=True) as temp_file : 
-    
-        logger.info(f"Storing copy of payload: {temp_file.name}")
-        async with aiofiles.open(temp_file.name, 'wb') as temp_file:
-            await temp_file.write(await request.read())
-    
+    # lives in CACHE_DIR so the final rename never crosses filesystems, .part files are swept on startup
+    temp_path = f"{CACHE_DIR}/{uuid.uuid4().hex}.upload.part"
+    payload = {"size": 0, "complete": False}
+    hasher = blobStore.Hasher() if DEDUPLICATE else None
+    temp_file = None
+
+    async def tee_payload():
+        logger.info(f"Storing copy of payload: {temp_path}")
+        async for chunk in request.content.iter_chunked(CHUNK_SIZE):
+            if hasher is not None:
+                hasher.update(chunk)
+            payload["size"] += await temp_file.write(chunk)
+            # upstream may answer before the generator is resumed past its last chunk,
+            # the copy is complete once the client's body was read to the end and written
+            payload["complete"] = request.content.at_eof()
+            yield chunk
+
+    try:
         # make the call
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, body=request.body, headers=request.headers) as response:
-                response.raise_for_status()
+        data = None
+        if request.body_exists:
+            temp_file = await aiofiles.open(temp_path, 'wb')
+            data = tee_payload()
+        async with upstreamGuard.Request(upstreamPool.session, "POST", url, data=data, headers=strip_hop_by_hop(request.headers)) as response:
+            response.raise_for_status()
 
-                body = await response.read()
+            body = await response.read()
 
-                if body is not None:               
-                    try:
-                        result_url = str(body, 'utf-8')
-                        parsed_url = urlparse(result_url)
-                        if not all([parsed_url.scheme, parsed_url.netloc]):
-                            raise ValueError("Invalid URL")
+        if temp_file is not None:
+            await temp_file.close()
+
+        # the body was decoded by the client, its encoding and length headers no longer apply
+        headers = strip_hop_by_hop(response.headers)
+        headers.popall("Content-Encoding", None)
+        headers.popall("Content-Length", None)
+
+        if body and payload["complete"]:               
+            try:
+                result_url = str(body, 'utf-8')
+                parsed_url = urlparse(result_url)
+                if not all([parsed_url.scheme, parsed_url.netloc]):
+                    raise ValueError("Invalid URL")
 
-                        cache_key = generate_key(parsed_url, "GET")
+                # the same key a GET of the url computes, so the stored payload answers it
+                cache_key = generate_key(result_url, "GET")
 
-                        cache_path = os.path.join(CACHE_DIR, cache_key)
-                        
-                        os.rename(temp_file.name, cache_path)
+                cache_path = os.path.join(CACHE_DIR, cache_key)
 
-                        storedData[cache_key] = GetCallResult(headers=response.headers, uri=url, cachePath=cache_path)
+                stored_headers = CIMultiDict()
+                if "Content-Type" in request.headers:
+                    stored_headers["Content-Type"] = request.headers["Content-Type"]
 
-                        combinedHeaders = {**response.headers, **{"X-FFPROXY-Cache": "MISS"}}
+                stored = GetCallResult(headers=stored_headers, uri=result_url, cachePath=cache_path, cacheKey=cache_key, size=payload["size"])
+                # re-uploads of the same payload end up as links to one blob
+                await move_into_cache(stored, temp_path, hasher)
+                stored.ApplyFreshness(compute_freshness(stored_headers, DEFAULT_TTL, STALE_WHILE_REVALIDATE, default_stale_if_error=STALE_IF_ERROR))
+                store_entry(stored)
 
-                        return web.Response(status=response.status, headers=combinedHeaders)    
+                headers["X-FFPROXY-Cache"] = "MISS"
 
-                    except Exception as e:
-                        logger.info("No valide returned URL for post request {url}")
-                
-                
-                logger.info(f"No result url returned from host. wont store payload")                  
-                return web.Response(status=response.status, body=body, headers= response.headers | {'X-FFPROXY-Cache': "No cached entry. Missing get endpoint"})
+                return web.Response(status=response.status, body=body, headers=headers)    
 
-async def main_dispatcher(request) -> aiohttp.ClientResponse:
+            except (ValueError, UnicodeDecodeError) as e:
+                logger.info(f"No valide returned URL for post request {url}: {e}")
+        
+        
+        logger.info(f"No result url returned from host. wont store payload")                  
+        headers["X-FFPROXY-Cache"] = "No cached entry. Missing get endpoint"
+        return web.Response(status=response.status, body=body, headers=headers)
+
+    finally:
+        if temp_file is not None and not temp_file.closed:
+            await temp_file.close()
+        # nothing left to remove once the payload has been renamed into the cache
+        await remove_cache_file(temp_path)
+
+def abort_response(request, message: str, error: BaseException):
+    """
+    Cuts the connection of a response whose headers are already out, so the client sees a truncated body.
+    Past prepare() the error handling middleware can't answer with an error status any more.
+    """
+    logger.error(f"{message}: {error}")
+    errorsTotal.Inc(type(error).__name__, "aborted")
+    if request.transport is not None:
+        request.transport.close()
+
+async def forward_streaming(request: web.Request) -> web.StreamResponse:
+    """
+    Passes a request through to upstream without caching, streaming both bodies.
+    Args:
+        request (web.Request): The incoming HTTP request.
+    Returns:
+        web.StreamResponse: The upstream response, already written to the client.
+    Notes:
+        - The request body is read from request.content as upstream consumes it and the response body is
+          written in CHUNK_SIZE pieces, each write waiting for the client to drain, so memory stays constant.
+        - Bodies are forwarded as is, upstream content encoding included, and redirects are handed back to the client.
+        - Hop-by-hop headers are dropped in both directions.
+        - Upstream breaking off the body after the headers were sent cuts the client's connection.
+    """
+    data = request.content if request.body_exists else None
+    proxied = None
+    sent = 0
+
+    try:
+        async with upstreamGuard.Request(upstreamPool.session, request.method, request.url, headers=strip_hop_by_hop(request.headers), data=data, allow_redirects=False, auto_decompress=False) as response:
+            headers = strip_hop_by_hop(response.headers)
+            headers.popall("Content-Length", None)
+            headers["X-FFPROXY-Cache"] = "PASS"
+
+            proxied = web.StreamResponse(status=response.status, reason=response.reason, headers=headers)
+            if response.content_length is not None:
+                proxied.content_length = response.content_length
+            await proxied.prepare(request)
+
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                await proxied.write(chunk)
+                sent += len(chunk)
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+        if proxied is None or not proxied.prepared:
+            raise
+        abort_response(request, f"Passing {request.method} {request.url} through broke off after {sent} bytes", e)
+        return proxied
+
+    await proxied.write_eof()
+    return proxied
+
+async def main_dispatcher(request) -> web.StreamResponse:
 
     url = request.url
     method = request.method
@@ -181,33 +839,43 @@ async def main_dispatcher(request) -> aiohttp.ClientResponse:
 
 
 
-    async with aiohttp.ClientSession() as session:
-
-        if request.method == "GET":
-            return await get_from_cache_or_source(request)
-        
-        elif request.method == "POST":
-            return await save_payload_to_cache(request)
-     
-
-        elif request.method == "DELETE":
-            async with session.delete(url, headers=request.headers) as response:
-                return response
+    if request.method == "GET":
+        return await get_from_cache_or_source(request)
+    
+    elif request.method == "POST":
+        return await save_payload_to_cache(request)
+ 
+    elif request.method in ("PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"):
+        return await forward_streaming(request)
 
-        elif request.method == "PATCH":
-            async with session.patch(url, data=request.body, headers=request.headers) as response:
-                return response
+    else:
+        raise web.HTTPMethodNotAllowed(request.method, ["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
 
-        elif request.method == "HEAD":
-            async with session.head(url, headers=request.headers) as response:            
-                return response
+def targets_upstream(request) -> bool:
+    """
+    Whether a request names another server than the proxy, whatever the router matched its path to.
+    Notes:
+        - aiohttp routes by path alone. Clients configured to use a proxy send absolute-form targets,
+          which are proxied whatever their path, /metrics and /cache/... included.
+        - With FFPROXY_API_HOSTS set, origin-form requests whose Host isn't one of them are proxied as well.
+    """
+    if request.message.url.is_absolute():
+        return True
+    if not API_HOSTS:
+        return False
+    host = request.host.lower()
+    return host not in API_HOSTS and host.rsplit(":", 1)[0] not in API_HOSTS
 
-        elif request.method == "OPTIONS":
-            async with session.options(url, headers=request.headers) as response:                   
-                return response
+def is_proxied(request) -> bool:
+    """Whether a request is traffic to pass on upstream rather than a call of the proxy's own api."""
+    return targets_upstream(request) or request.match_info.route.handler is main_dispatcher
 
-        else:
-            raise web.HTTPMethodNotAllowed(request.method, ["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD", "OPTIONS"])
+@web.middleware
+async def proxy_routing_middleware(request, handler):
+    # runs after routing, a request for another server the router matched to an api route goes upstream instead
+    if targets_upstream(request):
+        return await main_dispatcher(request)
+    return await handler(request)
 
 async def delete_entry(request) -> web.Response:
     """
@@ -218,80 +886,785 @@ async def delete_entry(request) -> web.Response:
         aiohttp.web.Response: The response indicating the success of the deletion.
     """
     cache_key = request.match_info['cacheKey']
-    # cache_key = generate_key(uri, "GET")
  
-    if cache_key in storedData:
-        os.remove(storedData[cache_key].cachePath)
-        del storedData[cache_key]
+    if await purge_keys([cache_key]):
         return web.Response(status=204)
     else:
         raise web.HTTPNotFound(reason="Entry not found in cache")
+
+async def delete_url(request) -> web.Response:
+    """
+    Deletes the cached GET response of the url in the `url` query parameter, the key is computed with generate_key.
+    """
+    url = request.query.get("url")
+    if not url:
+        raise web.HTTPBadRequest(reason="Pass the url to purge as ?url=")
  
+    if await purge_keys([generate_key(URL(url), "GET")]):
+        return web.Response(status=204)
+    else:
+        raise web.HTTPNotFound(reason="Entry not found in cache")
+
+def _remove_files(paths: list[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+async def purge_keys(keys: list[str]) -> int:
+    """
+    Drops the entries of keys, removing their files with one thread hop for the whole batch.
+    Returns:
+        int: How many of the keys were cached.
+    """
+    entries = [entry for entry in map(drop_entry, keys) if entry is not None]
+    if entries:
+        await asyncio.to_thread(_remove_files, [entry.cachePath for entry in entries])
+        for blob in {entry.blob for entry in entries if entry.blob is not None}:
+            await asyncio.to_thread(blobStore.Collect, blob)
+    return len(entries)
+ 
+def upstream_request_headers(headers) -> CIMultiDict:
+    forwarded = strip_hop_by_hop(headers)
+    for name in CLIENT_CONDITIONAL_HEADERS:
+        forwarded.popall(name, None)
+    # the client session asks for the encodings it can decode, bodies are stored decoded
+    forwarded.popall("Accept-Encoding", None)
+    return forwarded
+
+async def fill_from_upstream(call: ConcurrentCall, url, request_headers, found: GetCallResult | None = None) -> tuple[GetCallResult, str]:
+    """
+    Fetches url from upstream into the cache, revalidating `found` with its validators when given.
+    Args:
+        call (ConcurrentCall): The shared fill, told when upstream answers and about every chunk written.
+        url: The upstream url.
+        request_headers: The headers of the client request that triggered the fill.
+        found (GetCallResult): The stale entry being revalidated, if any.
+    Returns:
+        tuple[GetCallResult, str]: The entry and the outcome, REVALIDATED when upstream answered 304,
+        MISS when a new body was stored and UNCACHEABLE when the body was only written to the
+        partial file for the leading request to serve and remove.
+    """
+    cache_key = call.cacheKey
+    headers = upstream_request_headers(request_headers)
+    if found is not None:
+        headers.update(conditional_headers(found.headers))
+
+    async with upstreamGuard.Get(upstreamPool.session, url, headers=headers) as response:
+        if response.status == 304 and found is not None:
+            logger.info(f"{cache_key} : {url} revalidated by upstream")
+            found.Revalidated(response.headers)
+            return found, "REVALIDATED"
+
+        response.raise_for_status()
+
+        freshness = compute_freshness(response.headers, DEFAULT_TTL, STALE_WHILE_REVALIDATE, default_stale_if_error=STALE_IF_ERROR)
+        outcome = "MISS" if freshness.storable else "UNCACHEABLE"
+        vary = vary_snapshot(response.headers, request_headers)
+        stored_headers = strip_hop_by_hop(response.headers)
+        # the client session decoded the body, upstream's encoding and length don't describe it
+        stored_headers.popall("Content-Encoding", None)
+        stored_headers.popall("Content-Length", None)
+
+        encoding = COMPRESSION if COMPRESSION is not None and is_compressible(stored_headers) else None
+        compressor = None
+        if encoding is not None:
+            compressor = make_compressor(encoding, COMPRESSION_LEVEL)
+            stored_headers["Content-Encoding"] = encoding
+            if "accept-encoding" not in stored_headers.get("Vary", "").lower():
+                stored_headers["Vary"] = ", ".join(filter(None, [stored_headers.get("Vary"), "Accept-Encoding"]))
+
+        logger.info(f"{cache_key} : {url} has been fetched from upstream storing to disk")
+
+        # written next to the live file and renamed over it, so readers of a stale copy are never cut short
+        temp_path = f"{CACHE_DIR}/{cache_key}.{uuid.uuid4().hex}.part"
+        # the body is decoded by the client, a Content-Length of an encoded body doesn't describe it
+        expected_size = response.content_length if "Content-Encoding" not in response.headers and compressor is None else None
+
+        # hashed as written, so a body that is stored already is found without reading it again
+        hasher = blobStore.Hasher() if DEDUPLICATE and outcome == "MISS" else None
+
+        #minizing memfootprint by streaming the response to disk
+        size = 0
+        try:
+            # unbuffered so every byte counted in call.bytes_written is visible to followers
+            async with aiofiles.open(temp_path, 'wb', buffering=0) as f:
+                call.Started(outcome, headers=stored_headers, partPath=temp_path, expected_size=expected_size, vary=vary)
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    upstreamBytes.Inc(amount=len(chunk))
+                    if compressor is not None:
+                        chunk = compressor.compress(chunk)
+                        if not chunk:
+                            continue
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    written = await f.write(chunk)
+                    size += written
+                    call.Wrote(written)
+                if compressor is not None:
+                    tail = compressor.flush()
+                    if hasher is not None:
+                        hasher.update(tail)
+                    written = await f.write(tail)
+                    size += written
+                    call.Wrote(written)
+        except BaseException:
+            if outcome == "MISS":
+                await remove_cache_file(temp_path)
+            raise
+
+    previous = found or storedData.get(cache_key)
+    number_of_requests = call.number_of_requests + (previous.number_of_requests if previous is not None else 0)
+    stored = GetCallResult(headers=stored_headers, uri=url, cachePath=temp_path, cacheKey=cache_key, size=size, number_of_requests=max(number_of_requests, 1), vary=vary, encoding=encoding)
+    stored.ApplyFreshness(freshness)
+
+    if outcome == "UNCACHEABLE":
+        logger.info(f"{url} is not cacheable, serving it once")
+        previous = drop_entry(cache_key)
+        if previous is not None:
+            await remove_entry_file(previous)
+        return stored, outcome
+
+    stored.cachePath = f"{CACHE_DIR}/{cache_key}"
+    await move_into_cache(stored, temp_path, hasher)
+    store_entry(stored)
+    await discard_partial(cache_key)
+    return stored, outcome
+
+async def fill_across_workers(call: ConcurrentCall, url, request_headers, found: GetCallResult | None = None) -> tuple[GetCallResult, str]:
+    """
+    Runs fill_from_upstream under the key's fill lock when worker processes share the cache, so only one
+    of them downloads a key. A worker that had to wait serves what the other one stored, as COALESCED.
+    Notes:
+        - The holder flushes the journal before letting go, the waiter tails it right after taking the lock.
+        - The waiting worker's clients get the body once the other worker's download is complete,
+          there is no streaming from another process' partial file.
+    """
+    if fillLocks is None:
+        return await fill_from_upstream(call, url, request_headers, found)
+
+    cache_key = call.cacheKey
+    call.locked_elsewhere = True
+    try:
+        await fillLocks.Acquire(cache_key)
+    finally:
+        call.locked_elsewhere = False
+
+    try:
+        await sync_cache_index()
+        shared = storedData.get(cache_key)
+        if shared is not None and shared is not found and shared.IsFresh() and shared.MatchesVary(request_headers):
+            logger.info(f"{cache_key} : {url} was fetched by another worker")
+            return shared, "COALESCED"
+
+        entry, outcome = await fill_from_upstream(call, url, request_headers, found)
+        await cacheIndex.Flush()
+        return entry, outcome
+    finally:
+        fillLocks.Release(cache_key)
+
+async def remove_cache_file(path):
+    try:
+        await asyncio.to_thread(os.remove, path)
+    except FileNotFoundError:
+        pass
+
+async def remove_entry_file(entry: GetCallResult):
+    """
+    Removes the file of a dropped entry, and its blob once no other entry links to it.
+    """
+    await remove_cache_file(entry.cachePath)
+    if entry.blob is not None:
+        await asyncio.to_thread(blobStore.Collect, entry.blob)
+
+async def move_into_cache(stored: GetCallResult, temp_path: str, hasher=None):
+    """
+    Renames a completely written body to stored.cachePath, through the blob store when it was hashed.
+    """
+    if hasher is None:
+        await asyncio.to_thread(os.replace, temp_path, stored.cachePath)
+        return
+
+    stored.blob = blobStore.Digest(hasher)
+    if await asyncio.to_thread(blobStore.Link, temp_path, stored.cachePath, stored.blob):
+        blobStore.deduplicated += 1
+        blobStore.saved_bytes += stored.size
+        logger.info(f"{stored.uri} has the same body as a cached entry, stored once as {stored.blob}")
+
+async def serve_from_cache(request, entry: GetCallResult, outcome: str) -> web.StreamResponse:
+    if entry.encoding is not None and not accepts_encoding(request.headers.get("Accept-Encoding"), entry.encoding):
+        return await serve_decoded(request, entry, outcome)
+
+    if outcome == "HIT" and hotTier.max_bytes > 0 and "Range" not in request.headers:
+        hot = hotTier.Get(entry.cacheKey)
+        if hot is None and hotTier.ShouldPromote(entry.cacheKey, entry.size, entry.number_of_requests):
+            hot = await hotTier.Promote(entry.cacheKey, entry.cachePath, entry.headers)
+        if hot is not None:
+            return hotTier.Respond(request, hot)
+
+    headers = CIMultiDict(entry.headers)
+    headers["X-FFPROXY-Cache"] = outcome
+    return web.FileResponse(entry.cachePath, headers=headers)
+
+async def serve_decoded(request, entry: GetCallResult, outcome: str) -> web.StreamResponse:
+    """
+    Streams a compressed cache entry to a client that doesn't accept its encoding, decoding it on the fly.
+    Ranges are ignored, the decoded length isn't known up front.
+    """
+    headers = CIMultiDict(entry.headers)
+    headers["X-FFPROXY-Cache"] = outcome
+    for name in ("Content-Encoding", "Content-Length"):
+        headers.popall(name, None)
+
+    response = web.StreamResponse(status=200, headers=headers)
+    await response.prepare(request)
+
+    decompressor = make_decompressor(entry.encoding)
+    try:
+        async with aiofiles.open(entry.cachePath, 'rb') as f:
+            while chunk := await f.read(CHUNK_SIZE):
+                decoded = decompressor.decompress(chunk)
+                if decoded:
+                    await response.write(decoded)
+        tail = decompressor.flush()
+        if tail:
+            await response.write(tail)
+    except Exception as e:
+        # a file removed or corrupted underneath, or a client gone, the headers are out either way
+        abort_response(request, f"Decoding {entry.cachePath} for {entry.uri} broke off", e)
+        return response
+
+    await response.write_eof()
+    return response
+
+backgroundTasks: set[asyncio.Task] = set()
+
+async def run_fill(call: ConcurrentCall, url, request_headers, found: GetCallResult | None, leader: bool):
+    try:
+        entry, outcome = await fill_across_workers(call, url, request_headers, found)
+        call.Finished(entry, outcome)
+        if outcome == "UNCACHEABLE" and not leader:
+            # a background refresh has no request to hand the one-off body to
+            await remove_cache_file(entry.cachePath)
+    except asyncio.CancelledError:
+        call.Failed(aiohttp.ClientConnectionError(f"Upstream fill for {url} was cancelled"))
+        raise
+    except Exception as e:
+        logger.warning(f"Upstream fill of {url} failed: {e}")
+        call.Failed(e)
+    finally:
+        if concurrentCalls.get(call.cacheKey) is call:
+            del concurrentCalls[call.cacheKey]
+
+def start_fill(cache_key, url, request_headers, found: GetCallResult | None = None, leader: bool = True, shared: bool = True) -> ConcurrentCall:
+    """
+    Starts an upstream fill in its own task, registered in concurrentCalls when `shared` so later
+    requests for the same key join it instead of going upstream themselves.
+    """
+    call = ConcurrentCall(uri=url, cacheKey=cache_key, number_of_requests=1 if leader else 0)
+    call.task = asyncio.create_task(run_fill(call, url, CIMultiDict(request_headers), found, leader))
+    backgroundTasks.add(call.task)
+    call.task.add_done_callback(backgroundTasks.discard)
+
+    if shared:
+        concurrentCalls[cache_key] = call
+    return call
+
+def schedule_revalidation(found: GetCallResult, request_headers):
+    """
+    Starts at most one background refresh per key while clients are served the stale copy.
+    """
+    if found.cacheKey not in concurrentCalls:
+        start_fill(found.cacheKey, found.uri, request_headers, found, leader=False)
+
+async def warm_url(url, refresh_before: float = 0) -> str:
+    """
+    Pulls url into the cache through the same single-flight fill client misses take.
+    Args:
+        url: Absolute http(s) url.
+        refresh_before (float): Also refresh entries that are fresh but expire within this many seconds.
+    Returns:
+        str: The cache outcome, HIT when the entry was fresh already.
+    Raises:
+        ValueError: If url isn't an absolute http(s) url.
+    Notes:
+        - Warming isn't a client request, it doesn't count as a hit and an uncacheable body is thrown away.
+        - A stale or expiring entry is revalidated with its validators rather than fetched again.
+    """
+    url = URL(str(url))
+    if not url.absolute or url.scheme not in ("http", "https"):
+        raise ValueError(f"Not an absolute http(s) url: {url}")
+
+    cache_key = generate_key(url, "GET")
+    entry = storedData.get(cache_key)
+    if entry is not None and entry.expires_at - time.time() > refresh_before:
+        return "HIT"
+
+    call = concurrentCalls.get(cache_key)
+    if call is None:
+        call = start_fill(cache_key, url, CIMultiDict(), found=entry, leader=False)
+    _, outcome = await asyncio.shield(call.finished)
+    return outcome
+
+warmJobs: dict[str, WarmJob] = {}
+# finished jobs kept around for their progress reports
+MAX_WARM_JOBS = 32
+
+def start_warm_job(job: WarmJob) -> WarmJob:
+    job.task = asyncio.create_task(job.Run(warm_url))
+    backgroundTasks.add(job.task)
+    job.task.add_done_callback(backgroundTasks.discard)
+
+    warmJobs[job.id] = job
+    for old in [old for old in warmJobs.values() if old.task.done()][:max(len(warmJobs) - MAX_WARM_JOBS, 0)]:
+        del warmJobs[old.id]
+    return job
+
+async def refresh_top_entries():
+    """
+    Refreshes the REFRESH_TOP_N most requested entries that expire within REFRESH_AHEAD seconds,
+    so the urls clients hit most never turn stale in front of them.
+    """
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+
+        now = time.time()
+        top = heapq.nlargest(REFRESH_TOP_N, storedData.values(), key=lambda entry: entry.number_of_requests)
+        expiring = [str(entry.uri) for entry in top if entry.expires_at - now < REFRESH_AHEAD and entry.cacheKey not in concurrentCalls]
+        if not expiring:
+            continue
+
+        logger.info(f"Refreshing {len(expiring)} of the {REFRESH_TOP_N} most requested entries before they expire")
+        job = start_warm_job(WarmJob(urls=expiring, concurrency=WARM_CONCURRENCY, rate=WARM_RATE, refresh_before=REFRESH_AHEAD, name="refresh"))
+        await asyncio.shield(job.task)
+
+async def refresh_ctx(app):
+    if REFRESH_TOP_N <= 0 or not PRIMARY:
+        yield
+        return
+
+    refresher = asyncio.create_task(refresh_top_entries())
+    yield
+
+    refresher.cancel()
+    try:
+        await refresher
+    except asyncio.CancelledError:
+        pass
+
+async def serve_in_flight(request, call: ConcurrentCall, leader: bool) -> web.StreamResponse:
+    """
+    Serves a request from a running fill, streaming the body from the partial file while it is downloaded.
+    Args:
+        request (web.Request): The client request.
+        call (ConcurrentCall): The fill to serve from.
+        leader (bool): Whether this request started the fill, only the leader may receive an uncacheable body.
+    Returns:
+        web.StreamResponse: The response, already written when streamed.
+    """
+    while True:
+        try:
+            outcome = await asyncio.wait_for(asyncio.shield(call.started), FILL_STALL_TIMEOUT)
+            break
+        except asyncio.TimeoutError:
+            # another worker downloading the key isn't a stall of this fill
+            if not call.locked_elsewhere:
+                raise
+
+    if outcome in ("REVALIDATED", "COALESCED"):
+        entry, _ = call.finished.result()
+        entry.CacheHit()
+        return await serve_from_cache(request, entry, outcome)
+
+    if not leader and (outcome == "UNCACHEABLE" or vary_snapshot(call.headers, request.headers) != call.vary):
+        # the shared response is private to the request that caused it, get our own copy
+        own = start_fill(call.cacheKey, request.url, request.headers, shared=False)
+        return await serve_in_flight(request, own, leader=True)
+
+    label = outcome if leader else "COALESCED"
+
+    if outcome == "MISS" and call.finished.done():
+        entry, _ = call.finished.result()
+        return await serve_from_cache(request, entry, label)
+
+    try:
+        part = await aiofiles.open(call.partPath, 'rb')
+    except FileNotFoundError:
+        # the fill completed and renamed the partial file in the meantime
+        entry, _ = await asyncio.wait_for(asyncio.shield(call.finished), FILL_STALL_TIMEOUT)
+        return await serve_from_cache(request, entry, label)
+
+    try:
+        if outcome == "UNCACHEABLE":
+            await remove_cache_file(call.partPath)
+        return await stream_partial(request, call, part, label)
+    finally:
+        await part.close()
+
+async def serve_in_flight_or_stale(request, call: ConcurrentCall, leader: bool, found: GetCallResult | None) -> web.StreamResponse:
+    """
+    Serves a request from a running fill like serve_in_flight, falling back to the expired copy `found`
+    when upstream fails before answering and the copy is still within its stale-if-error window.
+    """
+    try:
+        return await serve_in_flight(request, call, leader)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # once upstream has answered the response may be on its way, it can't be swapped for another
+        answered = call.started.done() and call.started.exception() is None
+        # a 404 or 410 says the copy is gone, only server errors are stood in for
+        client_error = isinstance(e, aiohttp.ClientResponseError) and e.status < 500
+        if found is None or answered or client_error or not found.CanServeIfError():
+            raise
+        logger.warning(f"Upstream failed for {found.uri}, serving the copy that expired {time.time() - found.expires_at:.0f}s ago: {type(e).__name__}: {e}")
+        found.CacheHit()
+        return await serve_from_cache(request, found, "STALE_IF_ERROR")
+
+async def stream_partial(request, call: ConcurrentCall, part, label: str) -> web.StreamResponse:
+    headers = CIMultiDict(call.headers)
+    headers["X-FFPROXY-Cache"] = label
+    for name in ("Content-Length", "Transfer-Encoding"):
+        headers.popall(name, None)
+
+    # the partial file holds the body as stored, decode it for clients that don't accept its encoding
+    decompressor = None
+    encoding = headers.get("Content-Encoding")
+    if encoding is not None and not accepts_encoding(request.headers.get("Accept-Encoding"), encoding):
+        decompressor = make_decompressor(encoding)
+        headers.popall("Content-Encoding")
+
+    start, stop = 0, call.expected_size
+    byte_range = requested_range(request, call.expected_size) if call.expected_size is not None else None
+    if byte_range is not None:
+        start, stop = byte_range
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{call.expected_size}"
+
+    response = web.StreamResponse(status=206 if byte_range is not None else 200, headers=headers)
+    if stop is not None:
+        response.content_length = stop - start
+    await response.prepare(request)
+
+    offset = start
+    await part.seek(start)
+    try:
+        while stop is None or offset < stop:
+            available = call.bytes_written if stop is None else min(call.bytes_written, stop)
+            if offset < available:
+                chunk = await part.read(min(available - offset, CHUNK_SIZE))
+                if chunk:
+                    offset += len(chunk)
+                    if decompressor is not None:
+                        chunk = decompressor.decompress(chunk)
+                    if chunk:
+                        await response.write(chunk)
+                    continue
+
+            if call.finished.done():
+                # raises the upstream error if the fill broke off
+                call.finished.result()
+                if offset >= call.bytes_written:
+                    break
+                continue
+
+            await call.WaitForProgress(offset, FILL_STALL_TIMEOUT)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        abort_response(request, f"Upstream fill of {call.uri} broke off after {offset} bytes", e)
+        return response
+
+    if decompressor is not None:
+        tail = decompressor.flush()
+        if tail:
+            await response.write(tail)
+    await response.write_eof()
+    return response
+
+partialData: dict[str, PartialObject] = {}
+
+class PartialObjectChanged(aiohttp.ClientError):
+    pass
+
+async def discard_partial(cache_key, partial: PartialObject | None = None):
+    """
+    Forgets the partial object for cache_key, only if it is still `partial` when one is given.
+    """
+    current = partialData.get(cache_key)
+    if current is None or (partial is not None and current is not partial):
+        return
+    del partialData[cache_key]
+    await remove_cache_file(current.path)
+
+def _create_sparse_file(path: str, size: int):
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+def range_request_headers(request_headers, byte_range: str, partial: PartialObject | None = None) -> CIMultiDict:
+    headers = upstream_request_headers(request_headers)
+    headers["Range"] = byte_range
+    # byte offsets only line up with an identity encoded body
+    headers["Accept-Encoding"] = "identity"
+    if partial is not None and partial.validator is not None:
+        headers["If-Range"] = partial.validator
+    return headers
+
+async def open_partial(request, cache_key, url):
+    """
+    Sends the first Range request for a cold key and sets up its partial object from the 206 answer.
+    Returns:
+        The partial object, the open upstream response, the offset its body starts at and the claimed blocks,
+        or None when upstream answered without a usable range, the caller then falls back to a full fill.
+    """
+    byte_range = upstream_range(request, RANGE_BLOCK_SIZE)
+    if byte_range is None:
+        return None
+
+    upstream = await upstreamGuard.Send(upstreamPool.session, "GET", url, headers=range_request_headers(request.headers, byte_range), auto_decompress=False)
+    try:
+        content_range = parse_content_range(upstream.headers.get("Content-Range"))
+        freshness = compute_freshness(upstream.headers, DEFAULT_TTL, STALE_WHILE_REVALIDATE, default_stale_if_error=STALE_IF_ERROR)
+        if upstream.status != 206 or content_range is None or not freshness.storable or "Vary" in upstream.headers or "Content-Encoding" in upstream.headers:
+            upstream.release()
+            return None
+
+        first_byte, last_byte, total_size = content_range
+
+        etag = upstream.headers.get("ETag")
+        # weak validators can't be used with If-Range
+        validator = etag if etag is not None and not etag.startswith("W/") else upstream.headers.get("Last-Modified")
+
+        partial = partialData.get(cache_key)
+        if partial is None or partial.IsExpired() or partial.total_size != total_size or partial.validator != validator:
+            stored_headers = strip_hop_by_hop(upstream.headers)
+            stored_headers.popall("Content-Range", None)
+            stored_headers.popall("Content-Length", None)
+
+            partial = PartialObject(
+                uri=url,
+                cacheKey=cache_key,
+                path=f"{CACHE_DIR}/{cache_key}.{uuid.uuid4().hex}.sparse",
+                total_size=total_size,
+                block_size=RANGE_BLOCK_SIZE,
+                headers=stored_headers,
+                validator=validator,
+                expires_at=freshness.expires_at,
+                stale_while_revalidate=freshness.stale_while_revalidate,
+                stale_if_error=freshness.stale_if_error,
+            )
+            await asyncio.to_thread(_create_sparse_file, partial.path, total_size)
+            await discard_partial(cache_key)
+            partialData[cache_key] = partial
+            logger.info(f"Caching {url} ({total_size} bytes) in {partial.block_count} blocks from range requests")
+
+        first, last = partial.BlockOf(first_byte), partial.BlockOf(last_byte)
+        return partial, upstream, first_byte, (first, last, partial.Claim(first, last))
+    except BaseException:
+        upstream.release()
+        raise
+
+async def copy_segment(partial: PartialObject, upstream, segment_start: int, claim, f, response, pos: int, stop: int) -> int:
+    """
+    Writes an upstream 206 body into the sparse file at its offset, passing the bytes the client
+    is waiting for at `pos` on to it. Returns the client's new position.
+    """
+    first, last, future = claim
+    written = segment_start
+    error = None
+    try:
+        await f.seek(segment_start)
+        async for chunk in upstream.content.iter_chunked(CHUNK_SIZE):
+            upstreamBytes.Inc(amount=len(chunk))
+            await f.write(chunk)
+            end = written + len(chunk)
+            if written <= pos < end and pos < stop:
+                piece = chunk[pos - written:min(end, stop) - written]
+                await response.write(piece)
+                pos += len(piece)
+            written = end
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        # whatever made it to disk completely still counts
+        partial.MarkWritten(segment_start, written)
+        partial.Release(first, last, future, error)
+        upstream.release()
+    return pos
+
+async def copy_from_disk(f, response, pos: int, until: int) -> int:
+    await f.seek(pos)
+    while pos < until:
+        chunk = await f.read(min(CHUNK_SIZE, until - pos))
+        if not chunk:
+            raise IOError(f"Sparse cache file ended at {pos}, expected {until}")
+        await response.write(chunk)
+        pos += len(chunk)
+    return pos
+
+async def promote_partial(partial: PartialObject):
+    """
+    Turns a partial object whose blocks are all on disk into a regular cache entry.
+    """
+    if partialData.get(partial.cacheKey) is not partial:
+        return
+    del partialData[partial.cacheKey]
+
+    cache_path = f"{CACHE_DIR}/{partial.cacheKey}"
+    await asyncio.to_thread(os.replace, partial.path, cache_path)
+
+    stored = GetCallResult(headers=partial.headers, uri=partial.uri, cachePath=cache_path, cacheKey=partial.cacheKey, size=partial.total_size,
+                           expires_at=partial.expires_at, stale_while_revalidate=partial.stale_while_revalidate, stale_if_error=partial.stale_if_error)
+    store_entry(stored)
+    logger.info(f"All blocks of {partial.uri} are cached, promoted to a full entry")
+
+async def serve_range(request, cache_key, url) -> web.StreamResponse | None:
+    """
+    Serves a Range request for a key that isn't fully cached from a sparse partial object, fetching only
+    the blocks the range needs that aren't on disk yet.
+    Args:
+        request (web.Request): The client request, carrying a Range header.
+        cache_key (str): The cache key of the object.
+        url: The upstream url.
+    Returns:
+        web.StreamResponse: The 206 response, already written, or None when upstream doesn't serve ranges
+        for this object and the caller should do a full fill.
+    Notes:
+        - Concurrent requests wait for blocks another request is fetching instead of fetching them again.
+        - A changed object, detected through If-Range, discards the partial copy and cuts the response.
+        - The partial object becomes a regular cache entry once every block has been fetched.
+    """
+    partial = partialData.get(cache_key)
+    if partial is not None and partial.IsExpired():
+        await discard_partial(cache_key, partial)
+        partial = None
+
+    opening = None
+    if partial is None:
+        opening = await open_partial(request, cache_key, url)
+        if opening is None:
+            return None
+        partial = opening[0]
+
+    try:
+        start, stop = requested_range(request, partial.total_size)
+    except web.HTTPRequestRangeNotSatisfiable:
+        if opening is not None:
+            opening[1].release()
+            partial.Release(*opening[3][:2], opening[3][2])
+        raise
+
+    headers = CIMultiDict(partial.headers)
+    headers["Content-Range"] = f"bytes {start}-{stop - 1}/{partial.total_size}"
+    headers["X-FFPROXY-Cache"] = "PARTIAL"
+
+    response = web.StreamResponse(status=206, headers=headers)
+    response.content_length = stop - start
+    await response.prepare(request)
+
+    pos = start
+    try:
+        async with aiofiles.open(partial.path, 'r+b', buffering=0) as f:
+            if opening is not None:
+                _, upstream, segment_start, claim = opening
+                pos = await copy_segment(partial, upstream, segment_start, claim, f, response, pos, stop)
+
+            while pos < stop:
+                present_until = partial.PresentUntil(pos, stop)
+                if present_until > pos:
+                    pos = await copy_from_disk(f, response, pos, present_until)
+                    continue
+
+                pending = partial.fetching.get(partial.BlockOf(pos))
+                if pending is not None:
+                    try:
+                        await asyncio.wait_for(asyncio.shield(pending), FILL_STALL_TIMEOUT)
+                    except aiohttp.ClientError:
+                        # the other fetch failed and released its blocks, fetch them ourselves
+                        pass
+                    continue
+
+                first, last = partial.MissingRun(pos, stop)
+                segment_start = partial.BlockStart(first)
+                byte_range = f"bytes={segment_start}-{partial.BlockEnd(last) - 1}"
+                claim = (first, last, partial.Claim(first, last))
+
+                upstream = await upstreamGuard.Send(upstreamPool.session, "GET", url, headers=range_request_headers(request.headers, byte_range, partial), auto_decompress=False)
+                content_range = parse_content_range(upstream.headers.get("Content-Range"))
+                if upstream.status != 206 or content_range is None or content_range[0] != segment_start:
+                    upstream.release()
+                    error = PartialObjectChanged(f"{url} changed upstream, dropping its partial copy")
+                    partial.Release(first, last, claim[2], error)
+                    await discard_partial(cache_key, partial)
+                    raise error
+
+                pos = await copy_segment(partial, upstream, segment_start, claim, f, response, pos, stop)
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+        abort_response(request, f"Range fill of {url} broke off at {pos}", e)
+        if isinstance(e, UPSTREAM_BODY_ERRORS):
+            upstreamGuard.Health(url).Failed(f"{type(e).__name__}: {e}")
+        return response
+
+    if partial.IsComplete():
+        await promote_partial(partial)
+
+    await response.write_eof()
+    return response
+
 async def get_from_cache_or_source(request):
 
     url = request.url
     method = request.method
     headers = request.headers
 
-    cache_key = generate_key(url, method)
+    cache_key = generate_key(url, method, headers)
+
+    found = storedData.get(cache_key)
+    if found is not None and not found.MatchesVary(headers):
+        logger.info(f"Cached {url} was selected by different {', '.join(found.vary)}, refetching")
+        found = None
+
+    if found is not None and WORKER_ID is not None and not os.path.exists(found.cachePath):
+        # another worker purged or evicted it and this one hasn't read that from the journal yet
+        logger.info(f"Cached file of {url} was removed by another worker, refetching")
+        drop_entry(cache_key)
+        found = None
     
     ## happy path - check if the response is already in the cache
-    if cache_key in storedData:
-        
-        found = storedData[cache_key]
-        found.CacheHit()
+    if found is not None:
         
-        return web.FileResponse(found.cachePath, headers=found.headers)
-          
+        if found.IsFresh():
+            found.CacheHit()
+            return await serve_from_cache(request, found, "HIT")
 
-    ## unhappy path - fetch from upstream but debounced, only one request will fetch from upstream
-    if cache_key not in concurrentCalls:
-        
-        logger.info(f"Cache miss for {cache_key} - fetching {url} from upstream")
-        
-        cuncurrentCall = ConcurrentCall(uri=url, number_of_requests=0, wait_handle=asyncio.Condition())
-        
-        concurrentCalls[cache_key] = cuncurrentCall.wait_handle
+        if found.CanServeStale():
+            found.CacheHit()
+            schedule_revalidation(found, headers)
+            return await serve_from_cache(request, found, "STALE")
 
+        logger.info(f"Cached {url} is stale, revalidating with upstream")
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=request.headers) as response:
-                response.raise_for_status()
-                    
-                logger.info(f"{cache_key} : {url} has been fetched from upstream storing to disk")
+    ## unhappy path - fetch from upstream but debounced, only one request will fetch from upstream
+    call = concurrentCalls.get(cache_key)
+    if call is None:
 
-                #minizing memfootprint by streaming the response to disk
-                async with aiofiles.open(f"{CACHE_DIR}/{cache_key}", 'wb') as f:
-                    async for chunk in response.content.iter_chunked(4 * 1024):
-                        await f.write(chunk)
+        if found is None and RANGE_BLOCK_SIZE > 0 and "Range" in headers and "If-Range" not in headers:
+            response = await serve_range(request, cache_key, url)
+            if response is not None:
+                return response
         
-        stored = GetCallResult(headers=response.headers, uri=url, cachePath=f"{CACHE_DIR}/{cache_key}")
-
-        storedData[cache_key] = stored
-
-        async with concurrentCalls[cache_key]:
-            concurrentCalls[cache_key].notify_all()
-
-        del concurrentCalls[cache_key]
+        logger.info(f"Cache miss for {cache_key} - fetching {url} from upstream")
 
-        return web.FileResponse(stored.cachePath, headers=stored.headers)
+        call = start_fill(cache_key, url, headers, found)
+        return await serve_in_flight_or_stale(request, call, True, found)
 
     # debouncing requests - only one request will fetch from upstream
-    else:
-        signal = concurrentCalls[cache_key].NewCall()
-        
-        logger.info(f"Waiting for {cache_key} to be fetched from upstream from {url}")    
-        
-        async with signal:           
-            await signal.wait()
-            
-            logger.info(f"Done waiting for {url} to be fetched from upstream") 
-            
-            stored = storedData[cache_key]
+    call.NewCall()
 
-            stored.CacheHit()
+    logger.debug(f"Waiting for {cache_key} to be fetched from upstream from {url}")    
 
-            return web.FileResponse(stored.cachePath, headers=stored.headers)
+    return await serve_in_flight_or_stale(request, call, False, found)
+
+# entries shown on the stats page, the most recently used ones, /cache/entries pages through the rest
+STATS_PAGE_SIZE = 100
 
 @aiohttp_jinja2.template('stats.html')
 async def get_stats(request) -> web.Response:
@@ -302,12 +1675,182 @@ async def get_stats(request) -> web.Response:
     Returns:
         aiohttp.web.Response: The response containing the cache statistics.
     """
-    return {"stats": [entry.Stats() for entry in storedData.values()]}
+    recent = heapq.nlargest(STATS_PAGE_SIZE, storedData.values(), key=lambda entry: entry.last_accessed_time)
+    return {"stats": [entry.Stats() for entry in recent], "total": len(storedData), "eviction": cacheBudget.Stats(), "pool": upstreamPool.Stats(), "hot": hotTier.Stats(), "blobs": blobStore.Stats() if DEDUPLICATE else None}
 
     
 @aiohttp_jinja2.template('index.html')
 async def get_index(request) -> web.Response:
-    return {"stats": [entry.Stats() for entry in storedData.values()]}
+    # the page loads its table from /cache/stats
+    return {}
+
+ENTRY_SORT_KEYS = {
+    "last_accessed": lambda entry: entry.last_accessed_time,
+    "requests": lambda entry: entry.number_of_requests,
+    "size": lambda entry: entry.size,
+    "created": lambda entry: entry.created_time,
+    "expires": lambda entry: entry.expires_at,
+    "uri": lambda entry: str(entry.uri),
+}
+MAX_PAGE_SIZE = 1000
+
+async def list_entries(request) -> web.Response:
+    """
+    Lists cache entries as JSON, one page at a time.
+    Args:
+        request (aiohttp.web.Request): Query parameters offset, limit (at most MAX_PAGE_SIZE), sort (one of ENTRY_SORT_KEYS,
+            insertion order when absent), order (asc or desc) and the prefix, regex and host filters.
+    Returns:
+        aiohttp.web.Response: The page, next_offset for the following one and total when no filter is applied.
+    Raises:
+        web.HTTPBadRequest: If a parameter is invalid.
+    Notes:
+        - Unsorted pages walk storedData and stop once the page is full, O(offset + limit).
+        - Sorted pages keep offset + limit entries in a heap, O(n log(offset + limit)) rather than a full sort.
+    """
+    try:
+        offset = max(int(request.query.get("offset", 0)), 0)
+        limit = min(max(int(request.query.get("limit", 100)), 1), MAX_PAGE_SIZE)
+        matcher = UrlMatcher.FromOptions(request.query)
+    except ValueError as e:
+        raise web.HTTPBadRequest(reason=str(e))
+
+    sort = request.query.get("sort")
+    if sort is not None and sort not in ENTRY_SORT_KEYS:
+        raise web.HTTPBadRequest(reason=f"sort must be one of {', '.join(ENTRY_SORT_KEYS)}")
+
+    entries = storedData.values()
+    if not matcher.IsEmpty():
+        entries = (entry for entry in entries if matcher.Matches(str(entry.uri)))
+
+    if sort is None:
+        page = list(itertools.islice(entries, offset, offset + limit))
+    else:
+        select = heapq.nsmallest if request.query.get("order", "desc") == "asc" else heapq.nlargest
+        page = select(offset + limit, entries, key=ENTRY_SORT_KEYS[sort])[offset:]
+
+    return web.json_response({
+        "entries": [entry.ToListing() for entry in page],
+        "offset": offset,
+        "limit": limit,
+        "next_offset": offset + limit if len(page) == limit else None,
+        "total": len(storedData) if matcher.IsEmpty() else None,
+    })
+
+purgeJobs: dict[str, PurgeJob] = {}
+
+async def post_purge(request) -> web.Response:
+    """
+    Starts a background job removing every entry whose url matches the prefix, regex and host given
+    as JSON or in the query string.
+    Returns:
+        aiohttp.web.Response: 202 with the job's report, its Location polls the progress.
+    Raises:
+        web.HTTPBadRequest: If no condition is given or the regex is invalid.
+    """
+    options = request.query
+    if request.content_type == "application/json":
+        try:
+            options = await request.json()
+            matcher = UrlMatcher.FromOptions(options)
+        except (ValueError, AttributeError) as e:
+            raise web.HTTPBadRequest(reason=f"Expected a JSON object with prefix, regex or host: {e}")
+    else:
+        try:
+            matcher = UrlMatcher.FromOptions(options)
+        except ValueError as e:
+            raise web.HTTPBadRequest(reason=str(e))
+
+    if matcher.IsEmpty():
+        raise web.HTTPBadRequest(reason="Give a prefix, regex or host to purge, DELETE /cache/{key} removes single entries")
+
+    def uri_of(cache_key):
+        entry = storedData.get(cache_key)
+        return str(entry.uri) if entry is not None else None
+
+    job = PurgeJob(matcher=matcher)
+    job.task = asyncio.create_task(job.Run(list(storedData), uri_of, purge_keys))
+    backgroundTasks.add(job.task)
+    job.task.add_done_callback(backgroundTasks.discard)
+
+    purgeJobs[job.id] = job
+    for old in [old for old in purgeJobs.values() if old.task.done()][:max(len(purgeJobs) - MAX_WARM_JOBS, 0)]:
+        del purgeJobs[old.id]
+
+    logger.info(f"Purge job {job.id} started over {len(storedData)} entries")
+    return web.json_response(job.Stats(), status=202, headers={"Location": f"/cache/purge/{job.id}"})
+
+async def get_purge_job(request) -> web.Response:
+    job = purgeJobs.get(request.match_info['job'])
+    if job is None:
+        raise web.HTTPNotFound(reason="No such purge job")
+    return web.json_response(job.Stats())
+
+async def post_warm(request) -> web.Response:
+    """
+    Starts a warm job for a list of urls and answers with its progress report.
+    Args:
+        request (aiohttp.web.Request): Either JSON {"urls": [...], "concurrency": n, "rate": r, "refresh_before": s}
+            or a text file with one url per line, options then go in the query string.
+    Returns:
+        aiohttp.web.Response: 202 with the job's report, its Location polls the progress.
+    Raises:
+        web.HTTPBadRequest: If the body holds no urls or the options aren't numbers.
+    """
+    if request.content_type == "application/json":
+        try:
+            options = await request.json()
+            urls = options.get("urls", [])
+        except (ValueError, AttributeError):
+            raise web.HTTPBadRequest(reason="Expected a JSON object with a list of urls")
+    else:
+        options = request.query
+        urls = [line.strip() for line in (await request.text()).splitlines() if line.strip() and not line.lstrip().startswith("#")]
+
+    if not isinstance(urls, list) or not urls or not all(isinstance(url, str) for url in urls):
+        raise web.HTTPBadRequest(reason="No urls to warm")
+
+    try:
+        job = WarmJob(
+            urls=urls,
+            concurrency=int(options.get("concurrency", WARM_CONCURRENCY)),
+            rate=float(options.get("rate", WARM_RATE)),
+            refresh_before=float(options.get("refresh_before", 0)),
+        )
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(reason="concurrency, rate and refresh_before must be numbers")
+
+    start_warm_job(job)
+    logger.info(f"Warm job {job.id} started for {len(urls)} urls")
+    return web.json_response(job.Stats(), status=202, headers={"Location": f"/cache/warm/{job.id}"})
+
+async def get_warm_jobs(request) -> web.Response:
+    return web.json_response({"jobs": [job.Stats() for job in warmJobs.values()]})
+
+async def get_warm_job(request) -> web.Response:
+    job = warmJobs.get(request.match_info['job'])
+    if job is None:
+        raise web.HTTPNotFound(reason="No such warm job")
+    return web.json_response(job.Stats())
+
+async def cancel_warm_job(request) -> web.Response:
+    job = warmJobs.get(request.match_info['job'])
+    if job is None:
+        raise web.HTTPNotFound(reason="No such warm job")
+    job.task.cancel()
+    return web.Response(status=204)
+
+async def get_upstreams(request) -> web.Response:
+    """
+    Lists the upstream hosts the proxy sent requests to, with the state of their circuit and their recent latency.
+    """
+    return web.json_response(upstreamGuard.Stats())
+
+async def get_metrics(request) -> web.Response:
+    """
+    Exposes the proxy's counters, latency histograms and gauges in the Prometheus text format.
+    """
+    return web.Response(text=metrics.Render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
 
 
 
@@ -319,65 +1862,185 @@ async def get_index(request) -> web.Response:
 @web.middleware
 async def logging_middleware(request, handler):
     
-    start_time = asyncio.get_event_loop().time()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Incoming request: {request.method} {request.url} {request.headers}")
 
-    logger.info(f"Incoming request: {request.method} {request.url} {request.headers}")
+    # only proxied requests go to the access log, the cache api isn't traffic to replay
+    if accessLog is None or not is_proxied(request):
+        return await handler(request)
 
+    arrived = time.time()
+    started = time.monotonic()
     response = await handler(request)
-    
-    end_time = asyncio.get_event_loop().time()
-    duration = end_time - start_time
 
-    logger.info(f"Request {request.method} {request.url} completed in {duration:.4f} seconds")
-    
+    record = {
+        "ts": round(arrived, 6),
+        "method": request.method,
+        "url": str(request.url),
+        "status": response.status,
+        "outcome": response.headers.get("X-FFPROXY-Cache"),
+        "bytes": response.content_length,
+        # until the handler returned, file responses are sent after that
+        "duration": round(time.monotonic() - started, 6),
+    }
+    headers = {name: request.headers[name] for name in REPLAY_HEADERS if name in request.headers}
+    if headers:
+        record["headers"] = headers
+    if request.body_exists:
+        record["body_size"] = request.content_length
+    if WORKER_ID is not None:
+        record["worker"] = WORKER_ID
+    accessLog.Record(record)
     return response
 
+async def flush_access_log():
+    while True:
+        await asyncio.sleep(ACCESS_LOG_FLUSH_INTERVAL)
+        try:
+            await accessLog.Flush()
+        except OSError as e:
+            logger.error(f"Failed to write the access log: {e}")
+
+async def access_log_ctx(app):
+    if accessLog is None:
+        yield
+        return
+
+    accessLog.Open()
+    flusher = asyncio.create_task(flush_access_log())
+    yield
+
+    flusher.cancel()
+    try:
+        await flusher
+    except asyncio.CancelledError:
+        pass
+    await accessLog.Flush()
+    accessLog.Close()
+
+class MetricsAccessLogger(AbstractAccessLogger):
+    """
+    Records every finished request in the metrics, called by aiohttp once the body has been sent
+    so file responses are timed and counted in full, unlike in a middleware.
+    """
+
+    def log(self, request, response, time):
+        outcome = response.headers.get("X-FFPROXY-Cache", "NONE")
+        requestsTotal.Inc(outcome, f"{response.status // 100}xx")
+        requestLatency.Observe(time, outcome)
+        if outcome != "NONE":
+            # body_length counts everything written including headers, and misses what went out through sendfile
+            sent = response.content_length if response.content_length is not None else response.body_length
+            responseBytes.Inc("cache" if outcome in CACHE_OUTCOMES else "upstream", amount=sent)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Request {request.method} {request.url} {outcome} {response.status} completed in {time:.4f} seconds")
+
 @web.middleware
 async def error_handling_middleware(request, handler):
     try:
         response = await handler(request)
         return response
+    except CircuitOpenError as e:
+        logger.warning(f"Upstream unavailable: {e}")
+        errorsTotal.Inc(type(e).__name__, "503")
+        return web.Response(status=503, text=f"Service Unavailable: {e}", headers={"Retry-After": str(max(int(e.retry_after), 1))})
     except aiohttp.ClientError as e:
         logger.error(f"Upstream error: {e}")
-        return web.Response(status=502, text="Bad Gateway: Upstream server error: {e}")
-    except asyncio.TimeoutError:
+        errorsTotal.Inc(type(e).__name__, "502")
+        return web.Response(status=502, text=f"Bad Gateway: Upstream server error: {e}")
+    except asyncio.TimeoutError as e:
         logger.error("Upstream request timed out")
+        errorsTotal.Inc(type(e).__name__, "504")
         return web.Response(status=504, text="Gateway Timeout: Upstream server did not respond in time")
     except web.HTTPException as e:
         logger.error(f"HTTP error: {e}")
-        return web.Response(status=e.status, text=e.reason)
-    except FileNotFoundError:
+        errorsTotal.Inc(type(e).__name__, str(e.status))
+        return web.Response(status=e.status, text=e.reason, headers=e.headers)
+    except FileNotFoundError as e:
         logger.error(f"File not found")
-        return web.Response(status=404, text="Not Found")
-    except web.HTTPNotFound:
-        logger.error(f"Resource not found")
+        errorsTotal.Inc(type(e).__name__, "404")
         return web.Response(status=404, text="Not Found")
     except IOError as e:
         logger.error(f"IO error: {e}")
+        errorsTotal.Inc(type(e).__name__, "500")
         return web.Response(status=500, text="Internal IO exception")   
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
+        errorsTotal.Inc(type(e).__name__, "500")
         return web.Response(status=500, text="Internal Server Error")
 
 
 async def init_app() -> web.Application:
-    app = web.Application(middlewares=[logging_middleware, error_handling_middleware])
+    app = web.Application(middlewares=[logging_middleware, error_handling_middleware, proxy_routing_middleware])
 
     aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader('templates'))
 
+    app.cleanup_ctx.append(upstream_pool_ctx)
+    app.cleanup_ctx.append(cache_index_ctx)
+    app.cleanup_ctx.append(eviction_ctx)
+    app.cleanup_ctx.append(refresh_ctx)
+    app.cleanup_ctx.append(access_log_ctx)
+
 
     app.router.add_static('/static/', path=Path('static'), name='style.css')
 
     app.router.add_route('GET', '/cache', get_index)
     app.router.add_route('GET', '/cache/stats', get_stats)
-    app.router.add_route('DELETE', '/cache/', delete_entry)
+    app.router.add_route('GET', '/metrics', get_metrics)
+    app.router.add_route('POST', '/cache/warm', post_warm)
+    app.router.add_route('GET', '/cache/warm', get_warm_jobs)
+    app.router.add_route('GET', '/cache/warm/{job}', get_warm_job)
+    app.router.add_route('DELETE', '/cache/warm/{job}', cancel_warm_job)
+    app.router.add_route('GET', '/cache/entries', list_entries)
+    app.router.add_route('GET', '/cache/upstreams', get_upstreams)
+    app.router.add_route('POST', '/cache/purge', post_purge)
+    app.router.add_route('GET', '/cache/purge/{job}', get_purge_job)
+    app.router.add_route('DELETE', '/cache', delete_url)
+    app.router.add_route('DELETE', '/cache/{cacheKey}', delete_entry)
 
     app.router.add_route('*', '/{tail:.*}', main_dispatcher)
 
     return app
 
+def run_worker():
+    web.run_app(init_app(), host='0.0.0.0', port=PORT, reuse_port=WORKER_ID is not None, access_log_class=MetricsAccessLogger)
+
+def run_workers(count: int):
+    """
+    Starts `count` worker processes listening on PORT with SO_REUSEPORT, so the kernel spreads connections over them.
+    Notes:
+        - The parent prepares CACHE_DIR once and the workers start warm from the shared journal.
+        - SIGINT and SIGTERM are passed on to the workers, which shut down like a single process does.
+    """
+    prepare_cache_dir()
+    os.environ['FFPROXY_STARTUP_MODE'] = "warm"
+
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for worker_id in range(count):
+        # read at import time by the spawned worker
+        os.environ['FFPROXY_WORKER_ID'] = str(worker_id)
+        worker = context.Process(target=run_worker, name=f"ffproxy-worker-{worker_id}")
+        worker.start()
+        workers.append(worker)
+    logger.info(f"Started {count} workers on port {PORT}")
+
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for worker in workers:
+        worker.join()
+
 if __name__ == "__main__":   
-    web.run_app(init_app(), host='0.0.0.0', port=PORT)
+    if WORKERS > 1:
+        run_workers(WORKERS)
+    else:
+        run_worker()
 
 
 
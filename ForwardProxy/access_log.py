@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# request headers that change what the proxy answers, kept so a replay sends the same request
+REPLAY_HEADERS = ("Accept-Encoding", "Range", "If-Range", "If-None-Match", "If-Modified-Since", "Content-Type")
+
+
+class AccessLog:
+    """
+    Proxied requests as JSON lines, one per request, in the format replay.py reads back.
+    Notes:
+        - Records are buffered in memory and appended by Flush() in one write per batch through a thread,
+          the request path only appends to a list.
+        - The file is opened with O_APPEND, workers sharing it add whole batches without overwriting each other.
+        - When the flusher falls behind by more than `max_pending` records new ones are dropped and counted.
+    """
+
+    def __init__(self, path: str, max_pending: int = 100_000):
+        self.path = path
+        self.max_pending = max_pending
+        self.fd: int | None = None
+        self.pending: list[str] = []
+        self.written = 0
+        self.dropped = 0
+        self.flush_lock: asyncio.Lock | None = None
+
+    def Open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # made on the serving loop, on 3.9 a lock binds the loop current when it is made
+        self.flush_lock = asyncio.Lock()
+        logger.info(f"Writing access log to {self.path}")
+
+    def Close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def Record(self, record: dict):
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.pending.append(json.dumps(record, separators=(",", ":")))
+
+    async def Flush(self):
+        if self.fd is None:
+            return
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            data = ("\n".join(batch) + "\n").encode()
+            await asyncio.to_thread(self._write, data)
+            self.written += len(batch)
+
+    def _write(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
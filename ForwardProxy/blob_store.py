@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import os
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+logger = logging.getLogger(__name__)
+
+BLOB_DIR = "blobs"
+
+
+class BlobStore:
+    """
+    Content addressed storage for cached bodies, so identical bodies behind different urls are stored once.
+    A body lives under blobs/<algorithm>/<xx>/<digest> and every cache entry holding it is a hard link to that file,
+    the entry files keep their usual paths and the filesystem's link count is the reference count.
+    Notes:
+        - Digests are BLAKE3 when the optional blake3 package is installed, sha256 otherwise, and carry the
+          algorithm name so blobs written under either stay valid.
+        - A blob whose link count dropped to 1 is only referenced by its own name and is removed by Collect().
+          Link counts are shared by all worker processes, a worker linking a blob another one collects
+          still holds the data through its own link.
+        - `refs` counts the entries of this process per blob, so the cache budget charges a body once.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = os.path.join(directory, BLOB_DIR)
+        self.algorithm = "blake3" if blake3 is not None else "sha256"
+        self.refs: dict[str, int] = {}
+        self.deduplicated = 0
+        self.saved_bytes = 0
+
+    def Hasher(self):
+        return blake3.blake3() if self.algorithm == "blake3" else hashlib.sha256()
+
+    def Digest(self, hasher) -> str:
+        return f"{self.algorithm}:{hasher.hexdigest()}"
+
+    def Path(self, digest: str) -> str:
+        algorithm, _, hexdigest = digest.partition(':')
+        return os.path.join(self.directory, algorithm, hexdigest[:2], hexdigest)
+
+    def Link(self, temp_path: str, entry_path: str, digest: str) -> bool:
+        """
+        Moves a freshly written body into place as entry_path, sharing the blob's file when the body is stored already.
+        Returns:
+            bool: Whether an existing blob was reused and the new copy dropped.
+        """
+        blob_path = self.Path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        for _ in range(2):
+            try:
+                os.link(temp_path, blob_path)
+                os.replace(temp_path, entry_path)
+                return False
+            except FileExistsError:
+                pass
+
+            link_path = f"{temp_path}.link"
+            try:
+                os.link(blob_path, link_path)
+            except FileNotFoundError:
+                # collected in between, store this copy as the blob
+                continue
+            os.replace(link_path, entry_path)
+            os.remove(temp_path)
+            return True
+
+        os.replace(temp_path, entry_path)
+        return False
+
+    def Collect(self, digest: str):
+        """
+        Removes the blob once no cache entry links to it anymore.
+        """
+        blob_path = self.Path(digest)
+        try:
+            if os.stat(blob_path).st_nlink <= 1:
+                os.remove(blob_path)
+        except FileNotFoundError:
+            pass
+
+    def CollectAll(self) -> int:
+        """
+        Removes every unreferenced blob, left behind when the process died between removing an entry and its blob.
+        """
+        removed = 0
+        if not os.path.isdir(self.directory):
+            return removed
+
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    if os.stat(path).st_nlink <= 1:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+
+        if removed:
+            logger.info(f"Removed {removed} unreferenced blobs")
+        return removed
+
+    def Ref(self, digest: str) -> bool:
+        """
+        Counts an entry holding the blob, returns whether it is the first one.
+        """
+        count = self.refs.get(digest, 0)
+        self.refs[digest] = count + 1
+        return count == 0
+
+    def Unref(self, digest: str) -> bool:
+        """
+        Forgets an entry holding the blob, returns whether it was the last one.
+        """
+        count = self.refs.get(digest, 0) - 1
+        if count > 0:
+            self.refs[digest] = count
+            return False
+        self.refs.pop(digest, None)
+        return True
+
+    def Stats(self):
+        return {
+            "algorithm": self.algorithm,
+            "blobs": len(self.refs),
+            "deduplicated": self.deduplicated,
+            "saved_bytes": self.saved_bytes,
+        }
@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import fcntl
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_NAME = "index.journal"
+LOCK_NAME = "index.journal.lock"
+
+
+class CacheIndex:
+    """
+    Durable metadata store for the entries in the cache directory.
+    Every change is appended as one JSON line to a journal next to the cached files,
+    so a restart replays the journal in O(entries) instead of stat'ing the files.
+    Notes:
+        - Records are buffered in memory and written by a single flusher, hits for the
+          same key are coalesced into one record per flush.
+        - A torn trailing line left by a crash is skipped on replay.
+        - The journal is rewritten as a compact snapshot once it holds `compact_ratio`
+          times more records than live entries.
+        - Several processes may share one journal. Appends and compaction take an flock on a lock file next to it,
+          records carry the `writer` that made them and Tail() hands every process the records of the others.
+    """
+
+    def __init__(self, directory: str, compact_ratio: int = 4, compact_min_records: int = 1024, writer: str | None = None):
+        self.path = os.path.join(directory, JOURNAL_NAME)
+        self.lock_path = os.path.join(directory, LOCK_NAME)
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self.writer = writer
+        self.records = 0
+        self.live = 0
+        self.pending: list[dict] = []
+        self.pending_hits: dict[str, dict] = {}
+        # how far this process has read the journal, and which file that was, compaction replaces it
+        self.offset = 0
+        self.inode = None
+        # created on the loop that flushes, on 3.9 a lock binds the loop current when it is made
+        self.flush_lock: asyncio.Lock | None = None
+
+    def Load(self) -> dict[str, dict]:
+        entries: dict[str, dict] = {}
+        self.records = 0
+        self.offset = 0
+        self.inode = None
+
+        if not os.path.exists(self.path):
+            return entries
+
+        with open(self.path, 'rb') as journal:
+            self.inode = os.fstat(journal.fileno()).st_ino
+            for line in journal:
+                if not line.endswith(b"\n"):
+                    # torn, or still being written by another process
+                    break
+                self.offset += len(line)
+                parsed = self._parse(line)
+                if parsed is None:
+                    continue
+
+                op, key, record = parsed
+                record.pop("w", None)
+                self.records += 1
+                if op == "put":
+                    entries[key] = record
+                elif op == "hit" and key in entries:
+                    entries[key].update(record)
+                elif op == "del":
+                    entries.pop(key, None)
+
+        self.live = len(entries)
+        logger.info(f"Replayed {self.records} journal records into {self.live} cache entries")
+        return entries
+
+    def Tail(self) -> tuple[bool, list[tuple[str, str, dict]]]:
+        """
+        Reads the records other processes appended since the last Load() or Tail().
+        Returns:
+            tuple[bool, list]: Whether the journal was compacted in the meantime, in which case the records are
+            the complete snapshot starting from the top, and the (op, key, record) triples in journal order.
+        """
+        ops = []
+        try:
+            journal = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False, ops
+
+        with journal:
+            inode = os.fstat(journal.fileno()).st_ino
+            replaced = inode != self.inode
+            if replaced:
+                self.inode = inode
+                self.offset = 0
+                self.records = 0
+
+            journal.seek(self.offset)
+            for line in journal:
+                if not line.endswith(b"\n"):
+                    break
+                self.offset += len(line)
+                self.records += 1
+                parsed = self._parse(line)
+                if parsed is None:
+                    continue
+                op, key, record = parsed
+                if not replaced and record.pop("w", None) == self.writer:
+                    continue
+                record.pop("w", None)
+                ops.append((op, key, record))
+
+        return replaced, ops
+
+    def _parse(self, line: bytes) -> tuple[str, str, dict] | None:
+        try:
+            record = json.loads(line)
+            return record.pop("op"), record["key"], record
+        except (ValueError, KeyError):
+            logger.warning(f"Skipping unreadable record in {self.path}")
+            return None
+
+    def Put(self, record: dict, new: bool = True):
+        """Records an entry, `new` when it wasn't in the cache before rather than written over or revalidated."""
+        self.pending_hits.pop(record["key"], None)
+        self.pending.append({"op": "put", **record})
+        if new:
+            self.live += 1
+
+    def Hit(self, key: str, number_of_requests: int, last_accessed_time: float):
+        self.pending_hits[key] = {"op": "hit", "key": key, "number_of_requests": number_of_requests, "last_accessed_time": last_accessed_time}
+
+    def Delete(self, key: str):
+        self.pending_hits.pop(key, None)
+        self.pending.append({"op": "del", "key": key})
+        self.live = max(self.live - 1, 0)
+
+    def NeedsCompaction(self) -> bool:
+        return self.records > max(self.compact_min_records, self.compact_ratio * self.live)
+
+    async def Flush(self):
+        # serialized so batches land in the order they were taken
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        async with self.flush_lock:
+            # hits go last so they land after a put for the same key in this batch
+            batch = self.pending + list(self.pending_hits.values())
+            self.pending = []
+            self.pending_hits = {}
+
+            if batch:
+                if self.writer is not None:
+                    batch = [{**record, "w": self.writer} for record in batch]
+                await asyncio.to_thread(self._append, batch)
+                if self.writer is None:
+                    self.records += len(batch)
+
+    @contextlib.asynccontextmanager
+    async def Exclusive(self):
+        """
+        Holds the journal lock across processes, nobody appends or compacts until it is released.
+        Tail() inside it sees every record there is.
+        """
+        lock = await asyncio.to_thread(self._lock)
+        try:
+            yield
+        finally:
+            lock.close()
+
+    async def Compact(self, records: list[dict]):
+        """
+        Rewrites the journal as a snapshot of `records`, with several writers only inside Exclusive()
+        after tailing, or the records the other processes appended meanwhile are lost.
+        """
+        self.inode = await asyncio.to_thread(self._rewrite, records)
+        self.records = len(records)
+        self.live = len(records)
+        self.offset = await asyncio.to_thread(os.path.getsize, self.path)
+        logger.info(f"Compacted cache journal to {self.records} records")
+
+    def _lock(self):
+        lock = open(self.lock_path, 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return lock
+
+    def _append(self, batch: list[dict]):
+        data = "".join(json.dumps(record, separators=(',', ':')) + "\n" for record in batch)
+        with self._lock():
+            with open(self.path, 'a', encoding='utf-8') as journal:
+                journal.write(data)
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    def _rewrite(self, records: list[dict]) -> int:
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as journal:
+            for record in records:
+                journal.write(json.dumps({"op": "put", **record}, separators=(',', ':')) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+            inode = os.fstat(journal.fileno()).st_ino
+        os.replace(temp_path, self.path)
+        return inode
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import logging
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# content types worth compressing, media formats are compressed already
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "application/xhtml+xml",
+                      "application/x-ndjson", "application/ld+json", "image/svg+xml")
+
+
+def is_compressible(headers) -> bool:
+    """
+    Whether a decoded response of this type is stored compressed, responses that already carry a
+    Content-Encoding are left alone.
+    """
+    if "Content-Encoding" in headers:
+        return False
+    content_type = headers.get("Content-Type", "").split(';')[0].strip().lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) or content_type.endswith(("+json", "+xml"))
+
+
+def resolve_encoding(mode: str) -> str | None:
+    """
+    Maps the configured compression mode to the encoding stored on disk.
+    Args:
+        mode (str): off, gzip or zstd.
+    Returns:
+        str: The encoding, or None when compression is off.
+    Raises:
+        ValueError: If the mode is unknown.
+    Notes:
+        - zstd needs the optional zstandard package, without it gzip is used.
+    """
+    mode = mode.lower()
+    if mode in ("off", "none", ""):
+        return None
+    if mode == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed, storing compressible responses with gzip")
+        return "gzip"
+    if mode not in ("gzip", "zstd"):
+        raise ValueError(f"Unknown compression mode {mode}, expected off, gzip or zstd")
+    return mode
+
+
+def accepts_encoding(accept_encoding: str | None, encoding: str) -> bool:
+    """
+    Whether an Accept-Encoding header allows `encoding`, honouring q values and *.
+    A missing header is treated as identity only, which is what clients without one expect in practice.
+    """
+    if not accept_encoding:
+        return False
+
+    qualities = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[name.strip().lower()] = q
+
+    return qualities.get(encoding, qualities.get("*", 0.0)) > 0
+
+
+class _GzipCompressor:
+    def __init__(self, level: int):
+        # wbits 31 writes a gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+
+class _GzipDecompressor:
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(31)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.decompressor.decompress(data)
+
+    def flush(self) -> bytes:
+        return self.decompressor.flush()
+
+
+class _ZstdCompressor:
+    def __init__(self, level: int):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+
+class _ZstdDecompressor:
+    def __init__(self):
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.decompressor.decompress(data)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def make_compressor(encoding: str, level: int | None = None):
+    if encoding == "zstd":
+        return _ZstdCompressor(3 if level is None else level)
+    return _GzipCompressor(6 if level is None else level)
+
+
+def make_decompressor(encoding: str):
+    if encoding == "zstd":
+        return _ZstdDecompressor()
+    return _GzipDecompressor()
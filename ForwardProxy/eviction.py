@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+from collections import OrderedDict, defaultdict
+
+
+class LRUPolicy:
+    """
+    Least recently used eviction, an ordered dict where the front is the next victim.
+    All operations are O(1).
+    """
+
+    def __init__(self):
+        self.order: OrderedDict[str, None] = OrderedDict()
+
+    def Add(self, key: str, hits: int = 1):
+        self.order[key] = None
+        self.order.move_to_end(key)
+
+    def Touch(self, key: str):
+        if key in self.order:
+            self.order.move_to_end(key)
+
+    def Remove(self, key: str):
+        self.order.pop(key, None)
+
+    def Victim(self) -> str | None:
+        return next(iter(self.order), None)
+
+    def __len__(self):
+        return len(self.order)
+
+
+class LFUPolicy:
+    """
+    Least frequently used eviction with frequency buckets, ties broken by recency.
+    Each bucket is an ordered dict of the keys seen exactly that many times, and the
+    lowest non-empty frequency is tracked so victim lookup stays O(1).
+    """
+
+    def __init__(self):
+        self.frequency: dict[str, int] = {}
+        self.buckets: defaultdict[int, OrderedDict[str, None]] = defaultdict(OrderedDict)
+        self.min_frequency = 0
+
+    def Add(self, key: str, hits: int = 1):
+        self.Remove(key)
+        hits = max(hits, 1)
+        self.frequency[key] = hits
+        self.buckets[hits][key] = None
+        if len(self.frequency) == 1 or hits < self.min_frequency:
+            self.min_frequency = hits
+
+    def Touch(self, key: str):
+        hits = self.frequency.get(key)
+        if hits is None:
+            return
+
+        bucket = self.buckets[hits]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[hits]
+            if self.min_frequency == hits:
+                self.min_frequency = hits + 1
+
+        self.frequency[key] = hits + 1
+        self.buckets[hits + 1][key] = None
+
+    def Remove(self, key: str):
+        hits = self.frequency.pop(key, None)
+        if hits is None:
+            return
+
+        bucket = self.buckets[hits]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[hits]
+            if self.min_frequency == hits:
+                # only walks the buckets on removal of the last key of the lowest frequency
+                self.min_frequency = min(self.buckets, default=0)
+
+    def Victim(self) -> str | None:
+        bucket = self.buckets.get(self.min_frequency)
+        if not bucket:
+            return None
+        return next(iter(bucket))
+
+    def __len__(self):
+        return len(self.frequency)
+
+
+EVICTION_POLICIES = {
+    "lru": LRUPolicy,
+    "lfu": LFUPolicy,
+}
+
+
+def make_policy(name: str):
+    try:
+        return EVICTION_POLICIES[name.lower()]()
+    except KeyError:
+        raise ValueError(f"Unknown eviction policy {name}, expected one of {', '.join(EVICTION_POLICIES)}")
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import dataclasses
+import time
+from email.utils import parsedate_to_datetime
+
+# request headers that must not leak into a cache fill, the proxy answers them itself
+CLIENT_CONDITIONAL_HEADERS = ("If-None-Match", "If-Modified-Since", "If-Match", "If-Unmodified-Since", "If-Range", "Range")
+
+# headers a 304 Not Modified carries that replace the stored ones
+REVALIDATION_HEADERS = ("Cache-Control", "Expires", "Date", "ETag", "Last-Modified", "Age", "Vary")
+
+
+@dataclasses.dataclass
+class Freshness:
+    storable: bool
+    expires_at: float
+    stale_while_revalidate: float
+    stale_if_error: float = 0.0
+
+
+def parse_cache_control(value: str | None) -> dict[str, str | None]:
+    directives = {}
+    if not value:
+        return directives
+
+    for part in value.split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+
+    return directives
+
+
+def parse_http_date(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def directive_seconds(directives: dict, name: str) -> int | None:
+    try:
+        return max(int(directives[name]), 0)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def compute_freshness(headers, default_ttl: float, default_stale_while_revalidate: float, now: float | None = None, default_stale_if_error: float = 0.0) -> Freshness:
+    """
+    Computes how long an upstream response may be served from a shared cache.
+    Args:
+        headers: The upstream response headers.
+        default_ttl (float): Lifetime used when the response carries no explicit freshness information.
+        default_stale_while_revalidate (float): Stale window used when the response doesn't set one.
+        now (float): Wall clock time of the response, defaults to time.time().
+        default_stale_if_error (float): How long past expiry the response may stand in for a failing upstream
+            when it doesn't set stale-if-error itself.
+    Returns:
+        Freshness: Whether the response may be stored, when it expires and how long it may be served stale,
+        to hide a revalidation or while upstream fails.
+    Notes:
+        - s-maxage wins over max-age, which wins over Expires relative to Date.
+        - no-cache stores the response but makes every use revalidate, must-revalidate disables serving stale,
+          for errors as well.
+        - no-store, private and Vary: * make the response not storable.
+    """
+    now = time.time() if now is None else now
+    directives = parse_cache_control(headers.get("Cache-Control"))
+
+    storable = "no-store" not in directives and "private" not in directives and headers.get("Vary", "").strip() != "*"
+
+    lifetime = directive_seconds(directives, "s-maxage")
+    if lifetime is None:
+        lifetime = directive_seconds(directives, "max-age")
+    if lifetime is None and "Expires" in headers:
+        expires = parse_http_date(headers.get("Expires"))
+        date = parse_http_date(headers.get("Date")) or now
+        # an unparseable Expires means already expired
+        lifetime = max(expires - date, 0) if expires is not None else 0
+    if lifetime is None:
+        lifetime = default_ttl
+    if "no-cache" in directives:
+        lifetime = 0
+
+    try:
+        age = max(int(headers.get("Age", 0)), 0)
+    except ValueError:
+        age = 0
+
+    stale_while_revalidate = directive_seconds(directives, "stale-while-revalidate")
+    if stale_while_revalidate is None:
+        stale_while_revalidate = default_stale_while_revalidate
+    stale_if_error = directive_seconds(directives, "stale-if-error")
+    if stale_if_error is None:
+        stale_if_error = default_stale_if_error
+    if "must-revalidate" in directives or "proxy-revalidate" in directives or "no-cache" in directives:
+        stale_while_revalidate = 0
+        stale_if_error = 0
+
+    return Freshness(storable=storable, expires_at=now + lifetime - age, stale_while_revalidate=stale_while_revalidate, stale_if_error=stale_if_error)
+
+
+# request headers the proxy negotiates itself rather than passing them upstream, they never select a stored response
+NEGOTIATED_HEADERS = ("accept-encoding",)
+
+
+def vary_snapshot(response_headers, request_headers) -> dict[str, str]:
+    """
+    Captures the request header values named by the response's Vary header.
+    """
+    names = [name.strip().lower() for name in response_headers.get("Vary", "").split(',') if name.strip()]
+    names = [name for name in names if name not in NEGOTIATED_HEADERS]
+    return {name: request_headers.get(name, "") for name in names}
+
+
+def conditional_headers(stored_headers) -> dict[str, str]:
+    """
+    Builds the validators for revalidating a stored response with its origin.
+    """
+    conditional = {}
+    if "ETag" in stored_headers:
+        conditional["If-None-Match"] = stored_headers["ETag"]
+    if "Last-Modified" in stored_headers:
+        conditional["If-Modified-Since"] = stored_headers["Last-Modified"]
+    return conditional
+
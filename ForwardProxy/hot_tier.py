@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import os
+from collections import OrderedDict
+from email.utils import formatdate
+
+from aiohttp import web
+from multidict import CIMultiDict, CIMultiDictProxy
+
+
+@dataclasses.dataclass
+class HotEntry:
+    body: bytes
+    headers: CIMultiDictProxy
+    etag: str
+
+
+class HotTier:
+    """
+    RAM copies of small, frequently hit cache entries, served without touching the disk.
+    Entries are promoted from the disk cache once they have been requested `promote_after` times
+    and evicted least recently used when the byte budget is exceeded.
+    Notes:
+        - Headers are built once at promotion, ETag and Last-Modified follow the same scheme as
+          web.FileResponse so clients see the same validators whichever tier answers.
+        - The caller is responsible for dropping entries whose disk copy changes.
+    """
+
+    def __init__(self, max_bytes: int, max_object_size: int, promote_after: int):
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.promote_after = promote_after
+        self.entries: OrderedDict[str, HotEntry] = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.promotions = 0
+        self.evictions = 0
+
+    def Get(self, key: str) -> HotEntry | None:
+        hot = self.entries.get(key)
+        if hot is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return hot
+
+    def ShouldPromote(self, key: str, size: int, number_of_requests: int) -> bool:
+        return self.max_bytes > 0 and size <= self.max_object_size and number_of_requests >= self.promote_after and key not in self.entries
+
+    async def Promote(self, key: str, path: str, headers) -> HotEntry:
+        body, stat = await asyncio.to_thread(_read_with_stat, path)
+
+        hot_headers = CIMultiDict(headers)
+        hot_headers.popall("Content-Length", None)
+        etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        hot_headers["ETag"] = f'"{etag}"'
+        hot_headers["Last-Modified"] = formatdate(stat.st_mtime, usegmt=True)
+        hot_headers["X-FFPROXY-Cache"] = "HIT"
+
+        hot = HotEntry(body=body, headers=CIMultiDictProxy(hot_headers), etag=etag)
+        self.Remove(key)
+        self.entries[key] = hot
+        self.used_bytes += len(body)
+        self.promotions += 1
+
+        while self.used_bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.used_bytes -= len(evicted.body)
+            self.evictions += 1
+
+        return hot
+
+    def Remove(self, key: str):
+        hot = self.entries.pop(key, None)
+        if hot is not None:
+            self.used_bytes -= len(hot.body)
+
+    @staticmethod
+    def Respond(request: web.Request, hot: HotEntry) -> web.Response:
+        if_none_match = request.if_none_match
+        if if_none_match and any(etag.value in (hot.etag, "*") for etag in if_none_match):
+            return web.Response(status=304, headers={"ETag": hot.headers["ETag"], "X-FFPROXY-Cache": "HIT"})
+        return web.Response(body=hot.body, headers=hot.headers)
+
+    def Stats(self):
+        served = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "used_bytes": self.used_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / served if served else 0.0,
+            "promotions": self.promotions,
+            "evictions": self.evictions,
+        }
+
+
+def _read_with_stat(path: str) -> tuple[bytes, os.stat_result]:
+    with open(path, 'rb') as f:
+        return f.read(), os.fstat(f.fileno())
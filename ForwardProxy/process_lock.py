@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import os
+
+
+class KeyLocks:
+    """
+    Per cache key locks shared by the worker processes, so only one of them fills a key from upstream.
+    Each key is a one byte POSIX record lock in a single lock file, at an offset taken from the key's hash,
+    so no lock files pile up and a worker that dies releases its locks with it.
+    Notes:
+        - Record locks belong to the process, a worker taking one it already holds gets it straight away and
+          releasing it once drops it. Fills of the same key inside one worker, e.g. for different Vary selections,
+          therefore queue on an asyncio.Lock of the key before taking the record lock.
+        - The file descriptor stays open for the life of the process, closing any descriptor of the file
+          would drop every lock the process holds on it.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.05):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.fd: int | None = None
+        self.local: dict[int, _LocalLock] = {}
+        self.contended = 0
+
+    def Open(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def Close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @staticmethod
+    def _offset(key: str) -> int:
+        # cache keys are hex digests, 40 bits keep collisions between live fills out of the picture
+        return int(key[:10], 16)
+
+    def _try_lock(self, offset: int) -> bool:
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+            return True
+        except (BlockingIOError, PermissionError):
+            return False
+
+    async def Acquire(self, key: str) -> bool:
+        """
+        Takes the lock for key, waiting for another fill of it in this worker and polling while another worker holds it.
+        Returns:
+            bool: Whether another fill held it, that fill may have stored the key meanwhile.
+        """
+        offset = self._offset(key)
+        local = self.local.get(offset)
+        if local is None:
+            local = self.local[offset] = _LocalLock()
+        local.users += 1
+        try:
+            waited = local.lock.locked()
+            await local.lock.acquire()
+        except BaseException:
+            self._forget(offset, local)
+            raise
+
+        try:
+            if self._try_lock(offset):
+                return waited
+
+            self.contended += 1
+            while not self._try_lock(offset):
+                await asyncio.sleep(self.poll_interval)
+            return True
+        except BaseException:
+            local.lock.release()
+            self._forget(offset, local)
+            raise
+
+    def Release(self, key: str):
+        offset = self._offset(key)
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, offset)
+        local = self.local[offset]
+        local.lock.release()
+        self._forget(offset, local)
+
+    def _forget(self, offset: int, local: _LocalLock):
+        local.users -= 1
+        if local.users == 0:
+            del self.local[offset]
+
+
+class _LocalLock:
+    """The in-process side of a key's lock, kept only while some fill holds or waits for it."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
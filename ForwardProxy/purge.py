@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import re
+import time
+import uuid
+from urllib.parse import urlsplit
+
+
+@dataclasses.dataclass
+class UrlMatcher:
+    """
+    Selects cache entries by url, every given condition has to hold.
+    """
+    prefix: str | None = None
+    regex: re.Pattern | None = None
+    host: str | None = None
+
+    @classmethod
+    def FromOptions(cls, options) -> "UrlMatcher":
+        """
+        Builds a matcher from request options with prefix, regex and host keys.
+        Raises:
+            ValueError: If the regex doesn't compile.
+        """
+        regex = options.get("regex")
+        try:
+            compiled = re.compile(regex) if regex else None
+        except re.error as e:
+            raise ValueError(f"Invalid regex {regex}: {e}")
+        host = options.get("host")
+        return cls(prefix=options.get("prefix") or None, regex=compiled, host=host.lower() if host else None)
+
+    def IsEmpty(self) -> bool:
+        return self.prefix is None and self.regex is None and self.host is None
+
+    def Matches(self, uri: str) -> bool:
+        if self.prefix is not None and not uri.startswith(self.prefix):
+            return False
+        if self.host is not None and (urlsplit(uri).hostname or "") != self.host:
+            return False
+        if self.regex is not None and self.regex.search(uri) is None:
+            return False
+        return True
+
+
+@dataclasses.dataclass
+class PurgeJob:
+    """
+    Removes every cache entry whose url matches, walking a snapshot of the keys in batches so the
+    event loop keeps serving in between.
+    Notes:
+        - Entries stored after the job started aren't in the snapshot and survive it.
+    """
+    matcher: UrlMatcher
+    batch_size: int = 1000
+    id: str = dataclasses.field(default_factory=lambda: uuid.uuid4().hex[:12])
+    status: str = "queued"
+    total: int = 0
+    scanned: int = 0
+    matched: int = 0
+    removed: int = 0
+    created_time: float = dataclasses.field(default_factory=time.time)
+    finished_time: float | None = None
+    task: asyncio.Task | None = None
+
+    async def Run(self, keys: list[str], uri_of, purge_batch):
+        """
+        Args:
+            keys (list[str]): Snapshot of the cache keys to look at.
+            uri_of: Returns the url of a key, None when it is gone already.
+            purge_batch: Coroutine function removing a list of keys, returning how many it removed.
+        """
+        self.status = "running"
+        self.total = len(keys)
+        try:
+            for start in range(0, len(keys), self.batch_size):
+                batch = keys[start:start + self.batch_size]
+                matched = []
+                for key in batch:
+                    uri = uri_of(key)
+                    if uri is not None and self.matcher.Matches(uri):
+                        matched.append(key)
+                self.scanned += len(batch)
+                self.matched += len(matched)
+                if matched:
+                    self.removed += await purge_batch(matched)
+                # let requests in between batches
+                await asyncio.sleep(0)
+            self.status = "finished"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+            raise
+        finally:
+            self.finished_time = time.time()
+
+    def Stats(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "prefix": self.matcher.prefix,
+            "regex": self.matcher.regex.pattern if self.matcher.regex is not None else None,
+            "host": self.matcher.host,
+            "total": self.total,
+            "scanned": self.scanned,
+            "matched": self.matched,
+            "removed": self.removed,
+        }
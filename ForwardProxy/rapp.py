@@ -1,11 +1,12 @@
 # Running with rust runtime 
+# The proxy scales over cores with FFPROXY_WORKERS, SO_REUSEPORT worker processes sharing one cache index.
+# This RSGI entry point is kept for granian but doesn't bridge to the aiohttp application.
 
 
 
 class RApp:
     def __rsgi_init__(self, loop):
-        
-        loop.run_until_complete(some_async_init_task())
+        pass
 
     async def __rsgi__(self, scope, protocol):
-        
\ No newline at end of file
+        protocol.response_str(501, [("content-type", "text/plain")], "Run FF_caching_proxy.py with FFPROXY_WORKERS=<n> for multiple workers\n")
@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+
+import aiohttp
+from yarl import URL
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# answers that say the host is in trouble, other statuses are about the url that was asked for
+FAILURE_STATUSES = (502, 503, 504)
+
+# errors of upstream breaking off a body, a client going away while it is relayed is no fault of upstream's
+UPSTREAM_BODY_ERRORS = (aiohttp.ClientPayloadError, aiohttp.ServerDisconnectedError, asyncio.TimeoutError)
+
+# latencies needed before a percentile is trusted to time hedges
+MIN_LATENCY_SAMPLES = 20
+
+# hedges a host can have saved up, so a quiet spell doesn't buy a burst of doubled requests later
+HEDGE_BURST = 10.0
+
+
+class CircuitOpenError(aiohttp.ClientConnectionError):
+    """
+    Raised instead of sending a request to an upstream host whose circuit is open.
+    """
+
+    def __init__(self, host: str, retry_after: float):
+        super().__init__(f"Circuit for {host} is open, retry in {retry_after:.0f}s")
+        self.host = host
+        self.retry_after = retry_after
+
+
+class UpstreamHealth:
+    """
+    Circuit breaker and recent latencies of one upstream host.
+    Notes:
+        - `failure_threshold` consecutive failures open the circuit, requests are then refused without
+          going upstream for `open_seconds`. After that one probe is let through, its success closes the
+          circuit and its failure opens it again.
+        - A threshold of 0 never opens the circuit, the host's health is still tracked.
+        - Latencies are times until upstream answered with its headers, kept for the last `window` requests.
+    """
+
+    def __init__(self, host: str, failure_threshold: int, open_seconds: float, window: int = 256):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.latencies: collections.deque[float] = collections.deque(maxlen=window)
+        self.hedge_tokens = HEDGE_BURST
+
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.times_opened = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.last_error: str | None = None
+
+    def Allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() < self.open_until:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            self.probing = False
+        # half open, one probe at a time
+        if self.probing:
+            self.rejected += 1
+            return False
+        self.probing = True
+        return True
+
+    def RetryAfter(self) -> float:
+        return max(self.open_until - time.monotonic(), 0.0)
+
+    def Succeeded(self, latency: float):
+        self.latencies.append(latency)
+        self.consecutive_failures = 0
+        self.probing = False
+        if self.state != CLOSED:
+            logger.info(f"Upstream {self.host} recovered, closing its circuit")
+            self.state = CLOSED
+
+    def Failed(self, error: str):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+        self.probing = False
+        if self.state == HALF_OPEN or (self.failure_threshold > 0 and self.consecutive_failures >= self.failure_threshold and self.state == CLOSED):
+            self.state = OPEN
+            self.open_until = time.monotonic() + self.open_seconds
+            self.times_opened += 1
+            logger.warning(f"Upstream {self.host} failed {self.consecutive_failures} times in a row, opening its circuit for {self.open_seconds}s: {error}")
+
+    def Abandoned(self):
+        """A request ended without telling anything about the host, e.g. it was cancelled, another probe may go."""
+        self.probing = False
+
+    def Percentile(self, percentile: float) -> float | None:
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * percentile / 100), len(ordered) - 1)]
+
+    def Stats(self):
+        p50, p95 = self.Percentile(50), self.Percentile(95)
+        return {
+            "host": self.host,
+            "state": self.state,
+            "retry_after": round(self.RetryAfter(), 1) if self.state == OPEN else None,
+            "consecutive_failures": self.consecutive_failures,
+            "requests": self.requests,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "times_opened": self.times_opened,
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "latency_p50_ms": round(1000 * p50, 1) if p50 is not None else None,
+            "latency_p95_ms": round(1000 * p95, 1) if p95 is not None else None,
+            "last_error": self.last_error,
+        }
+
+
+def _discard(task: asyncio.Task):
+    """Cancels an attempt that lost the race, releasing its response should it have one by the time it ends."""
+    if not task.done():
+        task.cancel()
+        task.add_done_callback(_discard)
+        return
+    if not task.cancelled() and task.exception() is None:
+        task.result().release()
+
+
+class UpstreamGuard:
+    """
+    Circuit breakers per upstream host, a deadline for upstream's headers and hedged requests, for every request
+    the proxy sends upstream.
+    Notes:
+        - Only cache fills are hedged, through Get(). Hedging sends the request twice and is only safe for idempotent requests.
+        - A request whose headers take longer than the `hedge_percentile` latency of its host, but at least
+          `hedge_min_delay`, is sent a second time and whichever answers first is used, the other is cancelled.
+          Each request earns its host `hedge_max_ratio` of a hedge, a brownout can't double the load upstream.
+        - Hosts are told apart by scheme, host and port. Every worker process keeps its own breakers.
+    """
+
+    def __init__(self, failure_threshold: int = 5, open_seconds: float = 30, headers_timeout: float = 30,
+                 hedge_percentile: float = 0, hedge_min_delay: float = 0.05, hedge_max_ratio: float = 0.1):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.headers_timeout = headers_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        self.hosts: dict[str, UpstreamHealth] = {}
+
+    def Health(self, url) -> UpstreamHealth:
+        url = url if isinstance(url, URL) else URL(str(url))
+        host = f"{url.scheme}://{url.host}:{url.port}"
+        health = self.hosts.get(host)
+        if health is None:
+            health = self.hosts[host] = UpstreamHealth(host, self.failure_threshold, self.open_seconds)
+        return health
+
+    def HedgeDelay(self, health: UpstreamHealth) -> float | None:
+        if self.hedge_percentile <= 0 or health.state != CLOSED:
+            return None
+        latency = health.Percentile(self.hedge_percentile)
+        return max(latency, self.hedge_min_delay) if latency is not None else None
+
+    async def Send(self, session: aiohttp.ClientSession, method: str, url, hedge: bool = False, **kwargs) -> aiohttp.ClientResponse:
+        """
+        Sends a request upstream unless the host's circuit is open, recording how upstream answered with the host's health.
+        Args:
+            session (aiohttp.ClientSession): The session to send it through.
+            method (str): The request method.
+            url: The upstream url.
+            hedge (bool): Whether a slow request may be sent a second time, only for idempotent requests.
+            kwargs: Passed on to session.request().
+        Returns:
+            aiohttp.ClientResponse: The response with its headers read, the caller releases it.
+        Raises:
+            CircuitOpenError: If the host's circuit is open.
+            asyncio.TimeoutError: If upstream didn't answer with its headers within `headers_timeout` seconds.
+        Notes:
+            - Connection errors, timeouts and 502, 503 and 504 answers count as failures.
+            - Requests with a body aren't held to `headers_timeout`, sending the body is part of waiting for the headers.
+        """
+        health = self.Health(url)
+        if not health.Allow():
+            raise CircuitOpenError(health.host, health.RetryAfter())
+
+        health.requests += 1
+        health.hedge_tokens = min(health.hedge_tokens + self.hedge_max_ratio, HEDGE_BURST)
+        timeout = self.headers_timeout if kwargs.get("data") is None else None
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(self._send(session, method, url, health, hedge, kwargs), timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            health.Failed(f"{type(e).__name__}: {e}")
+            raise
+        except BaseException:
+            health.Abandoned()
+            raise
+
+        if response.status in FAILURE_STATUSES:
+            health.Failed(f"HTTP {response.status}")
+        else:
+            health.Succeeded(time.monotonic() - started)
+        return response
+
+    @contextlib.asynccontextmanager
+    async def Request(self, session: aiohttp.ClientSession, method: str, url, hedge: bool = False, **kwargs):
+        """
+        Send() as a context manager that releases the response, upstream breaking off the body counts as a failure too.
+        """
+        response = await self.Send(session, method, url, hedge, **kwargs)
+        try:
+            yield response
+        except UPSTREAM_BODY_ERRORS as e:
+            self.Health(url).Failed(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            response.release()
+
+    def Get(self, session: aiohttp.ClientSession, url, **kwargs):
+        """A hedged GET, as cache fills send them."""
+        return self.Request(session, "GET", url, hedge=True, **kwargs)
+
+    async def _send(self, session: aiohttp.ClientSession, method: str, url, health: UpstreamHealth, hedge: bool, kwargs) -> aiohttp.ClientResponse:
+        delay = self.HedgeDelay(health) if hedge else None
+        if delay is None:
+            return await session.request(method, url, **kwargs)
+
+        async def attempt():
+            return await session.request(method, url, **kwargs)
+
+        attempts = [asyncio.create_task(attempt())]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if not done and health.hedge_tokens >= 1:
+                health.hedge_tokens -= 1
+                health.hedges += 1
+                logger.debug(f"No answer for {url} after {1000 * delay:.0f}ms, hedging")
+                attempts.append(asyncio.create_task(attempt()))
+
+            pending = set(attempts)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in attempts if task in done and task.exception() is None), None)
+
+            if winner is None:
+                # every attempt failed, the first one's error is the one to report
+                return attempts[0].result()
+            if winner is not attempts[0]:
+                health.hedges_won += 1
+            return winner.result()
+        finally:
+            for task in attempts:
+                if task is not winner:
+                    _discard(task)
+
+    def OpenCircuits(self) -> int:
+        return sum(1 for health in self.hosts.values() if health.state != CLOSED)
+
+    def Stats(self):
+        return {
+            "failure_threshold": self.failure_threshold,
+            "open_seconds": self.open_seconds,
+            "headers_timeout": self.headers_timeout,
+            "hedge_percentile": self.hedge_percentile,
+            "hosts": [health.Stats() for health in self.hosts.values()],
+        }
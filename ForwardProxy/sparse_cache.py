@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import re
+import time
+
+from aiohttp import web
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+def requested_range(request: web.Request, total: int) -> tuple[int, int] | None:
+    """
+    Resolves the request's single byte range against an object of `total` bytes.
+    Returns:
+        tuple[int, int]: The half open [start, stop) span, or None when the whole object should be sent.
+    Raises:
+        web.HTTPRequestRangeNotSatisfiable: If the range lies outside the object.
+    Notes:
+        - Malformed, multi-part and If-Range conditioned ranges are ignored, which RFC 9110 allows.
+    """
+    if "Range" not in request.headers or "If-Range" in request.headers:
+        return None
+
+    try:
+        http_range = request.http_range
+    except ValueError:
+        return None
+
+    start, stop = http_range.start, http_range.stop
+    if start is None:
+        return None
+
+    if start < 0:
+        start, stop = max(total + start, 0), total
+    else:
+        stop = total if stop is None else min(stop, total)
+
+    if start >= stop:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{total}"})
+
+    return start, stop
+
+
+def upstream_range(request: web.Request, block_size: int) -> str | None:
+    """
+    Widens the client's range to whole blocks for the first request to upstream, when the object size isn't known yet.
+    """
+    try:
+        http_range = request.http_range
+    except ValueError:
+        return None
+
+    start, stop = http_range.start, http_range.stop
+    if start is None:
+        return None
+    if start < 0:
+        # a suffix can't be aligned without knowing the size
+        return f"bytes={start}"
+
+    first = start - start % block_size
+    if stop is None:
+        return f"bytes={first}-"
+    last = -(-stop // block_size) * block_size - 1
+    return f"bytes={first}-{last}"
+
+
+def parse_content_range(value: str | None) -> tuple[int, int, int] | None:
+    """
+    Parses a 206 Content-Range into (first byte, last byte, total), None when malformed or the total is unknown.
+    """
+    match = CONTENT_RANGE.fullmatch((value or "").strip())
+    if match is None or match.group(3) == "*":
+        return None
+    return int(match.group(1)), int(match.group(2)), int(match.group(3))
+
+
+@dataclasses.dataclass
+class PartialObject:
+    """
+    A cached object of which only some blocks have been downloaded, stored in a sparse file of its full size.
+    Notes:
+        - `present` holds one byte per block, a block only counts once it has been written completely.
+        - `fetching` maps the blocks an upstream range request is currently writing to a future resolved
+          when it is done, so concurrent readers wait for it instead of fetching the same bytes again.
+        - `validator` is the ETag or Last-Modified sent as If-Range, a changed object answers 200 instead of 206.
+    """
+    uri: str
+    cacheKey: str
+    path: str
+    total_size: int
+    block_size: int
+    headers: object
+    validator: str | None
+    expires_at: float
+    stale_while_revalidate: float
+    stale_if_error: float = 0.0
+    present: bytearray = None
+    fetching: dict = dataclasses.field(default_factory=dict)
+    missing: int = 0
+
+    def __post_init__(self):
+        if self.present is None:
+            self.present = bytearray(self.block_count)
+            self.missing = self.block_count
+
+    @property
+    def block_count(self) -> int:
+        return max(-(-self.total_size // self.block_size), 1)
+
+    def IsExpired(self) -> bool:
+        return time.time() >= self.expires_at
+
+    def IsComplete(self) -> bool:
+        return self.missing == 0
+
+    def BlockOf(self, offset: int) -> int:
+        return offset // self.block_size
+
+    def BlockStart(self, block: int) -> int:
+        return block * self.block_size
+
+    def BlockEnd(self, block: int) -> int:
+        return min((block + 1) * self.block_size, self.total_size)
+
+    def PresentUntil(self, offset: int, stop: int) -> int:
+        """
+        Returns how far from `offset` the bytes up to `stop` are on disk without a gap.
+        """
+        block = self.BlockOf(offset)
+        while block < self.block_count and self.present[block] and self.BlockStart(block) < stop:
+            block += 1
+        return min(self.BlockStart(block), stop) if block < self.block_count else stop
+
+    def MissingRun(self, offset: int, stop: int) -> tuple[int, int]:
+        """
+        Returns the run of blocks from the one holding `offset` that are neither on disk nor being fetched, up to `stop`.
+        """
+        first = block = self.BlockOf(offset)
+        last = self.BlockOf(stop - 1)
+        while block <= last and not self.present[block] and block not in self.fetching:
+            block += 1
+        return first, block - 1
+
+    def Claim(self, first: int, last: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        for block in range(first, last + 1):
+            self.fetching[block] = future
+        return future
+
+    def Release(self, first: int, last: int, future: asyncio.Future, error: BaseException | None = None):
+        for block in range(first, last + 1):
+            if self.fetching.get(block) is future:
+                del self.fetching[block]
+        if not future.done():
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def MarkWritten(self, start: int, end: int):
+        """
+        Marks the blocks completely covered by the bytes written in [start, end) as present.
+        """
+        block = self.BlockOf(start)
+        if self.BlockStart(block) < start:
+            block += 1
+        while block < self.block_count and self.BlockEnd(block) <= end:
+            if not self.present[block]:
+                self.present[block] = 1
+                self.missing -= 1
+            block += 1
+
+    def Stats(self):
+        return {"uri": self.uri, "total_size": self.total_size, "blocks_present": self.block_count - self.missing, "block_count": self.block_count}
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamPool:
+    """
+    The one aiohttp ClientSession the proxy talks to its upstreams through.
+    Connections are kept alive and DNS answers cached, with a total and a per-host connection limit
+    so a burst of misses queues in the pool instead of opening unbounded connections to one upstream.
+    Notes:
+        - The session only exists between Open() and Close(), which the application runs on startup and cleanup.
+        - Queue time for a free connection is measured through aiohttp's tracing signals.
+    """
+
+    def __init__(self, limit: int, limit_per_host: int, keepalive_timeout: float, dns_cache_ttl: int, connect_timeout: float, read_timeout: float):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        self.session: aiohttp.ClientSession | None = None
+
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.queued = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    async def Open(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True,
+        )
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_queued_start.append(self._on_queued_start)
+        trace_config.on_connection_queued_end.append(self._on_queued_end)
+        trace_config.on_connection_create_end.append(self._on_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_reuseconn)
+
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, trace_configs=[trace_config])
+        logger.info(f"Upstream pool opened, limit {self.limit} connections, {self.limit_per_host} per host")
+
+    async def Close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _on_queued_start(self, session, context, params):
+        context.queued_at = asyncio.get_running_loop().time()
+        self.queued += 1
+
+    async def _on_queued_end(self, session, context, params):
+        waited = asyncio.get_running_loop().time() - context.queued_at
+        self.queue_wait_total += waited
+        self.queue_wait_max = max(self.queue_wait_max, waited)
+
+    async def _on_create_end(self, session, context, params):
+        self.connections_created += 1
+
+    async def _on_reuseconn(self, session, context, params):
+        self.connections_reused += 1
+
+    def Stats(self):
+        connector = self.session.connector if self.session is not None else None
+        # the connector has no public accessors for its pool, read what is there defensively
+        in_use = len(getattr(connector, "_acquired", ()))
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+
+        return {
+            "in_use": in_use,
+            "idle": idle,
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "queued": self.queued,
+            "queue_wait_avg_ms": 1000 * self.queue_wait_total / self.queued if self.queued else 0.0,
+            "queue_wait_max_ms": 1000 * self.queue_wait_max,
+        }
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import time
+import uuid
+from collections import Counter
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` operations per second with bursts of up to one second's worth, 0 means unlimited.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = max(rate, 1.0)
+        self.updated = time.monotonic()
+
+    async def Wait(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, max(self.rate, 1.0))
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+@dataclasses.dataclass
+class WarmJob:
+    """
+    A batch of urls pulled into the cache through the proxy's fill path, with its progress.
+    Notes:
+        - `outcomes` counts the cache outcome per url, HIT for urls that were fresh already.
+        - Only the first `max_errors` failures are kept with their message, all of them are counted.
+    """
+    urls: list[str]
+    concurrency: int = 8
+    rate: float = 0
+    # fresh entries expiring sooner than this are refreshed instead of skipped
+    refresh_before: float = 0
+    name: str = "warm"
+    id: str = dataclasses.field(default_factory=lambda: uuid.uuid4().hex[:12])
+    status: str = "queued"
+    done: int = 0
+    failed: int = 0
+    outcomes: Counter = dataclasses.field(default_factory=Counter)
+    errors: list = dataclasses.field(default_factory=list)
+    max_errors: int = 20
+    created_time: float = dataclasses.field(default_factory=time.time)
+    started_time: float | None = None
+    finished_time: float | None = None
+    task: asyncio.Task | None = None
+
+    async def Run(self, warm_one):
+        """
+        Warms every url with at most `concurrency` in flight and `rate` started per second.
+        Args:
+            warm_one: Coroutine function taking a url and refresh_before, returning the cache outcome.
+        """
+        self.status = "running"
+        self.started_time = time.time()
+        limiter = RateLimiter(self.rate)
+        pending = iter(self.urls)
+
+        async def worker():
+            for url in pending:
+                await limiter.Wait()
+                try:
+                    outcome = await warm_one(url, self.refresh_before)
+                    self.outcomes[outcome] += 1
+                except Exception as e:
+                    self.failed += 1
+                    if len(self.errors) < self.max_errors:
+                        self.errors.append({"url": url, "error": f"{type(e).__name__}: {e}"})
+                self.done += 1
+
+        try:
+            await asyncio.gather(*[worker() for _ in range(max(min(self.concurrency, len(self.urls)), 1))])
+            self.status = "finished"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+            raise
+        finally:
+            self.finished_time = time.time()
+
+    def Stats(self):
+        elapsed = (self.finished_time or time.time()) - self.started_time if self.started_time else 0.0
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "total": len(self.urls),
+            "done": self.done,
+            "failed": self.failed,
+            "progress": self.done / len(self.urls) if self.urls else 1.0,
+            "outcomes": dict(self.outcomes),
+            "errors": self.errors,
+            "concurrency": self.concurrency,
+            "rate": self.rate,
+            "elapsed": round(elapsed, 3),
+            "urls_per_second": round(self.done / elapsed, 2) if elapsed else 0.0,
+        }
@@ -0,0 +1,313 @@
+"""
+Offline benchmarks of the caching proxy and tinystatus against a local fake origin.
+
+The proxy runs in this process from ForwardProxy/FF_caching_proxy.py's init_app with a throwaway cache directory,
+or --proxy points the scenarios at a proxy started separately, e.g. with FFPROXY_WORKERS > 1.
+Load is generated with caller.py on the same event loop, so absolute numbers include the client's share
+of the CPU; compare runs of the same scenarios on the same machine.
+
+    python benchmarks/bench.py --label main --output results/main.json
+    python benchmarks/bench.py --scenarios hot_hits,miss_storm --duration 10
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+PROXY_DIR = os.path.join(REPO_DIR, "ForwardProxy")
+TINYSTATUS_DIR = os.path.join(REPO_DIR, "tinystatus")
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import caller
+from fake_origin import FakeOrigin, start_site
+
+logger = logging.getLogger("bench")
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return round(resident_pages * os.sysconf("SC_PAGE_SIZE") / 1e6, 1)
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3, 1)
+
+
+def load_args(uri: str, proxy: str, **options) -> argparse.Namespace:
+    """The options caller.py's load functions read, for a run driven from here."""
+    defaults = {
+        "uri": uri,
+        "proxy": proxy,
+        "method": "GET",
+        "num_calls": None,
+        "concurrency": 1,
+        "keys": 1,
+        "sizes": [],
+        "throttle_time": 0,
+        "verbose": False,
+        "out": sys.stdout,
+    }
+    return argparse.Namespace(**{**defaults, **options})
+
+
+class BenchContext:
+    """What a scenario runs against: the fake origin, the proxy url and a client session."""
+
+    def __init__(self, origin: FakeOrigin, origin_url: str, proxy_url: str, session: aiohttp.ClientSession, args):
+        self.origin = origin
+        self.origin_url = origin_url
+        self.proxy_url = proxy_url
+        self.session = session
+        self.args = args
+        # keeps urls of repeated runs against a long lived proxy from hitting each other's entries
+        self.run_id = uuid.uuid4().hex[:8]
+
+    def Url(self, path: str) -> str:
+        return f"{self.origin_url}{path}"
+
+
+async def scenario_miss_storm(ctx: BenchContext) -> dict:
+    """Many clients ask for one uncached key at once, a single request should reach the origin."""
+    clients = ctx.args.storm_clients
+    url = ctx.Url(f"/obj/storm-{ctx.run_id}?latency=200&size=16384")
+    before = ctx.origin.requests["object"]
+
+    stats = caller.LoadStats()
+    args = load_args(url, ctx.proxy_url, num_calls=clients, concurrency=clients)
+    await caller.run_closed_loop(ctx.session, args, caller.KeyPicker(1, 0), stats, None)
+    stats.finished = time.monotonic()
+    return {**stats.Summary(), "origin_requests": ctx.origin.requests["object"] - before}
+
+
+async def scenario_hot_hits(ctx: BenchContext) -> dict:
+    """Small objects served from the cache after one warming pass, the proxy's best case."""
+    keys = 100
+    uri = ctx.Url(f"/obj/hot-{ctx.run_id}-{{key}}?size=1024")
+    args = load_args(uri, ctx.proxy_url, keys=keys, concurrency=ctx.args.concurrency)
+    warm_stats = caller.LoadStats()
+    for key in range(keys):
+        await caller.make_http_call(ctx.session, caller.build_url(uri, key, keys, []), args, warm_stats, time.monotonic())
+
+    stats = caller.LoadStats()
+    deadline = time.monotonic() + ctx.args.duration
+    await caller.run_closed_loop(ctx.session, args, caller.KeyPicker(keys, 0, seed=1), stats, deadline)
+    stats.finished = time.monotonic()
+    return stats.Summary()
+
+
+async def scenario_large_stream(ctx: BenchContext) -> dict:
+    """A large object streamed to several clients at once, starting from a miss."""
+    url = ctx.Url(f"/obj/large-{ctx.run_id}?size={ctx.args.large_size}")
+    stats = caller.LoadStats()
+    args = load_args(url, ctx.proxy_url, num_calls=ctx.args.large_requests, concurrency=8)
+    await caller.run_closed_loop(ctx.session, args, caller.KeyPicker(1, 0), stats, None)
+    stats.finished = time.monotonic()
+    return stats.Summary()
+
+
+async def scenario_post_then_get(ctx: BenchContext) -> dict:
+    """
+    Payloads uploaded through the proxy, which keeps a copy under the url the origin answers with,
+    then fetched from that url, every GET should be a hit.
+    """
+    payload = ctx.origin.Body(64 * 1024)
+    post_stats = caller.LoadStats()
+    urls = []
+    for _ in range(ctx.args.uploads):
+        started = time.monotonic()
+        try:
+            async with ctx.session.post(ctx.Url("/upload"), data=payload, proxy=ctx.proxy_url) as response:
+                body = await response.text()
+                post_stats.Record(time.monotonic() - started, response.status,
+                                  response.headers.get(caller.CACHE_HEADER), len(body))
+                if response.status == 200:
+                    urls.append(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            post_stats.RecordError(time.monotonic() - started, e)
+    post_stats.finished = time.monotonic()
+
+    get_stats = caller.LoadStats()
+    args = load_args("", ctx.proxy_url)
+    for url in urls:
+        await caller.make_http_call(ctx.session, url, args, get_stats, time.monotonic())
+    get_stats.finished = time.monotonic()
+    return {"post": post_stats.Summary(), "get": get_stats.Summary()}
+
+
+async def scenario_tinystatus_rounds(ctx: BenchContext) -> dict:
+    """Rounds of tinystatus checks over thousands of fake services, a tenth of them failing."""
+    if TINYSTATUS_DIR not in sys.path:
+        sys.path.insert(0, TINYSTATUS_DIR)
+    import tinystatus
+
+    checks = []
+    for i in range(ctx.args.checks):
+        if i % 10 == 0:
+            checks.append({"name": f"port-{i}", "type": "port", "host": "127.0.0.1", "port": 1})
+        else:
+            checks.append({"name": f"http-{i}", "type": "http", "expected_code": 200,
+                           "host": ctx.Url("/health?latency=20")})
+
+    durations = []
+    up = 0
+    try:
+        for _ in range(ctx.args.rounds):
+            started = time.monotonic()
+            results = await tinystatus.run_checks(checks)
+            durations.append(round(time.monotonic() - started, 3))
+            up = sum(1 for result in results if result["status"])
+    finally:
+        await tinystatus.close_http_session()
+
+    return {
+        "checks": len(checks),
+        "rounds": len(durations),
+        "round_seconds": durations,
+        "checks_per_second": round(len(checks) * len(durations) / sum(durations), 1) if durations else 0.0,
+        "up": up,
+    }
+
+
+SCENARIOS = {
+    "miss_storm": scenario_miss_storm,
+    "hot_hits": scenario_hot_hits,
+    "large_stream": scenario_large_stream,
+    "post_then_get": scenario_post_then_get,
+    "tinystatus_rounds": scenario_tinystatus_rounds,
+}
+
+
+def import_proxy(cache_dir: str):
+    """
+    Imports FF_caching_proxy configured for a throwaway cache, its settings are read at import time.
+    The working directory moves to ForwardProxy, templates and static files are looked up relative to it.
+    """
+    os.environ["FFPROXY_CACHE_PATH"] = cache_dir
+    os.environ["FFPROXY_STARTUP_MODE"] = "clean"
+    os.environ.pop("FFPROXY_WORKER_ID", None)
+    os.chdir(PROXY_DIR)
+    if PROXY_DIR not in sys.path:
+        sys.path.insert(0, PROXY_DIR)
+    import FF_caching_proxy
+    return FF_caching_proxy
+
+
+async def run_benchmarks(args) -> dict:
+    origin = FakeOrigin(latency=args.origin_latency / 1000, failure_rate=args.failure_rate)
+    origin_runner, origin_url = await start_site(origin.App())
+
+    proxy_runner = None
+    cache_dir = None
+    proxy_url = args.proxy
+    if proxy_url is None:
+        cache_dir = tempfile.mkdtemp(prefix="ffproxy-bench-")
+        proxy = import_proxy(cache_dir)
+        proxy_runner, proxy_url = await start_site(await proxy.init_app(), access_log_class=proxy.MetricsAccessLogger)
+    logging.getLogger().setLevel(args.log_level)
+
+    results = {}
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=120)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False) as session:
+            ctx = BenchContext(origin, origin_url, proxy_url, session, args)
+            for name in args.scenarios:
+                logger.warning(f"Running {name}")
+                started = time.monotonic()
+                result = await SCENARIOS[name](ctx)
+                result["wall_seconds"] = round(time.monotonic() - started, 3)
+                result["rss_mb"] = rss_mb()
+                result["peak_rss_mb"] = peak_rss_mb()
+                results[name] = result
+    finally:
+        if proxy_runner is not None:
+            await proxy_runner.cleanup()
+        await origin_runner.cleanup()
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    return {
+        "label": args.label,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "proxy": "in-process" if args.proxy is None else args.proxy,
+        "scenarios": results,
+    }
+
+
+def print_summary(report: dict):
+    for name, result in report["scenarios"].items():
+        if "latency_ms" in result:
+            latency = result["latency_ms"]
+            line = (f"{result['throughput_rps']} req/s, {result['bytes_per_second'] / 1e6:.1f} MB/s, "
+                    f"p50 {latency['p50']} ms, p99 {latency['p99']} ms, p99.9 {latency['p99.9']} ms, "
+                    f"hit ratio {result['hit_ratio']:.1%}")
+            if "origin_requests" in result:
+                line += f", origin requests {result['origin_requests']}"
+        elif "get" in result:
+            line = (f"POST p50 {result['post']['latency_ms']['p50']} ms, "
+                    f"GET p50 {result['get']['latency_ms']['p50']} ms, GET outcomes {result['get']['cache_outcomes']}")
+        else:
+            line = f"{result['checks']} checks, rounds {result['round_seconds']} s, {result['up']} up"
+        print(f"{name}: {line}, rss {result['rss_mb']} MB")
+
+
+def parse_scenarios(value: str) -> list[str]:
+    names = [name for name in value.split(",") if name]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown scenarios {', '.join(unknown)}, choose from {', '.join(SCENARIOS)}")
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the caching proxy and tinystatus against a local fake origin.")
+    parser.add_argument("--scenarios", type=parse_scenarios, default=list(SCENARIOS), help=f"Comma separated, from {', '.join(SCENARIOS)}.")
+    parser.add_argument("--proxy", type=str, default=None, help="Benchmark a running proxy instead of one started in-process.")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds of load for the hot_hits scenario.")
+    parser.add_argument("--concurrency", type=int, default=64, help="Requests in flight for the hot_hits scenario.")
+    parser.add_argument("--storm_clients", type=int, default=200, help="Concurrent requests of the miss_storm scenario.")
+    parser.add_argument("--large_size", type=int, default=32 * 1024 * 1024, help="Object size of the large_stream scenario.")
+    parser.add_argument("--large_requests", type=int, default=32, help="Requests of the large_stream scenario.")
+    parser.add_argument("--uploads", type=int, default=200, help="Uploads of the post_then_get scenario.")
+    parser.add_argument("--checks", type=int, default=2000, help="Checks per round of the tinystatus_rounds scenario.")
+    parser.add_argument("--rounds", type=int, default=3, help="Rounds of the tinystatus_rounds scenario.")
+    parser.add_argument("--origin_latency", type=float, default=0, help="Origin latency in ms, scenarios may override it.")
+    parser.add_argument("--failure_rate", type=float, default=0, help="Share of origin responses failing with 503.")
+    parser.add_argument("--label", type=str, default=None, help="Name of the build under test, stored with the results.")
+    parser.add_argument("--output", type=str, default=None, help="Write the results as JSON to this file.")
+    parser.add_argument("--log_level", type=str, default="WARNING", help="Log level of the in-process proxy.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    output = os.path.abspath(args.output) if args.output else None
+
+    report = asyncio.run(run_benchmarks(args))
+    print_summary(report)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
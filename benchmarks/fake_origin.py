@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import random
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+# bodies are slices of one random buffer, so nothing compresses them and serving them allocates nothing new
+BODY_POOL_SIZE = 64 * 1024 * 1024
+
+
+@dataclasses.dataclass
+class FakeOrigin:
+    """
+    A local upstream for the benchmarks, with configurable latency, body sizes, cache headers and failures.
+    Per request overrides come from the query string: size, latency (ms), max_age and fail (probability).
+    Notes:
+        - `requests` counts the requests per route, the miss storm scenario reads how many reached the origin.
+        - Uploads are kept in memory so a GET of the url a POST returned gets the same body back.
+    """
+    latency: float = 0.0
+    jitter: float = 0.0
+    size: int = 1024
+    max_age: int = 3600
+    failure_rate: float = 0.0
+    seed: int = 0
+    requests: Counter = dataclasses.field(default_factory=Counter)
+    uploads: dict = dataclasses.field(default_factory=dict)
+
+    def __post_init__(self):
+        self.random = random.Random(self.seed)
+        self.pool = self.random.randbytes(BODY_POOL_SIZE)
+
+    def Body(self, size: int) -> bytes:
+        if size <= BODY_POOL_SIZE:
+            return self.pool[:size]
+        return (self.pool * (size // BODY_POOL_SIZE + 1))[:size]
+
+    async def _delay(self, request):
+        latency = float(request.query["latency"]) / 1000 if "latency" in request.query else self.latency
+        if self.jitter:
+            latency += self.random.uniform(0, self.jitter)
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def _should_fail(self, request) -> bool:
+        failure_rate = float(request.query.get("fail", self.failure_rate))
+        return failure_rate > 0 and self.random.random() < failure_rate
+
+    async def get_object(self, request):
+        self.requests["object"] += 1
+        await self._delay(request)
+        if self._should_fail(request):
+            return web.Response(status=503, text="Injected failure")
+
+        size = int(request.query.get("size", self.size))
+        max_age = int(request.query.get("max_age", self.max_age))
+        headers = {"Cache-Control": f"max-age={max_age}" if max_age > 0 else "no-store"}
+        return web.Response(body=self.Body(size), content_type="application/octet-stream", headers=headers)
+
+    async def post_upload(self, request):
+        self.requests["upload"] += 1
+        await self._delay(request)
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = await request.read()
+        return web.Response(text=f"http://{request.host}/uploads/{upload_id}")
+
+    async def get_upload(self, request):
+        self.requests["upload_get"] += 1
+        body = self.uploads.get(request.match_info["upload_id"])
+        if body is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=body, content_type="application/octet-stream",
+                            headers={"Cache-Control": f"max-age={self.max_age}"})
+
+    async def get_health(self, request):
+        self.requests["health"] += 1
+        await self._delay(request)
+        if self._should_fail(request):
+            return web.Response(status=503, text="Injected failure")
+        return web.Response(text="ok")
+
+    def App(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/obj/{key}", self.get_object)
+        app.router.add_post("/upload", self.post_upload)
+        app.router.add_get("/uploads/{upload_id}", self.get_upload)
+        app.router.add_get("/health", self.get_health)
+        return app
+
+
+async def start_site(app: web.Application, **runner_options) -> tuple[web.AppRunner, str]:
+    """
+    Serves app on a free local port.
+    Returns:
+        tuple[web.AppRunner, str]: The runner to clean up and the base url it listens on.
+    """
+    runner = web.AppRunner(app, **runner_options)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
@@ -1,53 +1,283 @@
+from __future__ import annotations
+
 import argparse
+import asyncio
+import json
+import math
+import random
+import sys
 import time
-import requests
+from collections import Counter
+from datetime import datetime, timezone
+
+import aiohttp
+
+CACHE_HEADER = "X-FFPROXY-Cache"
+# outcomes that didn't cost a download of their own: the ones the proxy answers from the cache,
+# plus COALESCED, a request that joined another one's upstream fill
+CACHE_HIT_OUTCOMES = ("HIT", "STALE", "REVALIDATED", "STALE_IF_ERROR", "COALESCED")
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class KeyPicker:
+    """
+    Picks which of `keys` urls the next request goes to, Zipf distributed with exponent `zipf` so a few keys
+    are hot and the long tail is mostly cold, 0 picks uniformly.
+    """
+
+    def __init__(self, keys: int, zipf: float, seed: int | None = None):
+        self.keys = list(range(keys))
+        self.random = random.Random(seed)
+        self.cum_weights = None
+        if zipf > 0:
+            total = 0.0
+            self.cum_weights = []
+            for rank in range(1, keys + 1):
+                total += 1 / rank ** zipf
+                self.cum_weights.append(total)
+
+    def Next(self) -> int:
+        if self.cum_weights is None:
+            return self.random.randrange(len(self.keys))
+        return self.random.choices(self.keys, cum_weights=self.cum_weights)[0]
+
+
+def build_url(uri: str, key: int, keys: int, sizes: list[int]) -> str:
+    """
+    Fills {key} and {size} in uri, or appends them as query parameters when uri has no placeholders.
+    Every key keeps the same size, so a cached object never changes size between requests.
+    """
+    size = sizes[key % len(sizes)] if sizes else None
+    if "{key}" in uri or "{size}" in uri:
+        return uri.replace("{key}", str(key)).replace("{size}", str(size or 0))
+
+    params = []
+    if keys > 1:
+        params.append(f"key={key}")
+    if size is not None:
+        params.append(f"size={size}")
+    if not params:
+        return uri
+    return uri + ("&" if "?" in uri else "?") + "&".join(params)
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(max(math.ceil(p / 100 * len(sorted_values)) - 1, 0), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class LoadStats:
+    """
+    Per request results of a run, summarised once it is over.
+    """
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.statuses = Counter()
+        self.outcomes = Counter()
+        self.errors = Counter()
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def Record(self, latency: float, status: int, outcome: str | None, size: int):
+        self.latencies.append(latency)
+        self.statuses[status] += 1
+        self.outcomes[outcome or "NONE"] += 1
+        self.bytes += size
+
+    def RecordError(self, latency: float, error: Exception):
+        self.latencies.append(latency)
+        self.errors[type(error).__name__] += 1
+
+    def Summary(self) -> dict:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        latencies = sorted(self.latencies)
+        completed = sum(self.statuses.values())
+        hits = sum(self.outcomes[outcome] for outcome in CACHE_HIT_OUTCOMES)
+        return {
+            "requests": len(latencies),
+            "completed": completed,
+            "errors": dict(self.errors),
+            "elapsed": round(elapsed, 3),
+            "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+            "bytes": self.bytes,
+            "bytes_per_second": round(self.bytes / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": {
+                **{f"p{p:g}": round(percentile(latencies, p) * 1000, 3) for p in PERCENTILES},
+                "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+                "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            },
+            "status_codes": {str(status): count for status, count in sorted(self.statuses.items())},
+            "cache_outcomes": dict(self.outcomes.most_common()),
+            "hit_ratio": round(hits / completed, 4) if completed else 0.0,
+        }
+
+
+async def make_http_call(session: aiohttp.ClientSession, url: str, args, stats: LoadStats, scheduled: float):
+    """
+    Sends one request and reads the body to the end.
+    Latency counts from `scheduled`, in open loop mode a request the generator couldn't start on time
+    is charged for the wait instead of hiding it.
+    """
+    try:
+        async with session.request(args.method, url, proxy=args.proxy or None) as response:
+            size = 0
+            async for chunk in response.content.iter_chunked(65536):
+                size += len(chunk)
+            stats.Record(time.monotonic() - scheduled, response.status, response.headers.get(CACHE_HEADER), size)
+            if args.verbose:
+                print(f"{args.method} {url} {response.status} {response.headers.get(CACHE_HEADER)} {size} bytes", file=args.out)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        stats.RecordError(time.monotonic() - scheduled, e)
+        if args.verbose:
+            print(f"{args.method} {url} failed: {type(e).__name__}: {e}", file=args.out)
+
 
+def next_url(args, picker: KeyPicker) -> str:
+    return build_url(args.uri, picker.Next(), args.keys, args.sizes)
 
 
-def make_http_call(uri, proxy, throttle_time, num_calls):
-    proxies = {
-        "http": proxy,
-        "https": proxy,
+async def run_closed_loop(session, args, picker: KeyPicker, stats: LoadStats, deadline: float | None):
+    """Keeps `concurrency` requests in flight, each worker sends its next request when the last one finished."""
+    remaining = args.num_calls
+
+    async def worker():
+        nonlocal remaining
+        while remaining is None or remaining > 0:
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            if remaining is not None:
+                remaining -= 1
+            await make_http_call(session, next_url(args, picker), args, stats, time.monotonic())
+            if args.throttle_time:
+                await asyncio.sleep(args.throttle_time)
+
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+
+
+async def run_open_loop(session, args, picker: KeyPicker, stats: LoadStats, deadline: float | None):
+    """
+    Starts requests at `rate` per second whether or not earlier ones finished, at most `concurrency` in flight.
+    """
+    semaphore = asyncio.Semaphore(args.concurrency)
+    tasks = set()
+    started = time.monotonic()
+    sent = 0
+
+    async def send(url, scheduled):
+        async with semaphore:
+            await make_http_call(session, url, args, stats, scheduled)
+
+    while args.num_calls is None or sent < args.num_calls:
+        scheduled = started + sent / args.rate
+        if deadline is not None and scheduled >= deadline:
+            break
+        # sleeps at least a tick, so requests already due get sent while the generator is behind schedule
+        await asyncio.sleep(max(scheduled - time.monotonic(), 0))
+        task = asyncio.create_task(send(next_url(args, picker), scheduled))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        sent += 1
+
+    if tasks:
+        await asyncio.gather(*tasks)
+
+
+async def run_load(args) -> dict:
+    picker = KeyPicker(args.keys, args.zipf, args.seed)
+    connector = aiohttp.TCPConnector(limit=args.concurrency, force_close=args.no_keepalive)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False) as session:
+        if args.warmup:
+            warmup_args = argparse.Namespace(**{**vars(args), "num_calls": None, "verbose": False})
+            await run_closed_loop(session, warmup_args, picker, LoadStats(), time.monotonic() + args.warmup)
+
+        stats = LoadStats()
+        deadline = time.monotonic() + args.duration if args.duration else None
+        if args.rate:
+            await run_open_loop(session, args, picker, stats, deadline)
+        else:
+            await run_closed_loop(session, args, picker, stats, deadline)
+        stats.finished = time.monotonic()
+
+    return {
+        "label": args.label,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "uri": args.uri,
+            "proxy": args.proxy,
+            "method": args.method,
+            "mode": "open" if args.rate else "closed",
+            "rate": args.rate,
+            "concurrency": args.concurrency,
+            "num_calls": args.num_calls,
+            "duration": args.duration,
+            "keys": args.keys,
+            "zipf": args.zipf,
+            "sizes": args.sizes,
+        },
+        "results": stats.Summary(),
     }
-    
-    for _ in range(num_calls):
-        try:
-            print(f"Making request to {uri} with proxy {proxy}")
-          
-            # Prepare the request
-            req = requests.Request('GET', uri)
-            prepared = req.prepare()
-            
-            # Send the prepared request
-            session = requests.Session()
-            response = session.send(prepared, proxies=proxies)
-            
-            # Output the actual request text
-            request_text = f"{prepared.method} {prepared.url} HTTP/1.1\r\n" + \
-                           "\r\n".join(f"{k}: {v}" for k, v in prepared.headers.items()) + \
-                           "\r\n\r\n" + (prepared.body or "")
-            print(f"Request sent to proxy:\n{request_text}")
-            
-            # Print the response
-            print(f"Status Code: {response.status_code}")
-            print(f"Response: {response.text}")
-            print(f"Status Code: {response.status_code}")
-            print(f"Response: {response.text}")
-        except requests.exceptions.RequestException as e:
-            print(f"An error occurred: {e}")
-        
-        time.sleep(throttle_time)
+
+
+def print_summary(report: dict, file=None):
+    results = report["results"]
+    latency = results["latency_ms"]
+    print(f"{results['requests']} requests in {results['elapsed']}s, {results['throughput_rps']} req/s, "
+          f"{results['bytes_per_second'] / 1e6:.2f} MB/s", file=file)
+    print("latency ms: " + ", ".join(f"{name} {value}" for name, value in latency.items()), file=file)
+    print(f"status codes: {results['status_codes']}", file=file)
+    print(f"cache outcomes: {results['cache_outcomes']}, hit ratio {results['hit_ratio']:.2%}", file=file)
+    if results["errors"]:
+        print(f"errors: {results['errors']}", file=file)
+
+
+def parse_sizes(value: str) -> list[int]:
+    return [int(size) for size in value.split(",") if size]
+
 
 def main():
-    parser = argparse.ArgumentParser(description="Make an HTTP call using a proxy.")
-    parser.add_argument("--uri", type=str, help="The URI to call.", required=False, default="http://localhost:8000/tinystatus")
-    parser.add_argument("--proxy", type=str, help="The proxy to use for the HTTP call.", required=False, default="http://localhost:8080")
-    parser.add_argument("--num_calls", type=int, help="The number of times to call the URI.", required=False, default=1)
-    parser.add_argument("--throttle_time", type=int, help="The time to throttle between calls (in seconds).", required=False, default=1)
-    
+    parser = argparse.ArgumentParser(description="Generate load through the caching proxy and report latency and hit ratio.")
+    parser.add_argument("--uri", type=str, help="The URI to call, {key} and {size} are filled per request.", required=False, default="http://localhost:8000/tinystatus")
+    parser.add_argument("--proxy", type=str, help="The proxy to use for the HTTP calls, empty to call the URI directly.", required=False, default="http://localhost:8080")
+    parser.add_argument("--method", type=str, help="The HTTP method.", required=False, default="GET")
+    parser.add_argument("--num_calls", type=int, help="The number of requests to send, unlimited with --duration.", required=False, default=None)
+    parser.add_argument("--duration", type=float, help="Seconds to generate load for.", required=False, default=None)
+    parser.add_argument("--concurrency", type=int, help="Requests in flight, the upper bound in open loop mode.", required=False, default=1)
+    parser.add_argument("--rate", type=float, help="Target requests per second, switches to open loop mode.", required=False, default=None)
+    parser.add_argument("--keys", type=int, help="The number of distinct URLs to spread requests over.", required=False, default=1)
+    parser.add_argument("--zipf", type=float, help="Zipf exponent of the key popularity, 0 for uniform.", required=False, default=0.0)
+    parser.add_argument("--sizes", type=parse_sizes, help="Comma separated object sizes in bytes, assigned round robin to keys.", required=False, default=[])
+    parser.add_argument("--seed", type=int, help="Seed of the key picker, for repeatable runs.", required=False, default=None)
+    parser.add_argument("--warmup", type=float, help="Seconds of unrecorded load before measuring.", required=False, default=0)
+    parser.add_argument("--timeout", type=float, help="Timeout per request in seconds.", required=False, default=30)
+    parser.add_argument("--throttle_time", type=float, help="The time to wait between calls of a worker (in seconds).", required=False, default=0)
+    parser.add_argument("--no_keepalive", action="store_true", help="Open a new connection per request.")
+    parser.add_argument("--label", type=str, help="Name of the build under test, stored with the results.", required=False, default=None)
+    parser.add_argument("--output", type=str, help="Write the results as JSON to this file, - for stdout.", required=False, default=None)
+    parser.add_argument("--verbose", action="store_true", help="Print every request.")
+
     args = parser.parse_args()
-    
-    make_http_call(args.uri, args.proxy, args.throttle_time, args.num_calls)
+    if args.num_calls is None and args.duration is None:
+        args.num_calls = 1
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate has to be positive")
+    # with the report on stdout everything else goes to stderr, so stdout stays valid JSON
+    args.out = sys.stderr if args.output == "-" else sys.stdout
+
+    report = asyncio.run(run_load(args))
+    print_summary(report, file=args.out)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
 
-if __name__ == "__main__":   
-    main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
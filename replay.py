@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+import zlib
+from datetime import datetime, timezone
+
+import aiofiles
+import aiohttp
+from yarl import URL
+
+from caller import CACHE_HEADER, LoadStats, print_summary
+
+READ_SIZE = 1024 * 1024
+# zlib's window bits for a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class RequestLog:
+    """
+    Reads the requests of a JSON lines log one at a time through aiofiles, so a log of any size is replayed
+    in constant memory and reading it never blocks the loop that schedules the requests.
+    Notes:
+        - A .gz log is decompressed chunk by chunk as it is read, concatenated gzip members included.
+        - Lines that aren't JSON or lack a method or absolute url are skipped and counted in `skipped`.
+    """
+
+    def __init__(self, path: str, methods: set[str], limit: int | None = None):
+        self.path = path
+        self.methods = methods
+        self.limit = limit
+        self.skipped = 0
+        self.decompressor = zlib.decompressobj(wbits=GZIP_WBITS) if path.endswith(".gz") else None
+
+    def _inflate(self, data: bytes) -> bytes:
+        inflated = []
+        while data:
+            inflated.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            # the next gzip member, as appending to a compressed log leaves them
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(wbits=GZIP_WBITS)
+        return b"".join(inflated)
+
+    async def Lines(self):
+        pending = b""
+        async with aiofiles.open(self.path, "rb") as f:
+            while chunk := await f.read(READ_SIZE):
+                if self.decompressor is not None:
+                    chunk = self._inflate(chunk)
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    yield line
+        if pending:
+            yield pending
+
+    async def Records(self):
+        yielded = 0
+        async for line in self.Lines():
+            if self.limit is not None and yielded >= self.limit:
+                break
+            try:
+                record = json.loads(line)
+                method = record["method"].upper()
+                url = URL(record["url"])
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self.skipped += 1
+                continue
+            if not url.is_absolute():
+                self.skipped += 1
+                continue
+            if method not in self.methods:
+                continue
+            record["method"] = method
+            yielded += 1
+            yield record
+
+
+def rewrite_origin(url: str, origin: URL | None) -> str:
+    """Points a logged url at another origin, keeping its path and query."""
+    if origin is None:
+        return url
+    return str(URL(url).with_scheme(origin.scheme).with_host(origin.host).with_port(origin.explicit_port))
+
+
+async def replay_request(session: aiohttp.ClientSession, record: dict, args, stats: LoadStats, scheduled: float):
+    """
+    Sends one logged request with the headers it was logged with and a body of its logged size.
+    Latency counts from `scheduled`, requests started late because the replay fell behind are charged for it.
+    """
+    url = rewrite_origin(record["url"], args.origin)
+    body = b"\0" * record["body_size"] if record.get("body_size") else None
+    try:
+        async with session.request(record["method"], url, headers=record.get("headers"), data=body,
+                                   proxy=args.proxy or None, allow_redirects=False) as response:
+            size = 0
+            async for chunk in response.content.iter_chunked(65536):
+                size += len(chunk)
+            stats.Record(time.monotonic() - scheduled, response.status, response.headers.get(CACHE_HEADER), size)
+            if args.verbose:
+                print(f"{record['method']} {url} {response.status} {response.headers.get(CACHE_HEADER)} {size} bytes", file=args.out)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        stats.RecordError(time.monotonic() - scheduled, e)
+        if args.verbose:
+            print(f"{record['method']} {url} failed: {type(e).__name__}: {e}", file=args.out)
+
+
+async def replay(args) -> dict:
+    """
+    Replays the log with its original inter-arrival times divided by `speed`, or back to back with speed 0,
+    never more than `concurrency` requests in flight.
+    """
+    stats = LoadStats()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    tasks = set()
+    max_lag = 0.0
+    log = RequestLog(args.log, set(args.methods), args.limit)
+
+    async def send(record, scheduled):
+        try:
+            await replay_request(session, record, args, stats, scheduled)
+        finally:
+            semaphore.release()
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False) as session:
+        first_ts = None
+        started = time.monotonic()
+        async for record in log.Records():
+            if args.speed > 0:
+                ts = float(record.get("ts", 0))
+                if first_ts is None:
+                    first_ts = ts
+                scheduled = started + max(ts - first_ts, 0) / args.speed
+                await asyncio.sleep(max(scheduled - time.monotonic(), 0))
+            else:
+                scheduled = time.monotonic()
+
+            # the reader waits here when the target can't keep up, so pending requests don't pile up in memory
+            await semaphore.acquire()
+            max_lag = max(max_lag, time.monotonic() - scheduled)
+            task = asyncio.create_task(send(record, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+    stats.finished = time.monotonic()
+
+    return {
+        "label": args.label,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "log": args.log,
+            "proxy": args.proxy,
+            "origin": str(args.origin) if args.origin else None,
+            "speed": args.speed,
+            "concurrency": args.concurrency,
+            "methods": args.methods,
+            "limit": args.limit,
+        },
+        "results": {**stats.Summary(), "skipped_lines": log.skipped, "max_lag": round(max_lag, 3)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a JSON lines request log, as written with FFPROXY_ACCESS_LOG, through the proxy.")
+    parser.add_argument("log", type=str, help="The request log, .gz logs are read compressed.")
+    parser.add_argument("--proxy", type=str, help="The proxy to replay through, empty to call the urls directly.", required=False, default="http://localhost:8080")
+    parser.add_argument("--speed", type=float, help="Time compression of the original timing, 2 replays twice as fast, 0 as fast as possible.", required=False, default=1.0)
+    parser.add_argument("--concurrency", type=int, help="Requests in flight at most.", required=False, default=64)
+    parser.add_argument("--methods", type=lambda value: [method.upper() for method in value.split(",") if method], help="Comma separated methods to replay.", required=False, default=["GET", "HEAD"])
+    parser.add_argument("--origin", type=URL, help="Send the requests to this origin instead of the logged one, e.g. a staging copy.", required=False, default=None)
+    parser.add_argument("--limit", type=int, help="Replay at most this many requests.", required=False, default=None)
+    parser.add_argument("--timeout", type=float, help="Timeout per request in seconds.", required=False, default=30)
+    parser.add_argument("--label", type=str, help="Name of the build or cache policy under test, stored with the results.", required=False, default=None)
+    parser.add_argument("--output", type=str, help="Write the results as JSON to this file, - for stdout.", required=False, default=None)
+    parser.add_argument("--verbose", action="store_true", help="Print every request.")
+
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("--speed can't be negative")
+    # with the report on stdout everything else goes to stderr, so stdout stays valid JSON
+    args.out = sys.stderr if args.output == "-" else sys.stdout
+
+    report = asyncio.run(replay(args))
+    print_summary(report, file=args.out)
+    print(f"skipped lines: {report['results']['skipped_lines']}, max lag behind schedule: {report['results']['max_lag']}s", file=args.out)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
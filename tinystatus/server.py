@@ -1,43 +1,154 @@
-from tinystatus.tinystatus import main, monitor_services
-import threading
 import asyncio
-import http.server
-import socketserver
+import email.utils
 import logging
+import os
+import time
 
-PORT = 8000
+from aiohttp import web
+
+try:
+    from tinystatus.tinystatus import (CHECK_INTERVAL, CheckScheduler, HistoryStore, RenderedPage,
+                                       monitor_services, pages)
+except ImportError:
+    # started from inside the tinystatus directory, as in the docker image
+    from tinystatus import CHECK_INTERVAL, CheckScheduler, HistoryStore, RenderedPage, monitor_services, pages
+
+PORT = int(os.getenv('PORT', 8000))
+# seconds browsers and proxies in front may reuse a page before asking again
+CACHE_MAX_AGE = int(os.getenv('CACHE_MAX_AGE', 10))
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Run the main function to generate initial status page
+# url path to the page rendered by the monitor
+PAGE_ROUTES = {
+    '/': 'index.html',
+    '/tinystatus': 'index.html',
+    '/index.html': 'index.html',
+    '/history': 'history.html',
+    '/history.html': 'history.html',
+}
+ROLLUP_DAYS = {'hour': 7, 'day': 90}
 
+# set up by monitor_ctx, the monitor and the API share them
+scheduler = None
+history = None
 
-# Function to run monitor_services in a separate thread
-def run_monitor():
-    asyncio.run(monitor_services())
+def accepted_encodings(request):
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = part.partition(';')
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
 
-# Start the monitoring loop in a separate thread
-monitor_thread = threading.Thread(target=run_monitor, daemon=True)
-monitor_thread.start()
+def not_modified(request, page):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or page.etag in tags
+    if_modified_since = request.if_modified_since
+    return if_modified_since is not None and int(page.last_modified) <= if_modified_since.timestamp()
 
+def cache_headers():
+    return {'Cache-Control': f'public, max-age={CACHE_MAX_AGE}'}
 
+async def serve_page(request):
+    """Serves a page from memory, answering revalidations with 304 and picking a precompressed variant."""
+    page = pages.get(PAGE_ROUTES[request.path])
+    if page is None:
+        raise web.HTTPServiceUnavailable(
+            text='The status page is being generated, try again shortly.',
+            headers={'Retry-After': str(CHECK_INTERVAL)},
+        )
 
-class TinyStatusHandler(http.server.SimpleHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/tinystatus':
-            self.path = '/index.html'  # Assuming your status page is named index.html
-        return super().do_GET()
+    headers = cache_headers()
+    headers.update({
+        'ETag': page.etag,
+        'Last-Modified': email.utils.formatdate(page.last_modified, usegmt=True),
+        'Vary': 'Accept-Encoding',
+    })
+    if not_modified(request, page):
+        return web.Response(status=304, headers=headers)
 
-Handler = TinyStatusHandler
+    body = page.body
+    accepted = accepted_encodings(request)
+    for encoding in ('br', 'gzip'):
+        if encoding in page.variants and encoding in accepted:
+            headers['Content-Encoding'] = encoding
+            body = page.variants[encoding]
+            break
+    return web.Response(body=body, content_type='text/html', charset='utf-8', headers=headers)
 
-with socketserver.TCPServer(("", PORT), Handler) as httpd:
-    logging.info(f"Serving at http://localhost:{PORT}")
+async def api_status(request):
+    results = scheduler.Results()
+    return web.json_response({
+        'checks': results,
+        'down': [result['name'] for result in results if not result['status']],
+    }, headers=cache_headers())
+
+async def api_history(request):
+    return web.json_response(history.Recent(), headers=cache_headers())
+
+async def api_check_history(request):
+    """The recent results of one check and its uptime per hour or day, ?period=hour|day&days=N."""
+    name = request.match_info['name']
+    period = request.query.get('period', 'hour')
+    if period not in ROLLUP_DAYS:
+        raise web.HTTPBadRequest(text=f"Unknown period {period}, use one of {', '.join(ROLLUP_DAYS)}")
     try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
-        logging.info("Server stopped by user")
-    except Exception as e:
-        logging.error(f"An error occurred: {str(e)}")
-    finally:
-        httpd.server_close()
-        logging.info("Server closed")
\ No newline at end of file
+        days = float(request.query.get('days', ROLLUP_DAYS[period]))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Invalid days {request.query['days']}")
+
+    recent = history.Recent()
+    if name not in recent:
+        raise web.HTTPNotFound(text=f"Unknown check {name}")
+    return web.json_response({
+        'name': name,
+        'recent': recent[name],
+        'period': period,
+        'rollups': history.Rollups(name, period, since=time.time() - days * 86400),
+    }, headers=cache_headers())
+
+async def monitor_ctx(app):
+    """Runs the monitor on the server's event loop for the life of the app."""
+    global scheduler, history
+    history = HistoryStore()
+    history.Open()
+    scheduler = CheckScheduler()
+
+    # serve the pages of the previous run until the first round is rendered
+    for path in set(PAGE_ROUTES.values()):
+        if path not in pages and os.path.exists(path):
+            with open(path, 'r') as f:
+                pages[path] = RenderedPage(f.read())
+
+    task = asyncio.create_task(monitor_services(scheduler, history))
+    yield
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    history.Close()
+
+def create_app():
+    app = web.Application()
+    app.cleanup_ctx.append(monitor_ctx)
+    for path in PAGE_ROUTES:
+        app.router.add_get(path, serve_page)
+    app.router.add_get('/api/status', api_status)
+    app.router.add_get('/api/history', api_history)
+    app.router.add_get('/api/history/{name}', api_check_history)
+    return app
+
+if __name__ == '__main__':
+    logging.info(f"Serving at http://localhost:{PORT}")
+    web.run_app(create_app(), port=PORT, print=None)
+    logging.info("Server closed")
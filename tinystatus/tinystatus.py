@@ -3,12 +3,24 @@ from dotenv import load_dotenv
 import yaml
 import asyncio
 import aiohttp
-import subprocess
+import re
 import markdown
 from jinja2 import Template
 from datetime import datetime
 import json
+import gzip
+import hashlib
+import tempfile
+import sqlite3
+import collections
 import logging
+import random
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Load environment variables
 load_dotenv()
@@ -21,130 +33,502 @@ CHECKS_FILE = os.getenv('CHECKS_FILE', 'checks.yaml')
 INCIDENTS_FILE = os.getenv('INCIDENTS_FILE', 'incidents.md')
 TEMPLATE_FILE = os.getenv('TEMPLATE_FILE', 'index.html.theme')
 HISTORY_TEMPLATE_FILE = os.getenv('HISTORY_TEMPLATE_FILE', 'history.html.theme')
+# history.json of earlier versions, imported into the history database once
 STATUS_HISTORY_FILE = os.getenv('STATUS_HISTORY_FILE', 'history.json')
+STATUS_HISTORY_DB = os.getenv('STATUS_HISTORY_DB', 'history.db')
+HISTORY_RETENTION_DAYS = float(os.getenv('HISTORY_RETENTION_DAYS', 7))
+HOURLY_RETENTION_DAYS = float(os.getenv('HOURLY_RETENTION_DAYS', 90))
+DAILY_RETENTION_DAYS = float(os.getenv('DAILY_RETENTION_DAYS', 730))
+# longest a page goes unwritten while its statuses stay the same, so its "Last updated" shows the checks still run
+PAGE_REFRESH_INTERVAL = float(os.getenv('PAGE_REFRESH_INTERVAL', 300))
+# checks running at the same time, and the defaults for the per check interval, timeout and retries in checks.yaml
+MAX_CONCURRENT_CHECKS = int(os.getenv('MAX_CONCURRENT_CHECKS', 50))
+CHECK_TIMEOUT = float(os.getenv('CHECK_TIMEOUT', 10))
+CHECK_RETRIES = int(os.getenv('CHECK_RETRIES', 0))
+RETRY_DELAY = float(os.getenv('RETRY_DELAY', 1))
+
+# seconds a resolved host name is reused by the shared HTTP session
+DNS_CACHE_TTL = int(os.getenv('DNS_CACHE_TTL', 300))
+PING_TIMEOUT = int(os.getenv('PING_TIMEOUT', 2))
+
+PING_TIME = re.compile(r'time[=<]\s*([\d.]+)\s*ms')
+
+# shared by all http checks, created on first use inside the running loop
+http_session = None
 
-# Service check functions
+def get_http_session():
+    """The pooled session of the http checks, connections are kept alive and host names cached between runs."""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_CHECKS, ttl_dns_cache=DNS_CACHE_TTL)
+        http_session = aiohttp.ClientSession(connector=connector)
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+# Service check functions, each returns whether the service is up and its latency in milliseconds
 async def check_http(url, expected_code):
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url) as response:
-                return response.status == expected_code
-        except:
-            return False
+    started = time.monotonic()
+    try:
+        async with get_http_session().get(url) as response:
+            # time to the response headers, the body isn't needed for the status
+            latency = (time.monotonic() - started) * 1000
+            return response.status == expected_code, latency
+    except Exception as e:
+        logging.debug(f"HTTP check of {url} failed: {str(e)}")
+        return False, None
 
 async def check_ping(host):
     try:
-        result = subprocess.run(['ping', '-c', '1', '-W', '2', host], capture_output=True, text=True)
-        return result.returncode == 0
-    except:
-        return False
+        process = await asyncio.create_subprocess_exec(
+            'ping', '-c', '1', '-W', str(PING_TIMEOUT), host,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    except Exception as e:
+        logging.error(f"Could not run ping for {host}: {str(e)}")
+        return False, None
+
+    try:
+        stdout, _ = await process.communicate()
+    except asyncio.CancelledError:
+        # timed out by run_check, don't leave the ping behind
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if process.returncode != 0:
+        return False, None
+    match = PING_TIME.search(stdout.decode(errors='replace'))
+    return True, float(match.group(1)) if match else None
 
-async def check_port(host, port): 
+async def check_port(host, port):
+    started = time.monotonic()
     try:
         _, writer = await asyncio.open_connection(host, port)
+        latency = (time.monotonic() - started) * 1000
         writer.close()
         await writer.wait_closed()
-        return True
-    except:
-        return False
+        return True, latency
+    except Exception as e:
+        logging.debug(f"Port check of {host}:{port} failed: {str(e)}")
+        return False, None
+
+def check_settings(check):
+    """Interval, timeout and retries of a check, from checks.yaml or the defaults."""
+    return (
+        float(check.get('interval', CHECK_INTERVAL)),
+        float(check.get('timeout', CHECK_TIMEOUT)),
+        int(check.get('retries', CHECK_RETRIES)),
+    )
+
+async def probe(check):
+    if check['type'] == 'http':
+        return await check_http(check['host'], check['expected_code'])
+    elif check['type'] == 'ping':
+        return await check_ping(check['host'])
+    elif check['type'] == 'port':
+        return await check_port(check['host'], check['port'])
+    logging.error(f"Unknown check type {check['type']} for {check['name']}")
+    return False, None
+
+async def run_check(check, semaphore):
+    """Runs one check within its timeout, retrying a failure up to its retries, holding a semaphore slot per attempt."""
+    _, timeout, retries = check_settings(check)
+    status, latency = False, None
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(RETRY_DELAY)
+        async with semaphore:
+            try:
+                status, latency = await asyncio.wait_for(probe(check), timeout)
+            except asyncio.TimeoutError:
+                logging.debug(f"{check['name']} timed out after {timeout}s")
+                status, latency = False, None
+        if status:
+            break
+    return {
+        'name': check['name'],
+        'status': status,
+        'latency_ms': round(latency, 1) if latency is not None else None,
+        'timestamp': time.time(),
+    }
 
 async def run_checks(checks):
-    results = []
-    for check in checks:
-        if check['type'] == 'http':
-            status = await check_http(check['host'], check['expected_code'])
-        elif check['type'] == 'ping':
-            status = await check_ping(check['host'])
-        elif check['type'] == 'port':
-            status = await check_port(check['host'], check['port'])
-        results.append({'name': check['name'], 'status': status})
-    return results
+    """Runs every check once, concurrently, at most MAX_CONCURRENT_CHECKS at a time."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHECKS)
+    return await asyncio.gather(*[run_check(check, semaphore) for check in checks])
+
+class CheckScheduler:
+    """
+    Runs every check in its own loop on its own interval, so a slow or hanging host only delays itself.
+    Start times are spread randomly over the first CHECK_INTERVAL and every later run is jittered by a few
+    percent, so thousands of checks don't fire in the same instant.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_CHECKS):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.tasks = {}
+        self.checks = {}
+        # latest result per check name, in checks.yaml order
+        self.latest = {}
+        # results since the last call to Collect, for the history
+        self.completed = []
+
+    def Update(self, checks):
+        """Starts loops for new or changed checks and stops those no longer configured."""
+        configured = {check['name']: check for check in checks}
+        for name in list(self.tasks):
+            if configured.get(name) != self.checks.get(name):
+                self.tasks.pop(name).cancel()
+                self.checks.pop(name, None)
+                if name not in configured:
+                    self.latest.pop(name, None)
+
+        for name, check in configured.items():
+            if name not in self.tasks:
+                self.checks[name] = check
+                self.tasks[name] = asyncio.create_task(self._Loop(check))
+
+        self.latest = {name: self.latest[name] for name in configured if name in self.latest}
+
+    async def _Loop(self, check):
+        interval, _, _ = check_settings(check)
+        await asyncio.sleep(random.uniform(0, min(interval, CHECK_INTERVAL) * 0.9))
+        while True:
+            started = time.monotonic()
+            try:
+                result = await run_check(check, self.semaphore)
+            except Exception as e:
+                logging.error(f"Check {check['name']} failed: {str(e)}")
+                result = {'name': check['name'], 'status': False, 'latency_ms': None, 'timestamp': time.time()}
+            self.latest[check['name']] = result
+            self.completed.append(result)
+
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(max(interval * random.uniform(0.95, 1.05) - elapsed, 0))
+
+    def Results(self):
+        return list(self.latest.values())
+
+    def Collect(self):
+        completed, self.completed = self.completed, []
+        return completed
+
+    def Stop(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+
+async def run_checks_once(checks):
+    try:
+        return await run_checks(checks)
+    finally:
+        await close_http_session()
 
 # History management
-def load_history():
-    if os.path.exists(STATUS_HISTORY_FILE):
-        with open(STATUS_HISTORY_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_history(history):
-    with open(STATUS_HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2)
-
-def update_history(results):
-    history = load_history()
-    current_time = datetime.now().isoformat()
-    for check in results:
-        if check['name'] not in history:
-            history[check['name']] = []
-        history[check['name']].append({'timestamp': current_time, 'status': check['status']})
-        history[check['name']] = history[check['name']][-MAX_HISTORY_ENTRIES:]
-    save_history(history)
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    name TEXT NOT NULL,
+    ts REAL NOT NULL,
+    status INTEGER NOT NULL,
+    latency_ms REAL,
+    PRIMARY KEY (name, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollups (
+    name TEXT NOT NULL,
+    period TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    up INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    latency_sum REAL NOT NULL,
+    latency_count INTEGER NOT NULL,
+    PRIMARY KEY (name, period, start)
+) WITHOUT ROWID;
+"""
+
+class HistoryStore:
+    """
+    Check results appended to a SQLite file once per round, with hourly and daily rollups updated as the results
+    come in, so uptime over months is a read of a few hundred rows instead of a scan of every result.
+    The last MAX_HISTORY_ENTRIES results per check are kept in memory for the history page.
+    Notes:
+        - Raw results are kept for HISTORY_RETENTION_DAYS, hourly rollups for HOURLY_RETENTION_DAYS and daily
+          rollups for DAILY_RETENTION_DAYS, pruned at most once an hour.
+        - Rollup periods start on UTC hour and day boundaries.
+        - A history.json left by earlier versions is imported when the database is created.
+    """
+    PERIODS = {'hour': 3600, 'day': 86400}
+
+    def __init__(self, path=None, max_recent=MAX_HISTORY_ENTRIES):
+        self.path = path or STATUS_HISTORY_DB
+        self.max_recent = max_recent
+        self.recent = {}
+        self.connection = None
+        self.pruned_time = 0.0
+
+    def Open(self):
+        created = not os.path.exists(self.path)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(HISTORY_SCHEMA)
+        if created and os.path.exists(STATUS_HISTORY_FILE):
+            self._import_json(STATUS_HISTORY_FILE)
+        self._load_recent()
+
+    def Close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def Names(self):
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT name FROM rollups WHERE period = 'day'")]
+
+    def _load_recent(self):
+        for name in self.Names():
+            rows = self.connection.execute(
+                'SELECT ts, status, latency_ms FROM samples WHERE name = ? ORDER BY ts DESC LIMIT ?',
+                (name, self.max_recent)).fetchall()
+            recent = self._recent(name)
+            for ts, status, latency_ms in reversed(rows):
+                recent.append(self._entry(ts, status, latency_ms))
+
+    def _import_json(self, path):
+        with open(path, 'r') as f:
+            history = json.load(f)
+        results = []
+        for name, entries in history.items():
+            for entry in entries:
+                results.append({
+                    'name': name,
+                    'status': entry['status'],
+                    'latency_ms': entry.get('latency_ms'),
+                    'timestamp': datetime.fromisoformat(entry['timestamp']).timestamp(),
+                })
+        self.Append(results)
+        logging.info(f"Imported {len(results)} results from {path}")
+
+    def _recent(self, name):
+        recent = self.recent.get(name)
+        if recent is None:
+            recent = self.recent[name] = collections.deque(maxlen=self.max_recent)
+        return recent
+
+    @staticmethod
+    def _entry(ts, status, latency_ms):
+        return {'timestamp': datetime.fromtimestamp(ts).isoformat(), 'status': bool(status), 'latency_ms': latency_ms}
+
+    def Append(self, results):
+        """Stores a round of results, one insert per result and one rollup update per result and period."""
+        samples, rollups = [], []
+        for result in results:
+            ts = result.get('timestamp') or time.time()
+            status = int(bool(result['status']))
+            latency_ms = result.get('latency_ms')
+            samples.append((result['name'], ts, status, latency_ms))
+            for period, seconds in self.PERIODS.items():
+                rollups.append((result['name'], period, int(ts // seconds * seconds), status,
+                                latency_ms or 0.0, 0 if latency_ms is None else 1))
+            self._recent(result['name']).append(self._entry(ts, status, latency_ms))
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)', samples)
+            self.connection.executemany(
+                'INSERT INTO rollups VALUES (?, ?, ?, ?, 1, ?, ?) '
+                'ON CONFLICT (name, period, start) DO UPDATE SET '
+                'up = up + excluded.up, total = total + 1, '
+                'latency_sum = latency_sum + excluded.latency_sum, latency_count = latency_count + excluded.latency_count',
+                rollups)
+
+        if time.time() - self.pruned_time > 3600:
+            self.Prune()
+
+    def Prune(self):
+        """Drops results and rollups past their retention, per check so every delete is a range of the primary key."""
+        now = time.time()
+        self.pruned_time = now
+        retention = {
+            'hour': now - HOURLY_RETENTION_DAYS * 86400,
+            'day': now - DAILY_RETENTION_DAYS * 86400,
+        }
+        with self.connection:
+            for name in self.Names():
+                self.connection.execute('DELETE FROM samples WHERE name = ? AND ts < ?',
+                                        (name, now - HISTORY_RETENTION_DAYS * 86400))
+                for period, cutoff in retention.items():
+                    self.connection.execute('DELETE FROM rollups WHERE name = ? AND period = ? AND start < ?',
+                                            (name, period, cutoff))
+
+    def Recent(self):
+        """The last results per check, oldest first, for the history page."""
+        return {name: list(entries) for name, entries in self.recent.items() if entries}
+
+    def Rollups(self, name, period='hour', since=None):
+        """Uptime percentage and average latency of a check per hour or day, oldest first."""
+        rows = self.connection.execute(
+            'SELECT start, up, total, latency_sum, latency_count FROM rollups '
+            'WHERE name = ? AND period = ? AND start >= ? ORDER BY start',
+            (name, period, since or 0))
+        return [{
+            'start': datetime.fromtimestamp(start).isoformat(),
+            'uptime': round(up * 100 / total, 2),
+            'latency_ms': round(latency_sum / latency_count, 1) if latency_count else None,
+        } for start, up, total, latency_sum, latency_count in rows]
+
+    def Uptime(self, days):
+        """Uptime percentage per check over the last days, from the hourly rollups."""
+        rows = self.connection.execute(
+            "SELECT name, SUM(up), SUM(total) FROM rollups WHERE period = 'hour' AND start >= ? GROUP BY name",
+            (time.time() - days * 86400,))
+        return {name: round(up * 100 / total, 2) for name, up, total in rows if total}
+
+# Rendering
+# parsed contents of the config, incidents and template files by path, with the mtime and size they were read at
+file_cache = {}
+# template, digest of the statuses and time each page was last rendered with
+rendered_pages = {}
+# the latest version of each page by path, served from memory by server.py
+pages = {}
+
+class RenderedPage:
+    """A rendered page with its validators and compressed variants, gzip always and brotli when it is installed."""
+
+    def __init__(self, html):
+        self.body = html.encode('utf-8')
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:24]}"'
+        self.last_modified = time.time()
+        self.variants = {'gzip': gzip.compress(self.body, 9)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(self.body)
+
+def load_cached(path, parse):
+    """Returns parse(contents of path), reading and parsing the file again only when its mtime or size changed."""
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = file_cache.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with open(path, 'r') as f:
+        value = parse(f.read())
+    file_cache[path] = (version, value)
+    return value
+
+def write_atomic(path, content):
+    """Writes through a temporary file in the same directory renamed over path, readers see the old or the new page."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def render_page(path, template, last_updated, statuses, **context):
+    """
+    Renders and writes a page unless the template and statuses are the ones it was last written from.
+    statuses is what the page says about the checks, latencies and check times are left out of it,
+    they change every round. The page is still rendered every PAGE_REFRESH_INTERVAL seconds,
+    its last_updated then shows the time of a recent check round.
+    Returns whether the page was written.
+    """
+    digest = hashlib.sha256(json.dumps(statuses, sort_keys=True, default=str).encode()).hexdigest()
+    rendered = rendered_pages.get(path)
+    if (rendered is not None and rendered[:2] == (id(template), digest)
+            and time.monotonic() - rendered[2] < PAGE_REFRESH_INTERVAL and os.path.exists(path)):
+        return False
+    html = template.render(last_updated=last_updated, **context)
+    write_atomic(path, html)
+    pages[path] = RenderedPage(html)
+    rendered_pages[path] = (id(template), digest, time.monotonic())
+    return True
 
 # Main monitoring loop
-async def monitor_services():
+async def monitor_services(scheduler=None, history=None):
+    """
+    Runs the checks and renders the pages until cancelled.
+    server.py passes its own scheduler and opened history store to answer API requests from them,
+    a history store passed in is left open.
+    """
+    # the checks run on their own schedules, every CHECK_INTERVAL the page is rendered from their latest results
+    scheduler = scheduler or CheckScheduler()
+    owns_history = history is None
+    if owns_history:
+        history = HistoryStore()
+        history.Open()
+    try:
+        await _monitor_loop(scheduler, history)
+    finally:
+        scheduler.Stop()
+        if owns_history:
+            history.Close()
+        await close_http_session()
+
+async def _monitor_loop(scheduler, history):
     while True:
         try:
-            with open(CHECKS_FILE, 'r') as f:
-                checks = yaml.safe_load(f)
-
-            with open(INCIDENTS_FILE, 'r') as f:
-                incidents = markdown.markdown(f.read())
+            scheduler.Update(load_cached(CHECKS_FILE, yaml.safe_load))
+            # new checks start within the first interval, so the page has their results when it is rendered
+            await asyncio.sleep(CHECK_INTERVAL)
 
-            with open(TEMPLATE_FILE, 'r') as f:
-                template = Template(f.read())
+            incidents = load_cached(INCIDENTS_FILE, markdown.markdown)
+            template = load_cached(TEMPLATE_FILE, Template)
+            history_template = load_cached(HISTORY_TEMPLATE_FILE, Template)
 
-            with open(HISTORY_TEMPLATE_FILE, 'r') as f:
-                history_template = Template(f.read())
-
-            results = await run_checks(checks)
-            update_history(results)
+            history.Append(scheduler.Collect())
+            results = scheduler.Results()
 
             current_time = datetime.now()
             formatted_time = current_time.strftime("%Y-%m-%d %H:%M:%S")
 
-            html = template.render(
-                checks=results, 
-                incidents=incidents, 
-                last_updated=formatted_time
+            # a page is rewritten when what it says about the checks changes, not for every round's latencies
+            status_changed = render_page(
+                'index.html',
+                template,
+                formatted_time,
+                ([(result['name'], result['status']) for result in results], incidents),
+                checks=[{key: value for key, value in result.items() if key != 'timestamp'} for result in results],
+                incidents=incidents,
             )
-            with open('index.html', 'w') as f:
-                f.write(html)
-
-            history_html = history_template.render(
-                history=load_history(), 
-                last_updated=formatted_time
+            recent = history.Recent()
+            uptime_day, uptime_month = history.Uptime(1), history.Uptime(30)
+            history_changed = render_page(
+                'history.html',
+                history_template,
+                formatted_time,
+                ({name: [entry['status'] for entry in entries] for name, entries in recent.items()}, uptime_day, uptime_month),
+                history=recent,
+                uptime_day=uptime_day,
+                uptime_month=uptime_month,
             )
-            with open('history.html', 'w') as f:
-                f.write(history_html)
 
-            logging.info(f"Status page and history updated at {formatted_time}")
+            if status_changed or history_changed:
+                logging.info(f"Status page and history updated at {formatted_time}")
+            else:
+                logging.debug(f"Status page and history unchanged at {formatted_time}")
             down_services = [check['name'] for check in results if not check['status']]
             if down_services:
                 logging.warning(f"Services currently down: {', '.join(down_services)}")
 
         except Exception as e:
             logging.error(f"An error occurred: {str(e)}")
-
-        await asyncio.sleep(CHECK_INTERVAL)
+            await asyncio.sleep(CHECK_INTERVAL)
 
 # Main function
 def main():
-    with open(CHECKS_FILE, 'r') as f:
-        checks = yaml.safe_load(f)
-
-    with open(INCIDENTS_FILE, 'r') as f:
+    checks = load_cached(CHECKS_FILE, yaml.safe_load)
+    incidents = load_cached(INCIDENTS_FILE, markdown.markdown)
+    template = load_cached(TEMPLATE_FILE, Template)
 
-        incidents = markdown.markdown(f.read())
-
-    with open(TEMPLATE_FILE, 'r') as f:
-        template = Template(f.read())
-
-    results = asyncio.run(run_checks(checks))
+    results = asyncio.run(run_checks_once(checks))
     html = template.render(checks=results, incidents=incidents, last_updated=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-
-    with open('index.html', 'w') as f:
-        f.write(html)
+    write_atomic('index.html', html)
 
 if __name__ == "__main__":
     logging.basicConfig(level=getattr(logging, LOG_LEVEL), format='%(asctime)s - %(levelname)s - %(message)s')